@@ -0,0 +1,78 @@
+"""بنچمارک موتور هشدار: حلقه پایتونی هر هشدار در برابر گذر برداری AlertIndex.evaluate
+
+    python bench/alerts.py [--alerts 1000000] [--coins 5000] [--fresh 500] [--move 0.02]
+"""
+import argparse
+import random
+
+import numpy as np
+
+from common import Timer, load_bot, peak_rss_mb
+
+
+def python_loop(alerts, prices):
+    """همون بررسی قدیمی: یک if برای هر هشدار"""
+    hits = []
+    for user_id, cg_id, op, target in alerts:
+        price = prices.get(cg_id)
+        if price is None:
+            continue
+        if (op == '>=' and price >= target) or (op == '<=' and price <= target):
+            hits.append((user_id, cg_id))
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alerts", type=int, default=1_000_000)
+    parser.add_argument("--coins", type=int, default=5000)
+    parser.add_argument("--fresh", type=int, default=500, help="تعداد ارزهایی که هر دور قیمت تازه دارن")
+    parser.add_argument("--move", type=float, default=0.02, help="بیشترین تغییر نسبی قیمت در هر دور")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    rng = random.Random(1)
+    coins = [f"coin-{i}" for i in range(args.coins)]
+    base = {cg_id: rng.uniform(0.01, 50_000) for cg_id in coins}
+
+    alerts = []
+    for user_id in range(args.alerts):
+        # هدف‌ها مثل هشدار واقعی سمت دیگه قیمت فعلی‌ان (هنوز فعال نشدن)
+        cg_id = rng.choice(coins)
+        op = rng.choice(('>=', '<='))
+        alerts.append((user_id, cg_id, op, base[cg_id] * (1 + rng.uniform(0, 0.2) * (1 if op == '>=' else -1))))
+
+    index = bot.AlertIndex()
+    with Timer() as t_build:
+        for alert in alerts:
+            index.set(*alert)
+    print(f"{args.alerts:,} هشدار روی {args.coins:,} ارز — ساخت ایندکس: {t_build.elapsed:.2f}s")
+
+    loop_times, vector_times = [], []
+    for _ in range(args.rounds):
+        prices = {cg_id: base[cg_id] * rng.uniform(1 - args.move, 1 + args.move) for cg_id in rng.sample(coins, args.fresh)}
+        with Timer() as t_loop:
+            expected = python_loop(alerts, prices)
+        with Timer() as t_vector:
+            hits = index.evaluate(prices)
+        assert sorted(hits) == sorted(expected)
+        loop_times.append(t_loop.elapsed)
+        vector_times.append(t_vector.elapsed)
+
+    loop, vector = np.median(loop_times), np.median(vector_times)
+    print(f"حلقه پایتونی:  {loop * 1000:8.1f} ms")
+    print(f"evaluate:      {vector * 1000:8.1f} ms   ({loop / vector:.0f}x سریع‌تر، {len(hits):,} هشدار فعال)")
+
+    # به‌روزرسانی تدریجی (مثل save_alert / clear_alert)
+    sample = rng.sample(alerts, 10_000)
+    with Timer() as t_update:
+        for user_id, cg_id, op, target in sample:
+            index.remove(user_id, cg_id)
+            index.set(user_id, cg_id, op, target)
+    print(f"set/remove:    {t_update.elapsed / len(sample) * 1e6:8.1f} µs برای هر تغییر")
+    print(f"peak RSS:      {peak_rss_mb():8.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""بنچمارک کاتالوگ ارزها: بارگذاری mmap فایل catalog.bin و refresh از dump ـه /coins/list
+
+    python bench/catalog.py                         # ۱۵k ارز
+    python bench/catalog.py --coins 30000 --json
+
+یک coins_list.json مصنوعی (مثل bench/search.py) تو یک پوشه موقت نوشته میشه و refresh_catalog ازش
+catalog.bin می‌سازه. بعد:
+  load         load_catalog: mmap فایل و خوندن header (کمترین زمان از --repeat بار)
+  first_search اولین search روی کاتالوگ تازه بارگذاری‌شده (صفحه‌های لازم از فایل خونده میشن)
+  refresh_noop refresh_catalog وقتی فایل منبع عوض نشده (فقط stat)
+  refresh_touch refresh_catalog وقتی فقط mtime منبع عوض شده (فقط header دوباره نوشته میشه)
+  build        refresh_catalog با یک ارز جدید (ساخت کامل فایل)
+گزارش: زمان هر مرحله (ms) و حجم فایل؛ load باید زیر --max-ms باشه.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+
+from common import Timer, load_bot
+from search import synthetic_catalog
+
+
+def write_source(path, coins):
+    with open(path, "w") as f:
+        json.dump([{'id': cg_id, 'symbol': symbol.lower(), 'name': name} for symbol, cg_id, name in coins], f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--coins", type=int, default=15_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, default=1.0, help="سقف زمان load")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    coins = synthetic_catalog(bot, args.coins, random.Random(args.seed))
+    result = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        source = os.path.join(data_dir, "coins_list.json")
+        path = os.path.join(data_dir, "catalog.bin")
+        write_source(source, coins)
+        bot.refresh_catalog(source, path)
+        result['coins'] = len(bot.coin_index)
+        result['file_bytes'] = os.path.getsize(path)
+
+        loads = []
+        for _ in range(args.repeat):
+            with Timer() as t:
+                index = bot.load_catalog(path)
+            loads.append(t.elapsed)
+            with Timer() as t:
+                index.search("bitcoin")
+        result['load_ms'] = min(loads) * 1000
+        result['first_search_ms'] = t.elapsed * 1000
+
+        with Timer() as t:
+            assert not bot.refresh_catalog(source, path)
+        result['refresh_noop_ms'] = t.elapsed * 1000
+
+        os.utime(source)
+        with Timer() as t:
+            assert bot.refresh_catalog(source, path)
+        result['refresh_touch_ms'] = t.elapsed * 1000
+
+        write_source(source, coins + [("BENCH", "bench-new-coin", "Bench New Coin")])
+        with Timer() as t:
+            assert bot.refresh_catalog(source, path)
+        result['build_ms'] = t.elapsed * 1000
+        assert bot.coin_index.get("bench-new-coin")
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(f"{key:<18}{value:>12,.3f}" if isinstance(value, float) else f"{key:<18}{value:>12,}")
+    assert result['load_ms'] < args.max_ms, f"load {result['load_ms']:.2f}ms"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""راه‌اندازی bot.py برای بنچمارک‌ها، بدون سرویس بیرونی
+
+اگه BENCH_REDIS_URL داده بشه از همون Redis (مثلاً یک redis-server محلی) استفاده میشه،
+وگرنه از fakeredis داخل پروسه.
+"""
+import os
+import sys
+import time
+import resource
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot():
+    os.environ.setdefault("TOKEN", "123456:bench")
+    os.environ.setdefault("BOT_MODE", "worker")
+    redis_url = os.environ.get("BENCH_REDIS_URL")
+    if redis_url:
+        os.environ["UPSTASH_REDIS_URL"] = redis_url
+    else:
+        import fakeredis
+        import fakeredis.aioredis
+        import redis
+        import redis.asyncio
+
+        server = fakeredis.FakeServer()
+
+        def from_url(url, **kwargs):
+            kwargs.pop("ssl_cert_reqs", None)
+            return fakeredis.FakeRedis(server=server, **kwargs)
+
+        def async_from_url(url, **kwargs):
+            kwargs.pop("ssl_cert_reqs", None)
+            return fakeredis.aioredis.FakeRedis(server=server, **kwargs)
+
+        redis.from_url = from_url
+        redis.asyncio.from_url = async_from_url
+        os.environ["UPSTASH_REDIS_URL"] = "redis://fake"
+    sys.path.insert(0, ROOT)
+    import bot
+    return bot
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RedisOps:
+    """شمارش دستورهای Redis هر دو کلاینت sync و async (هر دستور داخل pipeline هم یکی حساب میشه)"""
+
+    def __init__(self):
+        import redis
+        import redis.asyncio
+        import redis.asyncio.client
+        import redis.client
+
+        self.count = 0
+        execute_command = redis.Redis.execute_command
+        pipeline_execute = redis.client.Pipeline.execute
+        async_execute_command = redis.asyncio.Redis.execute_command
+        async_pipeline_execute = redis.asyncio.client.Pipeline.execute
+
+        def counted_command(client, *args, **kwargs):
+            self.count += 1
+            return execute_command(client, *args, **kwargs)
+
+        def counted_pipeline(pipe, *args, **kwargs):
+            self.count += len(pipe.command_stack)
+            return pipeline_execute(pipe, *args, **kwargs)
+
+        async def async_counted_command(client, *args, **kwargs):
+            self.count += 1
+            return await async_execute_command(client, *args, **kwargs)
+
+        async def async_counted_pipeline(pipe, *args, **kwargs):
+            self.count += len(pipe.command_stack)
+            return await async_pipeline_execute(pipe, *args, **kwargs)
+
+        redis.Redis.execute_command = counted_command
+        redis.client.Pipeline.execute = counted_pipeline
+        redis.asyncio.Redis.execute_command = async_counted_command
+        redis.asyncio.client.Pipeline.execute = async_counted_pipeline
+
+    def reset(self):
+        count, self.count = self.count, 0
+        return count
@@ -0,0 +1,235 @@
+"""بنچمارک آفلاین چرخه چک قیمت و هندلرها
+
+    python bench/cycle.py                       # ۱k، ۱۰k و ۱۰۰k کاربر، هر کدوم در یک پروسه جدا
+    python bench/cycle.py --users 10000 --json  # فقط یک اندازه
+
+Redis: fakeredis داخل پروسه یا BENCH_REDIS_URL (دیتابیسش خالی میشه!). CoinGecko و Bot API تلگرام
+با bench/stubs.py شبیه‌سازی میشن، پس هیچ درخواستی از ماشین بیرون نمیره.
+گزارش: زمان دیوار هر مرحله، تعداد دستورهای Redis، درخواست‌های upstream، پیام در ثانیه و حافظه.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import Counter
+from types import SimpleNamespace
+
+from common import RedisOps, Timer, load_bot, peak_rss_mb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = (1_000, 10_000, 100_000)
+
+
+def start_stubs(latency=0.0):
+    cmd = [sys.executable, os.path.join(HERE, "stubs.py"), f"--latency={latency}"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline())
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def stub_stats(url, reset=False):
+    request = urllib.request.Request(f"{url}/_reset" if reset else f"{url}/_stats", method="POST" if reset else "GET")
+    with urllib.request.urlopen(request) as resp:
+        return json.loads(resp.read())
+
+
+def stub_sends(url):
+    """[(زمان، chat_id), ...] همه sendMessage ها از آخرین reset"""
+    with urllib.request.urlopen(f"{url}/_sends") as resp:
+        return [tuple(send) for send in json.loads(resp.read())["sends"]]
+
+
+def random_settings(bot, coins, alert_ratio, rng):
+    """تنظیمات یک کاربر مصنوعی: ۱ تا MAX_COINS ارز با دوره‌های مختلف، بعضی‌ها با هشدار"""
+    periods = [15] + [mins for mins, _ in bot.TIME_OPTIONS]
+    settings = []
+    for cg_id in rng.sample(coins, rng.randint(1, bot.MAX_COINS)):
+        item = {'symbol': cg_id[:5].upper(), 'cg_id': cg_id, 'period': rng.choice(periods), 'last_sent': 0}
+        if rng.random() < alert_ratio:
+            op = rng.choice(('>=', '<=', '%'))
+            if op == '%':
+                item['alert'] = {'op': op, 'price': rng.choice((1, 2, 5)), 'window': rng.choice((15, 60))}
+            else:
+                item['alert'] = {'op': op, 'price': rng.uniform(1, 10_000)}
+        settings.append(item)
+    return settings
+
+
+def seed_users(bot, users, coins, alert_ratio, rng):
+    items_total = alerts_total = 0
+    for user_id in range(1, users + 1):
+        settings = random_settings(bot, coins, alert_ratio, rng)
+        items_total += len(settings)
+        alerts_total += sum('alert' in item for item in settings)
+        bot.set_user_data(user_id, settings)
+    return items_total, alerts_total
+
+
+def callback_update(bot, app, user_id, data, seq):
+    return bot.Update.de_json({
+        'update_id': seq,
+        'callback_query': {
+            'id': str(seq),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+            'chat_instance': 'bench',
+            'data': data,
+            'message': {
+                'message_id': seq, 'date': int(time.time()), 'text': '-',
+                'chat': {'id': user_id, 'type': 'private'},
+            },
+        },
+    }, app.bot)
+
+
+async def run_once(args):
+    stubs, stub_url = start_stubs()
+    os.environ["COINGECKO_API_URL"] = stub_url
+    os.environ["TELEGRAM_API_URL"] = f"{stub_url}/bot"
+    os.environ.setdefault("CHECKER_SHARDS", str(args.shards))
+    try:
+        bot = load_bot()
+        ops = RedisOps()
+        if os.environ.get("BENCH_REDIS_URL"):
+            bot.r.flushdb()
+        rng = random.Random(args.seed)
+        coins = [cg_id for _, cg_id, _ in bot.builtin_coins()]
+        coins += [f"bench-coin-{i}" for i in range(max(0, args.coins - len(coins)))]
+        result = {'users': args.users, 'coins': len(coins)}
+
+        with Timer() as t:
+            result['items'], result['alerts'] = seed_users(bot, args.users, coins, args.alert_ratio, rng)
+        result['seed_s'] = t.elapsed
+
+        ops.reset()
+        with Timer() as t:
+            await bot.ensure_indexes()
+        result['index_s'], result['index_redis_ops'] = t.elapsed, ops.reset()
+
+        await bot.shard_manager.rebalance()
+        for shard in bot.shard_manager.owned:
+            bot.load_alert_shard(shard)
+
+        app = bot.application = bot.build_application()
+        await app.initialize()
+        # محدودیت‌های نرخ تلگرام/CoinGecko اینجا خاموشن: خود کد اندازه گرفته میشه نه سقف API
+        bot.dispatcher = bot.MessageDispatcher(workers=args.senders, global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+        await bot.dispatcher.start(app.bot)
+        for provider in bot.price_source.providers:
+            provider.governor = bot.RateGovernor(1e9, 1e9)
+
+        stub_stats(stub_url, reset=True)
+        ops.reset()
+        with Timer() as t:
+            await bot.price_feed.refresh()
+        stats = stub_stats(stub_url)
+        result['feed_s'] = t.elapsed
+        result['feed_upstream_calls'] = stats.get('coingecko_calls', 0)
+        result['feed_redis_ops'] = ops.reset()
+
+        # گیرنده‌های ممکن: کاربرانی که ارز due دارن + کاربرانی که هشدار دارن (digest هشدار بدون ورودی due)
+        now = time.time()
+        recipients = {user_id for user_id, settings in await bot.load_users(list(range(1, args.users + 1)))
+                      if any('alert' in item for item in settings)}
+        for shard in bot.shard_manager.owned:
+            recipients.update(await bot.get_due(shard, now))
+        ops.reset()
+
+        stub_stats(stub_url, reset=True)
+        with Timer() as t:
+            await bot.safe_check_prices()
+        stats = stub_stats(stub_url)
+        result['cycle_s'] = t.elapsed
+        result['cycle_redis_ops'] = ops.reset()
+        result['cycle_upstream_calls'] = stats.get('coingecko_calls', 0)
+        result['messages'] = stats.get('telegram_sendMessage', 0)
+        result['messages_per_s'] = result['messages'] / t.elapsed if t.elapsed else 0
+        # هر کاربر در هر چرخه یک digest (حداکثر MAX_COINS خط، خیلی کمتر از ۴۰۹۶ کاراکتر)
+        per_chat = Counter(chat_id for _, chat_id in stub_sends(stub_url))
+        assert result['messages'] <= len(recipients), (result['messages'], len(recipients))
+        assert max(per_chat.values(), default=0) <= 1, per_chat.most_common(3)
+
+        # get_price: بار اول از Redis (L2)، بار دوم از کش L1
+        sample = rng.sample(coins, min(200, len(coins)))
+        bot.price_cache._entries.clear()
+        for name in ('get_price_cold_ms', 'get_price_warm_ms'):
+            ops.reset()
+            with Timer() as t:
+                for cg_id in sample:
+                    await bot.get_price(cg_id)
+            result[name] = t.elapsed / len(sample) * 1000
+            result[name.replace('_ms', '_redis_ops')] = ops.reset() / len(sample)
+
+        # هندلرها با Update واقعی و Bot API جعلی
+        context = SimpleNamespace(user_data={}, bot=app.bot)
+        handler_users = [rng.randint(1, args.users) for _ in range(args.handler_calls)]
+        for name, handler, data in (
+            ('list_coins_ms', bot.list_coins, 'list_coins'),
+            ('add_coin_menu_ms', bot.add_coin_menu, 'add_coin'),
+        ):
+            ops.reset()
+            with Timer() as t:
+                for seq, user_id in enumerate(handler_users):
+                    await handler(callback_update(bot, app, user_id, data, seq), context)
+            result[name] = t.elapsed / len(handler_users) * 1000
+            result[name.replace('_ms', '_redis_ops')] = ops.reset() / len(handler_users)
+
+        await bot.dispatcher.stop()
+        await bot.price_source.aclose()
+        await app.shutdown()
+        result['peak_rss_mb'] = peak_rss_mb()
+        return result
+    finally:
+        stubs.terminate()
+
+
+def print_table(results):
+    rows = [
+        ('users', '{:,}'), ('items', '{:,}'), ('alerts', '{:,}'),
+        ('index_s', '{:.2f}'), ('feed_s', '{:.2f}'), ('feed_upstream_calls', '{}'),
+        ('cycle_s', '{:.2f}'), ('cycle_redis_ops', '{:,}'), ('cycle_upstream_calls', '{}'),
+        ('messages', '{:,}'), ('messages_per_s', '{:,.0f}'),
+        ('get_price_cold_ms', '{:.2f}'), ('get_price_warm_ms', '{:.3f}'),
+        ('list_coins_ms', '{:.2f}'), ('add_coin_menu_ms', '{:.2f}'), ('peak_rss_mb', '{:.0f}'),
+    ]
+    for key, fmt in rows:
+        print(f"{key:<22}" + "".join(f"{fmt.format(result[key]):>14}" for result in results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, help="فقط همین اندازه (پیش‌فرض: %s)" % ", ".join(map(str, SIZES)))
+    parser.add_argument("--coins", type=int, default=1000)
+    parser.add_argument("--alert-ratio", type=float, default=0.1)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--senders", type=int, default=32)
+    parser.add_argument("--handler-calls", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    if args.users:
+        result = asyncio.run(run_once(args))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_table([result])
+        return
+
+    # هر اندازه تو یک پروسه جدا، تا حافظه و کش‌ها روی هم اثر نذارن
+    results = []
+    for users in SIZES:
+        cmd = [sys.executable, __file__, "--users", str(users), "--json"]
+        cmd += [f"--{key.replace('_', '-')}={value}" for key, value in vars(args).items()
+                if key not in ("users", "json")]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""بنچمارک MessageDispatcher با محدودیت‌های واقعی (پیش‌فرض‌های خود ربات، نه ۱e9 ـه bench/cycle.py)
+
+    python bench/dispatcher.py                      # ۲۰۰ چت، هر کدوم ۳ پیام + ۴۰۰ پیام تکی
+    python bench/dispatcher.py --chats 500 --per-chat 2 --json
+
+Bot API با bench/stubs.py شبیه‌سازی میشه و زمان هر sendMessage از لاگ /_sends ـه stub خونده میشه،
+یعنی چیزی که تلگرام می‌بینه. همه پیام‌ها یکجا مثل چرخه چک قیمت submit میشن. بررسی‌ها:
+  global    تو هیچ بازه یک‌ثانیه‌ای بیشتر از --global-limit پیام (سقف تلگرام: ۳۰ در ثانیه)
+  per-chat  ارسال‌های هر چت با token bucket نرخ --chat-limit در ثانیه و burst ـه dispatcher جور درمیاد
+            (تلگرام: یک پیام در ثانیه در هر چت، burst کوتاه مجازه)
+گزارش: پیام در ثانیه، بیشترین پیام در یک ثانیه (کل و هر چت)، تأخیر صف (میانه و p99).
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from common import load_bot
+from cycle import start_stubs, stub_sends, stub_stats
+from inline import percentiles
+
+
+def max_in_window(times, window=1.0):
+    """بیشترین تعداد ارسال در یک بازه window ثانیه‌ای (sliding)"""
+    best = start = 0
+    for end, t in enumerate(times):
+        while t - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def bucket_overdraft(times, rate, burst):
+    """بیشترین کسری توکن اگه ارسال‌ها از یک token bucket (rate، burst) رد می‌شدن؛ ۰ یعنی مجاز"""
+    tokens, last, worst = burst, times[0], 0.0
+    for t in times:
+        tokens = min(burst, tokens + (t - last) * rate) - 1
+        last = t
+        worst = max(worst, -tokens)
+    return worst
+
+
+async def main_async(args):
+    stubs, stub_url = start_stubs(args.latency)
+    os.environ["TELEGRAM_API_URL"] = f"{stub_url}/bot"
+    try:
+        bot = load_bot()
+        app = bot.application = bot.build_application()
+        await app.initialize()
+        dispatcher = bot.dispatcher = bot.MessageDispatcher()
+        await dispatcher.start(app.bot)
+        stub_stats(stub_url, reset=True)
+
+        chat_ids = [chat for chat in range(1, args.chats + 1) for _ in range(args.per_chat)]
+        chat_ids += range(args.chats + 1, args.chats + 1 + args.singles)
+        wall_started, started = time.time(), time.perf_counter()
+        futures = [await dispatcher.submit(chat_id, f"bench {n}") for n, chat_id in enumerate(chat_ids)]
+        await asyncio.gather(*futures)
+        elapsed = time.perf_counter() - started
+        await dispatcher.stop()
+        await app.shutdown()
+
+        sends = sorted(stub_sends(stub_url))
+        times = [t for t, _ in sends]
+        by_chat = {}
+        for t, chat_id in sends:
+            by_chat.setdefault(chat_id, []).append(t)
+        latency = [t - wall_started for t in times]  # همه با هم submit شدن
+        result = {
+            'messages': len(sends),
+            'seconds': elapsed,
+            'messages_per_s': len(sends) / elapsed,
+            'max_per_second': max_in_window(times),
+            'max_per_chat_second': max(max_in_window(chat) for chat in by_chat.values()),
+            'chat_overdraft': max(bucket_overdraft(chat, args.chat_limit, dispatcher.chat_burst) for chat in by_chat.values()),
+            'failed': dispatcher.stats['failed'],
+        }
+        result.update((f"queue_{key}_s", value) for key, value in percentiles(latency).items())
+        return result
+    finally:
+        stubs.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=200, help="چت‌هایی که هر کدوم --per-chat پیام می‌گیرن")
+    parser.add_argument("--per-chat", type=int, default=3)
+    parser.add_argument("--singles", type=int, default=400, help="چت‌هایی که فقط یک پیام می‌گیرن")
+    parser.add_argument("--latency", type=float, default=0.02, help="تأخیر هر درخواست Bot API (ثانیه)")
+    parser.add_argument("--global-limit", type=int, default=30)
+    parser.add_argument("--chat-limit", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(f"{key:<22}{value:>12,.3f}" if isinstance(value, float) else f"{key:<22}{value:>12,}")
+    assert result['messages'] == args.chats * args.per_chat + args.singles, result['messages']
+    assert result['max_per_second'] <= args.global_limit, f"{result['max_per_second']} پیام در یک ثانیه"
+    # ۵۰ms لرزش شبکه بین dispatcher و stub
+    assert result['chat_overdraft'] <= 0.05 * args.chat_limit, f"کسری توکن چت {result['chat_overdraft']:.2f}"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""بنچمارک /health: تأخیر health check و اثرش روی بقیه درخواست‌های همون event loop
+
+    python bench/health.py                          # Redis با ۵ms تأخیر، ۱۰ ثانیه
+    python bench/health.py --redis-latency 0.02 --json
+
+Redis یک fakeredis روی TCP با تأخیر مصنوعی (bench/redis_server.py) ـه، مثل Upstash که تو همون ماشین
+نیست؛ Bot API و CoinGecko هم bench/stubs.py. وب‌سرور واقعی ربات تو همین پروسه بالا میاد و به مدت
+--seconds همزمان:
+  health   GET /health با نرخ --health-qps (هر بار اتصال تازه، مثل load balancer)
+  webhook  inline query با نرخ --qps روی وب‌هوک (جواب از حافظه، پس هر مکثی مال loop ـه)
+  lag      یک task که هر ۵ms می‌خوابه و دیر بیدار شدنش تأخیر event loop ـه
+گزارش: میانه، p99 و max هر کدوم (ms).
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import load_bot
+from cycle import HERE, start_stubs
+from inline import WebhookClient, inline_update, percentiles
+from startup import free_port
+
+
+def start_redis(latency):
+    cmd = [sys.executable, os.path.join(HERE, "redis_server.py"), f"--latency={latency}"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    return proc, f"redis://127.0.0.1:{int(proc.stdout.readline())}"
+
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+    status = (await reader.readline()).split()[1]
+    await reader.read()
+    writer.close()
+    return int(status)
+
+
+async def main_async(args):
+    redis_proc, redis_url = start_redis(args.redis_latency)
+    stubs, stub_url = start_stubs()
+    os.environ["BENCH_REDIS_URL"] = redis_url
+    os.environ["COINGECKO_API_URL"] = stub_url
+    os.environ["TELEGRAM_API_URL"] = f"{stub_url}/bot"
+    try:
+        bot = load_bot()
+        coins = bot.builtin_coins()[:50]
+        bot.price_feed.publish({cg_id: 1.0 + n for n, (_, cg_id, _) in enumerate(coins)})
+        words = [symbol.lower() for symbol, _, _ in coins]
+        app = bot.application = bot.build_application()
+        await app.initialize()
+        port = free_port()
+        server = bot.make_web_app().listen(port, address="127.0.0.1")
+        client = WebhookClient(port, f"/{bot.TOKEN}")
+        await asyncio.sleep(0.5)  # اولین ping (اتصال Redis) جزو اندازه‌گیری نباشه
+        await get(port, "/health")
+
+        lags, health, webhook, statuses = [], [], [], []
+        stop = time.perf_counter() + args.seconds
+
+        async def probe():
+            while time.perf_counter() < stop:
+                started = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lags.append((time.perf_counter() - started - 0.005) * 1000)
+
+        async def health_check():
+            started = time.perf_counter()
+            statuses.append(await get(port, "/health"))
+            health.append((time.perf_counter() - started) * 1000)
+
+        async def inline(seq):
+            started = time.perf_counter()
+            body = await client.post(json.dumps(inline_update(words[seq % len(words)], seq)).encode())
+            assert json.loads(body)['method'] == 'answerInlineQuery'
+            webhook.append((time.perf_counter() - started) * 1000)
+
+        async def drive(qps, make):
+            tasks = set()
+            seq = 0
+            while time.perf_counter() < stop:
+                task = asyncio.create_task(make(seq))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                seq += 1
+                await asyncio.sleep(1 / qps)
+            await asyncio.gather(*tasks)
+
+        await asyncio.gather(probe(), drive(args.health_qps, lambda seq: health_check()), drive(args.qps, inline))
+        server.stop()
+        client.close()
+        await app.shutdown()
+
+        result = {'redis_latency_ms': args.redis_latency * 1000, 'health_ok': statuses.count(200) / len(statuses)}
+        for name, samples in (('health', health), ('webhook', webhook), ('loop_lag', lags)):
+            result.update((f"{name}_{key}_ms", value) for key, value in percentiles(samples).items())
+        return result
+    finally:
+        stubs.terminate()
+        redis_proc.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis-latency", type=float, default=0.005, help="تأخیر هر دستور Redis (ثانیه)")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--health-qps", type=float, default=20)
+    parser.add_argument("--qps", type=float, default=200, help="inline query های وب‌هوک در ثانیه")
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        print(f"{key:<20}{value:>10,.2f}")
+
+
+if __name__ == "__main__":
+    main()
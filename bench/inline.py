@@ -0,0 +1,216 @@
+"""بنچمارک inline mode: تأخیر جواب inline query زیر ترافیک همزمان
+
+    python bench/inline.py                          # ۲۰k query با نرخ ۳۰۰ در ثانیه
+    python bench/inline.py --qps 500 --json
+
+CoinGecko و Bot API با bench/stubs.py شبیه‌سازی میشن و snapshot قیمت اول با یک fetch_prices پر میشه.
+query ها (۱ تا ۳ نماد، گاهی با واحد پول مثل "btc eth eur") از --distinct متن مختلف با توزیع zipf
+انتخاب میشن؛ کسر --cold از ارزهاییه که قیمتشون تو snapshot نیست، و هر --publish-every query یک
+دسته قیمت تازه منتشر میشه (مثل price feed) که کش جواب‌ها رو باطل می‌کنه.
+سه مرحله، هر کدوم با میانه، p99 و max:
+  build    فقط inline_results (بدون شبکه)
+  webhook  POST آپدیت به وب‌سرور واقعی ربات و جواب answerInlineQuery داخل پاسخ وب‌هوک
+  bot_api  مسیر معمولی: process_update و درخواست جدا answerInlineQuery به stub (--api-queries تا)
+webhook با نرخ ثابت --qps و bot_api با --api-qps اجرا میشن (open loop، سقف --concurrency همزمان) و تأخیر
+هر query از لحظه‌ای که باید فرستاده میشد حساب میشه، پس صف شدن پشت جواب‌های کند هم تو عدد هست.
+ظرفیت مسیر bot_api روی یک vCPU حدود ۱۲۰ تا ۱۳۰ query در ثانیه‌ست؛ --api-qps بالاتر از اون فقط رشد صف رو
+اندازه می‌گیره (تأخیر با طول اجرا زیاد میشه)، نه تأخیر خود مسیر رو.
+به‌علاوه نرخ hit کش جواب‌ها و تعداد درخواست‌های CoinGecko (فقط fetch پس‌زمینه ارزهای سرد).
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import time
+
+from common import load_bot
+from cycle import start_stubs, stub_stats
+from startup import free_port
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50': samples[len(samples) // 2],
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'max': samples[-1],
+    }
+
+
+def make_queries(bot, warm, cold, args, rng):
+    distinct = []
+    for _ in range(args.distinct):
+        pool = cold if rng.random() < args.cold else warm
+        words = [symbol.lower() for symbol in rng.sample(pool, rng.randint(1, 3))]
+        if rng.random() < 0.2:
+            words.append(rng.choice(bot.QUOTE_CURRENCIES[1:]))
+        distinct.append(" ".join(words))
+    weights = [1 / (rank + 1) for rank in range(len(distinct))]
+    return rng.choices(distinct, weights=weights, k=args.queries)
+
+
+def inline_update(text, seq):
+    return {
+        'update_id': seq,
+        'inline_query': {
+            'id': str(seq), 'query': text, 'offset': '',
+            'from': {'id': seq % 50_000 + 1, 'is_bot': False, 'first_name': 'u'},
+        },
+    }
+
+
+class WebhookClient:
+    """مثل خود تلگرام: چند اتصال keep-alive (max_connections پیش‌فرض وب‌هوک ۴۰) و روی هر کدوم یک
+    درخواست در لحظه. HTTP/1.1 حداقلی روی asyncio، تا هزینه کلاینت خود بنچمارک تو عدد نیاد."""
+
+    def __init__(self, port, path, connections=40):
+        self.port, self.path = port, path
+        self.idle = asyncio.Queue()
+        for _ in range(connections):
+            self.idle.put_nowait(None)
+
+    async def post(self, body):
+        conn = await self.idle.get()
+        try:
+            if conn is None:
+                conn = await asyncio.open_connection("127.0.0.1", self.port)
+            reader, writer = conn
+            writer.write(
+                f"POST {self.path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(next(line.split(b":")[1] for line in head.split(b"\r\n") if line.lower().startswith(b"content-length")))
+            return await reader.readexactly(length)
+        except Exception:
+            conn = None
+            raise
+        finally:
+            self.idle.put_nowait(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            if conn := self.idle.get_nowait():
+                conn[1].close()
+
+
+async def run_concurrent(queries, args, maybe_publish, call, qps):
+    """call(seq, text) برای همه query ها با نرخ ثابت qps (open loop) و حداکثر args.concurrency
+    همزمان — (latency های ms از زمان برنامه‌ریزی‌شده هر query، qps واقعی)"""
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(seq, text, scheduled):
+        async with semaphore:
+            await call(seq, text)
+            latencies.append((time.perf_counter() - scheduled) * 1000)
+
+    tasks = set()  # فقط query های در حال اجرا، تا خود بنچمارک heap رو بزرگ نکنه (GC کامل = تأخیر)
+    started = time.perf_counter()
+    for i, text in enumerate(queries):
+        maybe_publish(i)
+        scheduled = started + i / qps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(one(i, text, scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    return latencies, len(queries) / (time.perf_counter() - started)
+
+
+async def main_async(args):
+    stubs, stub_url = start_stubs()
+    os.environ["COINGECKO_API_URL"] = stub_url
+    os.environ["TELEGRAM_API_URL"] = f"{stub_url}/bot"
+    try:
+        bot = load_bot()
+        rng = random.Random(args.seed)
+        for provider in bot.price_source.providers:
+            provider.governor = bot.RateGovernor(1e9, 1e9)
+        coins = bot.builtin_coins()
+        warm_ids = [cg_id for _, cg_id, _ in coins[:args.coins]]
+        bot.price_feed.publish(await bot.fetch_prices(warm_ids))
+        warm = [symbol for symbol, _, _ in coins[:args.coins]]
+        cold = [symbol for symbol, _, _ in coins[args.coins:]] or warm
+        queries = make_queries(bot, warm, cold, args, rng)
+
+        def maybe_publish(i):
+            if args.publish_every and i and i % args.publish_every == 0:
+                bot.price_feed.publish({cg_id: 1.0 + rng.random() for cg_id in rng.sample(warm_ids, 10)})
+
+        app = bot.application = bot.build_application()
+        await app.initialize()
+        gc.freeze()  # مثل main بعد از بالا اومدن
+        stub_stats(stub_url, reset=True)
+        result = {'queries': args.queries, 'qps': args.qps, 'api_qps': args.api_qps}
+
+        build = []
+        for i, text in enumerate(queries):
+            maybe_publish(i)
+            started = time.perf_counter()
+            bot.inline_results(text)
+            build.append((time.perf_counter() - started) * 1e6)
+        result.update((f"build_{key}_us", value) for key, value in percentiles(build).items())
+
+        port = free_port()
+        server = bot.make_web_app().listen(port, address="127.0.0.1")
+        client = WebhookClient(port, f"/{bot.TOKEN}")
+
+        async def webhook(seq, text):
+            body = await client.post(json.dumps(inline_update(text, seq)).encode())
+            assert json.loads(body)['method'] == 'answerInlineQuery'
+
+        latencies, result['webhook_qps'] = await run_concurrent(queries, args, maybe_publish, webhook, args.qps)
+        result.update((f"webhook_{key}_ms", value) for key, value in percentiles(latencies).items())
+        server.stop()
+        client.close()
+
+        async def bot_api(seq, text):
+            await app.process_update(bot.Update.de_json(inline_update(text, seq), app.bot))
+
+        api_queries = queries[:args.api_queries]
+        latencies, result['bot_api_qps'] = await run_concurrent(api_queries, args, maybe_publish, bot_api, args.api_qps)
+        result.update((f"bot_api_{key}_ms", value) for key, value in percentiles(latencies).items())
+
+        stats = stub_stats(stub_url)
+        answers = bot.inline_answers.stats
+        result['cache_hit_rate'] = answers['hits'] / max(1, answers['hits'] + answers['misses'])
+        result['warmups'] = answers['warmups']
+        result['answer_calls'] = stats.get('telegram_answerInlineQuery', 0)
+        result['coingecko_calls'] = stats.get('coingecko_calls', 0)
+        await bot.price_source.aclose()
+        await app.shutdown()
+        return result
+    finally:
+        stubs.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=20_000)
+    parser.add_argument("--qps", type=float, default=300, help="نرخ ارسال query ها در مرحله webhook")
+    parser.add_argument("--api-qps", type=float, default=100, help="نرخ مرحله bot_api (بالای ظرفیتش صف بی‌انتها میشه)")
+    parser.add_argument("--concurrency", type=int, default=1000, help="سقف query های در حال اجرا")
+    parser.add_argument("--api-queries", type=int, default=2000, help="تعداد query برای مسیر bot_api (کنده)")
+    parser.add_argument("--distinct", type=int, default=2000, help="تعداد متن‌های مختلف query")
+    parser.add_argument("--coins", type=int, default=100, help="ارزهایی که قیمتشون تو snapshot هست")
+    parser.add_argument("--cold", type=float, default=0.02, help="کسر query هایی که ارزشون قیمت نداره")
+    parser.add_argument("--publish-every", type=int, default=2000, help="هر چند query یک دسته قیمت تازه")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        print(f"{key:<20}{value:>12,.3f}" if isinstance(value, float) else f"{key:<20}{value:>12,}")
+
+
+if __name__ == "__main__":
+    main()
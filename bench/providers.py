@@ -0,0 +1,125 @@
+"""بنچمارک لایه منابع قیمت: RateGovernor، circuit breaker و hedge زیر خطاهای ساختگی
+
+    python bench/providers.py                       # همه سناریوها، با CoinCap به عنوان fallback
+    python bench/providers.py --fallback none       # همون سناریوها فقط با CoinGecko
+    python bench/providers.py --scenario slow --json
+
+CoinGecko و CoinCap با bench/stubs.py شبیه‌سازی میشن و هر سناریو با POST /_faults تأخیر یا 429/500
+تزریق می‌کنه. تو هر سناریو --requests بار fetch_prices (هر بار --ids ارز تصادفی) با نرخ --qps صدا
+زده میشه، مثل get_price (max_wait=1). گزارش: کسر درخواست‌هایی که قیمت گرفتن، پوشش ارزها، میانه و
+p95 تأخیر، درخواست‌ها و خطاهای هر provider، hedge ها، باز شدن circuit و نرخ نهایی RateGovernor.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+import urllib.request
+
+from common import load_bot
+from cycle import start_stubs, stub_stats
+
+SCENARIOS = {
+    'healthy': {},
+    'slow': {'coingecko': {'latency': 2.0}},
+    'throttled': {'coingecko': {'status': 429, 'retry_after': 2}},
+    'flaky_429': {'coingecko': {'status': 429, 'rate': 0.3}},
+    'down': {'coingecko': {'status': 500}},
+    'both_throttled': {'coingecko': {'status': 429, 'retry_after': 2}, 'coincap': {'status': 429, 'retry_after': 2}},
+}
+
+
+def set_faults(url, faults):
+    request = urllib.request.Request(f"{url}/_faults", data=json.dumps(faults).encode(), method="POST")
+    with urllib.request.urlopen(request) as resp:
+        resp.read()
+
+
+async def run_scenario(bot, args, stub_url, faults, coins, rng):
+    set_faults(stub_url, faults)
+    stub_stats(stub_url, reset=True)
+    bot.price_source = source = bot.make_price_source()
+    latencies, covered, answered = [], 0, 0
+
+    async def one():
+        nonlocal covered, answered
+        ids = rng.sample(coins, args.ids)
+        started = time.perf_counter()
+        prices = await bot.fetch_prices(ids, deadline=8, max_wait=1)
+        latencies.append(time.perf_counter() - started)
+        covered += len(bot.base_prices(prices))
+        answered += bool(prices)
+
+    tasks = []
+    for _ in range(args.requests):
+        tasks.append(asyncio.create_task(one()))
+        await asyncio.sleep(1 / args.qps)
+    await asyncio.gather(*tasks)
+    await source.aclose()
+
+    stats = stub_stats(stub_url)
+    latencies.sort()
+    result = {
+        'answered': answered / args.requests,
+        'coverage': covered / (args.requests * args.ids),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'hedged': source.stats['hedged'],
+        'fallback': source.stats['fallback'],
+    }
+    for provider in ('coingecko', 'coincap'):
+        result[f'{provider}_calls'] = stats.get(f'{provider}_calls', 0)
+        result[f'{provider}_errors'] = sum(v for k, v in stats.items() if k.startswith(f'{provider}_') and k[-3:].isdigit())
+    result['circuit_opens'] = sum(provider.breaker.opens for provider in source.providers)
+    result['coingecko_rate'] = source.primary.governor.rate
+    return result
+
+
+async def main_async(args):
+    stubs, stub_url = start_stubs()
+    os.environ["COINGECKO_API_URL"] = stub_url
+    os.environ["COINGECKO_RATE"] = str(args.rate)
+    if args.fallback != "none":
+        os.environ.update(PRICE_FALLBACK=args.fallback, PRICE_FALLBACK_RATE=str(args.rate),
+                          PRICE_FALLBACK_URL=f"{stub_url}/coincap" if args.fallback == "coincap" else stub_url)
+    try:
+        bot = load_bot()
+        rng = random.Random(args.seed)
+        coins = [cg_id for _, cg_id, _ in bot.builtin_coins()]
+        coins += [f"bench-coin-{i}" for i in range(max(0, 200 - len(coins)))]
+        names = [args.scenario] if args.scenario else list(SCENARIOS)
+        return {name: await run_scenario(bot, args, stub_url, SCENARIOS[name], coins, rng) for name in names}
+    finally:
+        stubs.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--fallback", default="coincap", choices=("coincap", "coingecko", "none"))
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--qps", type=float, default=5)
+    parser.add_argument("--ids", type=int, default=1, help="تعداد ارز در هر درخواست (۱ مثل get_price، بیشتر مثل price feed)")
+    parser.add_argument("--rate", type=float, default=5, help="سقف RateGovernor هر provider (درخواست در ثانیه)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(results))
+        return
+    rows = (
+        ('answered', '{:.0%}'), ('coverage', '{:.0%}'), ('p50_ms', '{:.0f}'), ('p95_ms', '{:.0f}'),
+        ('coingecko_calls', '{}'), ('coingecko_errors', '{}'), ('coincap_calls', '{}'), ('coincap_errors', '{}'),
+        ('hedged', '{}'), ('fallback', '{}'), ('circuit_opens', '{}'), ('coingecko_rate', '{:.2f}'),
+    )
+    print(f"{'':<18}" + "".join(f"{name:>16}" for name in results))
+    for key, fmt in rows:
+        print(f"{key:<18}" + "".join(f"{fmt.format(result[key]):>16}" for result in results.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""fakeredis روی TCP برای بنچمارک‌هایی که چند پروسه یا کلاینت واقعی Redis لازم دارن
+
+    python bench/redis_server.py [--port 0] [--latency 0.002]
+
+پورت روی اولین خط stdout چاپ میشه؛ با BENCH_REDIS_URL=redis://127.0.0.1:{port} به load_bot داده میشه.
+--latency تأخیر هر دستور (ثانیه، فقط مسیر رفت) برای شبیه‌سازی Redis مدیریت‌شده‌ای مثل Upstash که
+تو همون ماشین نیست؛ با تأخیر، یک proxy جلوی سرور قرار می‌گیره و ترتیب دستورهای هر اتصال حفظ میشه.
+Lua و pub/sub پشتیبانی میشن؛ CLIENT TRACKING نه (کش تنظیمات کاربران خودش غیرفعال میشه).
+"""
+import argparse
+import asyncio
+import sys
+import threading
+
+import fakeredis
+import redis
+from fakeredis._clients._tcp_server import TCPFakeRequestHandler
+
+
+class RequestHandler(TCPFakeRequestHandler):
+    """جواب خطا (WRONGTYPE، NOSCRIPT ـه اولین EVALSHA) مثل Redis واقعی فقط جوابه
+
+    handler خود fakeredis بعد از هر جواب خطا اتصال رو می‌بنده؛ اون‌وقت SCRIPT LOAD بعد از NOSCRIPT روی
+    اتصال بسته‌شده می‌افته و هیچ اسکریپت Lua (مثل تمدید lease ها) هیچ‌وقت اجرا نمیشه.
+    """
+
+    def setup(self):
+        super().setup()
+        read_response = self.current_client.read_response
+
+        def read_error_as_reply(*args, **kwargs):
+            try:
+                return read_response(*args, **kwargs)
+            except redis.ResponseError as e:
+                return e
+
+        self.current_client.read_response = read_error_as_reply
+
+
+async def pipe(reader, writer, latency):
+    try:
+        while data := await reader.read(65536):
+            if latency:
+                await asyncio.sleep(latency)
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0 if args.latency else args.port), server_type="redis")
+    server.RequestHandlerClass = RequestHandler
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = upstream = server.server_address[1]
+
+    if args.latency:
+        async def connect(client_reader, client_writer):
+            upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", upstream)
+            await asyncio.gather(
+                pipe(client_reader, upstream_writer, args.latency),
+                pipe(upstream_reader, client_writer, 0),
+            )
+
+        proxy = await asyncio.start_server(connect, "127.0.0.1", args.port)
+        port = proxy.sockets[0].getsockname()[1]
+
+    print(port, flush=True)
+    sys.stdout.close()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
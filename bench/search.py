@@ -0,0 +1,133 @@
+"""بنچمارک جستجوی ارز (CoinIndex) روی کاتالوگ مصنوعی
+
+    python bench/search.py                          # ۳۰k ارز، ۲۰۰ کوئری از هر نوع
+    python bench/search.py --coins 100000 --json
+
+کاتالوگ مثل خروجی /coins/list کوین‌گکو ساخته میشه (ارزهای داخلی اول، بعد ارزهای مصنوعی با نماد ۳ تا ۵
+حرفی و اسم یک تا سه کلمه‌ای از هجاهای تصادفی و کلمه‌های رایجی مثل token و inu) و ایندکس با
+CoinIndex.from_coins ساخته میشه. نوع کوئری‌ها:
+  symbol   نماد دقیق
+  name     اسم کامل یا cg_id
+  prefix1  پیشوند یک حرفی (اولین اجرای هر پیشوند کوتاه، جدا به اسم _cold گزارش میشه)
+  prefix2  پیشوند دو حرفی
+  prefix   پیشوند ۳ تا ۵ حرفی از اسم
+  word     کلمه دوم اسم (مثلاً "inu" برای "shiba-inu")
+  fuzzy    اسم با یک حرف جابجا/غلط (فقط سه‌حرفی‌ها پیداش می‌کنن)
+  miss     رشته‌ای که تو کاتالوگ نیست
+هر کوئری --repeat بار اجرا میشه (_cold: فقط اولین اجرای هر پیشوند کوتاه) و همه نمونه‌ها، نه فقط بهترینشون،
+حساب میشن. گزارش: میانه، p99 و max برای هر نوع (µs)؛ p99 هر نوع باید زیر --max-ms باشه.
+"""
+import argparse
+import gc
+import json
+import random
+import string
+import time
+
+from common import Timer, load_bot
+from inline import percentiles
+
+SYLLABLES = [c + v for c in "bcdfghklmnprstvwxz" for v in "aeiou"]
+# کلمه‌هایی که تو اسم ارزهای واقعی زیاد تکرار میشن
+COMMON_WORDS = ["token", "coin", "finance", "protocol", "network", "swap", "dao", "inu", "ai", "chain",
+                "cash", "gold", "wrapped", "bridged", "staked", "usd", "pepe", "doge", "cat", "meta"]
+
+
+def synthetic_word(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))) + rng.choice(["", "", "x", "n", "r"])
+
+
+def synthetic_catalog(bot, count, rng):
+    """[(symbol, cg_id, name), ...]: ارزهای داخلی، بعد اسم‌های یک تا سه کلمه‌ای (حدود یک سوم با کلمه رایج)"""
+    coins = bot.builtin_coins()
+    seen = {cg_id for _, cg_id, _ in coins}
+    while len(coins) < count:
+        words = [synthetic_word(rng)]
+        if rng.random() < 0.35:
+            words.append(rng.choice(COMMON_WORDS))
+        elif rng.random() < 0.3:
+            words.append(synthetic_word(rng))
+        if rng.random() < 0.1:
+            words.insert(0, rng.choice(COMMON_WORDS[10:]))
+        cg_id = "-".join(words)
+        if cg_id in seen:
+            continue
+        seen.add(cg_id)
+        symbol = "".join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(3, 5)))
+        coins.append((symbol, cg_id, " ".join(word.capitalize() for word in words)))
+    return coins
+
+
+def typo(word, rng):
+    i = rng.randrange(1, len(word) - 1)
+    if rng.random() < 0.5:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i + 1:]
+
+
+def make_queries(coins, per_type, rng):
+    sample = rng.sample(coins, per_type)
+    multi = [coin for coin in coins if " " in coin[2]]
+    return {
+        'symbol': [symbol for symbol, _, _ in sample],
+        'name': [name or cg_id for _, cg_id, name in sample],
+        'prefix1': list(string.ascii_lowercase),
+        'prefix2': [a + b for a, b in (rng.sample(string.ascii_lowercase, 2) for _ in range(per_type))],
+        'prefix': [cg_id[:rng.randint(3, 5)] for _, cg_id, _ in sample],
+        'word': [name.split()[1].lower() for _, _, name in rng.sample(multi, per_type)],
+        'fuzzy': [typo(cg_id.replace("-", ""), rng) for _, cg_id, _ in sample if len(cg_id) >= 5],
+        'miss': ["".join(rng.choice("jqxz") for _ in range(6)) for _ in range(per_type)],
+    }
+
+
+def run(index, queries, repeat):
+    """زمان همه اجراهای search(query, 10)، repeat بار برای هر کوئری (µs)"""
+    samples = []
+    for query in queries:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            index.search(query, 10)
+            samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--coins", type=int, default=30_000)
+    parser.add_argument("--queries", type=int, default=200, help="کوئری از هر نوع")
+    parser.add_argument("--repeat", type=int, default=5, help="اجرای هر کوئری")
+    parser.add_argument("--max-ms", type=float, default=1.0, help="سقف p99 هر نوع کوئری")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    coins = synthetic_catalog(bot, args.coins, rng)
+    with Timer() as build:
+        index = bot.CoinIndex.from_coins(coins)
+    queries = make_queries(coins, args.queries, rng)
+    gc.freeze()  # مثل main() خود ربات: کاتالوگ و بقیه اشیای بلندمدت از GC بیرون میرن
+
+    results = {}
+    for kind, batch in queries.items():
+        if kind in ('prefix1', 'prefix2'):
+            # اولین اجرای هر پیشوند کوتاه (cold) جدا: خونه‌ها و رتبه‌های از پیش حساب‌شده‌اش هنوز لمس نشدن
+            results[f"{kind}_cold"] = percentiles(run(index, batch, 1))
+            results[kind] = percentiles(run(index, batch, args.repeat))
+        else:
+            results[kind] = percentiles(run(index, batch, args.repeat))
+
+    if args.json:
+        print(json.dumps({'coins': len(index), 'build_s': build.elapsed, 'queries_us': results}))
+    else:
+        print(f"{len(index):,} ارز، ساخت ایندکس {build.elapsed:.2f}s — زمان هر search (µs)")
+        print(f"{'':<16}{'p50':>10}{'p99':>10}{'max':>10}")
+        for kind, result in results.items():
+            print(f"{kind:<16}{result['p50']:>10.1f}{result['p99']:>10.1f}{result['max']:>10.1f}")
+    for kind, result in results.items():
+        assert result['p99'] < args.max_ms * 1000, f"{kind}: p99 {result['p99']:.0f}µs"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""بنچمارک فرمت ذخیره تنظیمات کاربر: حجم، پهنای باند Redis و CPU کدگذاری/خوندن
+
+    python bench/settings.py                    # ۱۰k کاربر مصنوعی
+    python bench/settings.py --users 100000 --json
+
+سه فرمت روی همون کاربرها مقایسه میشن:
+  blob     کل تنظیمات یک رشته JSON تو user:{id} (last_sent داخل هر ارز) — فرمت اولیه
+  json     هش user:{id} با مقدار JSON برای هر ارز + هش sent:{id} — نسخه ۱
+  compact  هش user:{id} با رکورد encode_item برای هر ارز + هش sent:{id} — فرمت فعلی (v3)
+گزارش برای هر کاربر: بایت‌های ذخیره‌شده (اسم فیلدها + مقدارها)، بایت‌های پاسخ RESP برای خوندن کامل
+کاربر (GET یا دو HGETALL؛ همون چیزی که load_users و هندلرها می‌خونن) و میکروثانیه CPU برای
+ساختن مقدارها و parse کردنشون به لیست تنظیمات: decode_us با کش _decode_record خالی و decode_warm_us دور
+دوم روی همون رکوردها (کش پر، DECODE_CACHE_SIZE)؛ کمترین زمان از --repeat دور. با BENCH_REDIS_URL، MEMORY
+USAGE واقعی هم گزارش میشه.
+"""
+import argparse
+import json
+import random
+
+from common import Timer, load_bot
+from cycle import random_settings
+
+
+def bulk_size(value):
+    data = value.encode()
+    return len(f"${len(data)}\r\n") + len(data) + 2
+
+
+def hash_reply_size(mapping):
+    return len(f"*{len(mapping) * 2}\r\n") + sum(bulk_size(k) + bulk_size(v) for k, v in mapping.items())
+
+
+def json_item(item, seq):
+    value = {'symbol': item['symbol'], 'period': item.get('period', 15), 'seq': seq}
+    if 'alert' in item:
+        value['alert'] = item['alert']
+    return json.dumps(value, ensure_ascii=False)
+
+
+def hash_rows(settings, encode):
+    fields = {'#': str(len(settings))}
+    fields.update((item['cg_id'], encode(item, seq)) for seq, item in enumerate(settings, 1))
+    return fields, {item['cg_id']: str(int(item['last_sent'])) for item in settings}
+
+
+def measure(name, bot, users, args):
+    result = {}
+    if name == 'blob':
+        with Timer() as t:
+            stored = [json.dumps(settings, ensure_ascii=False) for settings in users]
+        result['encode_us'] = t.elapsed
+        decode = float("inf")
+        for _ in range(args.repeat):
+            with Timer() as t:
+                for value in stored:
+                    json.loads(value)
+            decode = min(decode, t.elapsed)
+        result['decode_us'] = decode
+        result['bytes'] = sum(len(value.encode()) for value in stored)
+        result['reply_bytes'] = sum(bulk_size(value) for value in stored)
+    else:
+        encode = json_item if name == 'json' else bot.encode_item
+        with Timer() as t:
+            stored = [hash_rows(settings, encode) for settings in users]
+        result['encode_us'] = t.elapsed
+        cold = warm = float("inf")
+        for _ in range(args.repeat):
+            bot._decode_record.cache_clear()
+            with Timer() as t:
+                for fields, sent in stored:
+                    bot.parse_settings(fields, sent)
+            cold = min(cold, t.elapsed)
+            # دور دوم با کش _decode_record پر؛ رشته‌های تازه مثل جواب دوباره Redis (hash کش‌نشده)
+            again = [({k: "".join(v) for k, v in fields.items()}, sent) for fields, sent in stored]
+            with Timer() as t:
+                for fields, sent in again:
+                    bot.parse_settings(fields, sent)
+            warm = min(warm, t.elapsed)
+        result['decode_us'] = cold
+        result['decode_warm_us'] = warm
+        result['bytes'] = sum(len(k.encode()) + len(v.encode()) for row in stored for part in row for k, v in part.items())
+        result['reply_bytes'] = sum(hash_reply_size(fields) + hash_reply_size(sent) for fields, sent in stored)
+
+    if args.redis:
+        pipe = bot.r.pipeline(transaction=False)
+        for user_id, row in enumerate(stored, 1):
+            if name == 'blob':
+                pipe.set(bot.user_key(user_id), row)
+            else:
+                pipe.hset(bot.user_key(user_id), mapping=row[0])
+                pipe.hset(bot.sent_key(user_id), mapping=row[1])
+        pipe.execute()
+        for user_id in range(1, len(stored) + 1):
+            pipe.memory_usage(bot.user_key(user_id))
+            pipe.memory_usage(bot.sent_key(user_id))
+        result['redis_memory'] = sum(n or 0 for n in pipe.execute())
+        bot.r.flushdb()
+
+    for key in list(result):
+        result[key] = result[key] * (1e6 if key.endswith('_us') else 1) / len(users)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--coins", type=int, default=1000)
+    parser.add_argument("--alert-ratio", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=5, help="دورهای decode؛ کمترین زمان گزارش میشه")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    args.redis = bool(bot.os.environ.get("BENCH_REDIS_URL"))
+    if args.redis:
+        bot.r.flushdb()
+    rng = random.Random(args.seed)
+    coins = [cg_id for _, cg_id, _ in bot.builtin_coins()]
+    coins += [f"bench-coin-{i}" for i in range(max(0, args.coins - len(coins)))]
+    users = [random_settings(bot, coins, args.alert_ratio, rng) for _ in range(args.users)]
+    for settings in users:
+        for item in settings:
+            item['last_sent'] = 1_760_000_000 + rng.randrange(86400)
+
+    results = {name: measure(name, bot, users, args) for name in ('blob', 'json', 'compact')}
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"{args.users:,} کاربر، {sum(map(len, users)):,} ارز — مقدارها برای هر کاربر")
+    print(f"{'':<16}" + "".join(f"{name:>12}" for name in results))
+    for key, fmt in (('bytes', '{:.0f}'), ('reply_bytes', '{:.0f}'), ('redis_memory', '{:.0f}'),
+                     ('encode_us', '{:.2f}'), ('decode_us', '{:.2f}'), ('decode_warm_us', '{:.2f}')):
+        if key in results['compact']:
+            print(f"{key:<16}" + "".join(f"{fmt.format(result[key]) if key in result else '-':>12}" for result in results.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""بنچمارک چند پروسه‌ای شاردها: مقیاس‌پذیری چک قیمت و گرفتن شاردهای worker مرده
+
+    python bench/shards.py                          # ۱، ۲ و ۴ worker، ۱۶ شارد، ۲۰۰۰ کاربر
+    python bench/shards.py --workers 1 4 --json
+
+همه worker ها پروسه جدا با main() خود ربات (BOT_MODE=worker) روی یک Redis مشترکن: bench/redis_server.py
+با --redis-latency تأخیر (مثل Upstash)، یا BENCH_REDIS_URL. CoinGecko و Bot API هم bench/stubs.py.
+برای هر تعداد worker:
+  کاربرها seed میشن و همه‌شون یک زمان (--settle ثانیه بعد از بالا اومدن worker ها) due میشن، تا
+  lease ها قبلش بین worker ها پخش شده باشن؛ بعد زمان اولین تا آخرین digest از لاگ /_sends ـه stub.
+  هر کاربر باید دقیقاً یک digest بگیره (هیچ شاردی دست دو worker نیست).
+با بیشترین تعداد worker یکی با SIGKILL کشته میشه (lease ها آزاد نمیشن) و زمان تا وقتی که هر شارد دقیقاً
+یک صاحب زنده داره اندازه گرفته میشه. محدودیت نرخ ارسال worker ها خاموشه (مثل bench/cycle.py): خود
+کد اندازه گرفته میشه نه سقف تلگرام؛ با --real-limits محدودیت‌های پیش‌فرض روشنن و جمع ارسال همه worker ها
+تو هیچ ثانیه‌ای (با ۵۰ms لرزش) نباید از ۳۰ بیشتر بشه. بدون --real-limits، speedup (msg/s نسبت به اولین
+تعداد worker) باید حداقل --min-efficiency برابر تعداد worker ها باشه، ولی نه بیشتر از تعداد هسته‌ها: روی
+ماشین یک هسته‌ای worker ها (و Redis و stub) سر یک CPU رقابت می‌کنن و فقط نباید کندتر بشن.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from common import load_bot
+from cycle import seed_users, start_stubs, stub_sends, stub_stats
+from dispatcher import max_in_window
+from health import start_redis
+
+
+def run_worker(real_limits):
+    """یک worker: main() خود ربات، با dispatcher بدون محدودیت نرخ مگه real_limits"""
+    bot = load_bot()
+    if not real_limits:
+        bot.dispatcher = bot.MessageDispatcher(workers=32, global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+    asyncio.run(bot.main())
+
+
+def start_workers(count, env, real_limits):
+    workers = []
+    cmd = [sys.executable, __file__, "--worker"] + (["--real-limits"] if real_limits else [])
+    for n in range(count):
+        worker_env = dict(env, SNAPSHOT_PATH=os.path.join(env['BENCH_DATA_DIR'], f"snapshot-{n}.json"))
+        workers.append(subprocess.Popen(cmd, env=worker_env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return workers
+
+
+def owners(bot, shards):
+    """صاحب lease هر شارد (None یعنی بی‌صاحب)"""
+    return bot.r.mget([f"lease:shard:{shard}" for shard in range(shards)])
+
+
+def worker_ids(workers):
+    return {f"{socket.gethostname()}:{worker.pid}" for worker in workers if worker.poll() is None}
+
+
+def stop_workers(workers):
+    for worker in workers:
+        if worker.poll() is None:
+            worker.terminate()
+    for worker in workers:
+        worker.wait()
+
+
+def run_scaling(bot, args, env, stub_url, count, rng, workers):
+    """پروسه‌های worker به workers اضافه میشن (زنده می‌مونن) تا اگه وسط کار خطا شد هم بسته بشن"""
+    bot.r.flushdb()
+    coins = [cg_id for _, cg_id, _ in bot.builtin_coins()]
+    seed_users(bot, args.users, coins, 0, rng)
+    bot.rebuild_indexes()
+    due_at = time.time() + args.settle
+    pipe = bot.r.pipeline(transaction=False)
+    for shard in range(args.shards):
+        members = bot.r.zrange(bot.due_key(shard), 0, -1)
+        if members:
+            pipe.zadd(bot.due_key(shard), dict.fromkeys(members, due_at))
+    pipe.execute()
+    stub_stats(stub_url, reset=True)
+
+    workers.extend(start_workers(count, env, args.real_limits))
+    deadline = due_at + args.timeout
+    sends = []
+    while time.time() < deadline:
+        time.sleep(1)
+        sends = stub_sends(stub_url)
+        if len(sends) >= args.users:
+            break
+    times = sorted(t for t, _ in sends)
+    per_chat = Counter(chat_id for _, chat_id in sends)
+    assert len(per_chat) == args.users, f"{len(per_chat)} از {args.users} کاربر digest گرفتن"
+    assert max(per_chat.values()) == 1, per_chat.most_common(3)
+    span = times[-1] - times[0]
+    current = owners(bot, args.shards)
+    by_worker = {}
+    for t, chat_id in sorted(sends):
+        by_worker.setdefault(current[bot.shard_of(chat_id)], []).append(t)
+    result = {
+        'workers': count,
+        'messages': len(sends),
+        'drain_s': span,
+        'messages_per_s': len(sends) / span if span else 0,
+        'max_per_second': max_in_window(times),
+        # ۵۰ms لرزش بین worker ها و stub (مثل bench/dispatcher.py)
+        'max_per_950ms': max_in_window(times, 0.95),
+        'max_per_worker_second': max(max_in_window(worker_times) for worker_times in by_worker.values()),
+        'shards_per_worker': sorted(Counter(current).values()),
+    }
+    return result
+
+
+def run_failover(bot, args, workers):
+    victim = workers[0]
+    victim_id = f"{socket.gethostname()}:{victim.pid}"
+    victim_shards = owners(bot, args.shards).count(victim_id)
+    assert victim_shards, "worker قربانی شاردی نداره"
+    victim.send_signal(signal.SIGKILL)
+    victim.wait()
+    killed_at = time.time()
+    alive = worker_ids(workers)
+    while time.time() - killed_at < args.lease_ttl * 3:
+        current = owners(bot, args.shards)
+        if all(owner in alive for owner in current):
+            break
+        time.sleep(0.25)
+    current = owners(bot, args.shards)
+    assert all(owner in alive for owner in current), Counter(current)
+    # lease با SET NX حداکثر یک صاحب داره؛ اینجا هر شارد دقیقاً یکی، و زنده
+    return {
+        'victim_shards': victim_shards,
+        'recovery_s': time.time() - killed_at,
+        'lease_ttl_s': args.lease_ttl,
+        'owners_after': sorted(Counter(current).values()),
+    }
+
+
+def main_bench(args):
+    redis_proc = None
+    redis_url = os.environ.get("BENCH_REDIS_URL")
+    if not redis_url:
+        redis_proc, redis_url = start_redis(args.redis_latency)
+    stubs, stub_url = start_stubs()
+    env = dict(os.environ, BENCH_REDIS_URL=redis_url, COINGECKO_API_URL=stub_url, TELEGRAM_API_URL=f"{stub_url}/bot",
+               CHECKER_SHARDS=str(args.shards), LEASE_TTL=str(args.lease_ttl), BOT_MODE="worker")
+    os.environ.update(env)
+    workers = []
+    data_dir = tempfile.TemporaryDirectory()
+    env['BENCH_DATA_DIR'] = data_dir.name
+    try:
+        bot = load_bot()
+        rng = random.Random(args.seed)
+        results = []
+        for count in args.workers:
+            results.append(run_scaling(bot, args, env, stub_url, count, rng, workers))
+            if count != max(args.workers):
+                stop_workers(workers)
+                workers.clear()
+                time.sleep(args.lease_ttl)  # lease های worker های قبلی منقضی بشن
+        failover = run_failover(bot, args, workers) if len(workers) > 1 else None
+        return results, failover
+    finally:
+        stop_workers(workers)
+        data_dir.cleanup()
+        stubs.terminate()
+        if redis_proc:
+            redis_proc.terminate()
+
+
+def print_results(results, failover):
+    print(f"{'workers':>8}{'drain_s':>10}{'msg/s':>10}{'speedup':>10}{'max/1s':>8}{'worker':>8}  shards per worker")
+    for result in results:
+        print(f"{result['workers']:>8}{result['drain_s']:>10.2f}{result['messages_per_s']:>10.0f}"
+              f"{result['speedup']:>10.2f}{result['max_per_second']:>8}{result['max_per_worker_second']:>8}  {result['shards_per_worker']}")
+    if failover:
+        print(f"failover: {failover['victim_shards']} شارد worker کشته‌شده، {failover['recovery_s']:.1f}s بعد هر شارد یک صاحب زنده داشت "
+              f"(LEASE_TTL {failover['lease_ttl_s']:g}s)، شارد هر worker: {failover['owners_after']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--real-limits", action="store_true", help="محدودیت نرخ پیش‌فرض dispatcher؛ جمع ارسال‌ها ≤ ۳۰ در ثانیه")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--shards", type=int, default=16)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--lease-ttl", type=float, default=6, help="LEASE_TTL worker ها (ثانیه)")
+    parser.add_argument("--settle", type=float, default=20, help="ثانیه بین بالا اومدن worker ها و due شدن کاربرها")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--redis-latency", type=float, default=0.002, help="تأخیر هر دستور Redis (ثانیه)")
+    parser.add_argument("--min-efficiency", type=float, default=0.7, help="حداقل speedup / تعداد worker (تا سقف هسته‌ها)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.real_limits)
+        return
+
+    results, failover = main_bench(args)
+    base = results[0]
+    for result in results:
+        result['speedup'] = result['messages_per_s'] / base['messages_per_s']
+    if args.json:
+        print(json.dumps({'scaling': results, 'failover': failover}))
+    else:
+        print_results(results, failover)
+    if args.real_limits:
+        # سقف تلگرام برای کل ربات‌ه، نه هر worker
+        for result in results:
+            assert result['max_per_950ms'] <= 30, f"{result['workers']} worker: {result['max_per_950ms']} پیام در ۰.۹۵ ثانیه"
+    else:
+        cpus = os.cpu_count() or 1
+        for result in results[1:]:
+            expected = args.min_efficiency * min(result['workers'], cpus) / min(base['workers'], cpus)
+            assert result['speedup'] >= expected, f"{result['workers']} worker: speedup {result['speedup']:.2f} < {expected:.2f}"
+
+
+if __name__ == "__main__":
+    main()
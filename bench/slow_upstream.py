@@ -0,0 +1,130 @@
+"""بنچمارک event loop وقتی CoinGecko کنده: درخواست‌های قیمت نباید هندلرهای دیگه رو معطل کنن
+
+    python bench/slow_upstream.py                   # upstream سالم و با تأخیر ۳ ثانیه
+    python bench/slow_upstream.py --delay 10 --json
+
+CoinGecko و Bot API با bench/stubs.py شبیه‌سازی میشن و تأخیر با POST /_faults تزریق میشه (بدون fallback).
+تو هر سناریو به مدت --seconds همزمان:
+  get_price   با نرخ --price-qps برای ارزهایی که تو هیچ کشی نیستن، پس هر کدوم تا upstream میره
+  list_coins  با نرخ --handler-qps با Update واقعی (Redis + editMessageText به stub، بدون قیمت)
+  lag         یک task که هر ۵ms می‌خوابه و دیر بیدار شدنش تأخیر event loop ـه
+گزارش: میانه، p99 و max هر کدوم (ms) و تعداد درخواست‌های CoinGecko. اگه p99 تأخیر loop یا
+list_coins زیر upstream کند از --max-lag-ms بیشتر بشه، بنچمارک خطا میده.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+from common import load_bot
+from cycle import callback_update, start_stubs, stub_stats
+from inline import percentiles
+from providers import set_faults
+
+
+async def run_scenario(bot, app, args, stub_url, delay, tag):
+    set_faults(stub_url, {'coingecko': {'latency': delay}} if delay else {})
+    stub_stats(stub_url, reset=True)
+    rng = random.Random(args.seed)
+    context = SimpleNamespace(user_data={}, bot=app.bot)
+    lags, prices, handlers = [], [], []
+    stop = time.perf_counter() + args.seconds
+
+    async def probe():
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append((time.perf_counter() - started - 0.005) * 1000)
+
+    async def timed(samples, coro):
+        started = time.perf_counter()
+        await coro
+        samples.append((time.perf_counter() - started) * 1000)
+
+    async def drive(qps, samples, make):
+        tasks = set()
+        seq = 0
+        while time.perf_counter() < stop:
+            task = asyncio.create_task(timed(samples, make(seq)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            seq += 1
+            await asyncio.sleep(1 / qps)
+        await asyncio.gather(*tasks)
+
+    def price(seq):
+        return bot.get_price(f"slow-{tag}-{seq}")
+
+    def handler(seq):
+        user_id = rng.randint(1, args.users)
+        return bot.list_coins(callback_update(bot, app, user_id, 'list_coins', seq), context)
+
+    await asyncio.gather(
+        probe(),
+        drive(args.price_qps, prices, price),
+        drive(args.handler_qps, handlers, handler),
+    )
+    result = {'upstream_delay_s': delay, 'coingecko_calls': stub_stats(stub_url).get('coingecko_calls', 0)}
+    for name, samples in (('loop_lag', lags), ('list_coins', handlers), ('get_price', prices)):
+        result.update((f"{name}_{key}_ms", value) for key, value in percentiles(samples).items())
+    return result
+
+
+async def main_async(args):
+    stubs, stub_url = start_stubs()
+    os.environ["COINGECKO_API_URL"] = stub_url
+    os.environ["TELEGRAM_API_URL"] = f"{stub_url}/bot"
+    os.environ["PRICE_FALLBACK"] = ""
+    try:
+        bot = load_bot()
+        rng = random.Random(args.seed)
+        coins = [cg_id for _, cg_id, _ in bot.builtin_coins()]
+        for user_id in range(1, args.users + 1):
+            bot.set_user_data(user_id, [
+                {'symbol': cg_id[:5].upper(), 'cg_id': cg_id, 'period': 15, 'last_sent': 0}
+                for cg_id in rng.sample(coins, rng.randint(1, bot.MAX_COINS))
+            ])
+        for provider in bot.price_source.providers:
+            provider.governor = bot.RateGovernor(1e9, 1e9)
+        app = bot.application = bot.build_application()
+        await app.initialize()
+
+        results = {}
+        for tag, delay in (('healthy', 0.0), ('slow', args.delay)):
+            results[tag] = await run_scenario(bot, app, args, stub_url, delay, tag)
+        await bot.price_source.aclose()
+        await app.shutdown()
+        return results
+    finally:
+        stubs.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=3.0, help="تأخیر CoinGecko در سناریوی کند (ثانیه)")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--price-qps", type=float, default=20, help="get_price های کش‌نشده در ثانیه")
+    parser.add_argument("--handler-qps", type=float, default=50, help="list_coins در ثانیه")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--max-lag-ms", type=float, default=50, help="سقف p99 تأخیر loop و list_coins زیر upstream کند")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print(f"{'':<22}" + "".join(f"{name:>12}" for name in results))
+        for key in results['healthy']:
+            print(f"{key:<22}" + "".join(f"{result[key]:>12,.1f}" for result in results.values()))
+    slow = results['slow']
+    assert slow['loop_lag_p99_ms'] < args.max_lag_ms, f"loop lag p99 {slow['loop_lag_p99_ms']:.1f}ms"
+    assert slow['list_coins_p99_ms'] < args.max_lag_ms, f"list_coins p99 {slow['list_coins_p99_ms']:.1f}ms"
+
+
+if __name__ == "__main__":
+    main()
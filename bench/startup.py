@@ -0,0 +1,119 @@
+"""بنچمارک راه‌اندازی سرد: از اجرای پروسه تا اولین آپدیت جواب داده‌شده
+
+    python bench/startup.py                          # ۵ بار، BOT_MODE=all، تأخیر ۵۰ms برای Bot API
+    python bench/startup.py --runs 10 --mode web --json
+
+ربات مثل Render تو یک پروسه تازه اجرا میشه؛ Bot API و CoinGecko با bench/stubs.py (با تأخیر --latency
+برای هر درخواست) و Redis با fakeredis داخل همون پروسه (یا BENCH_REDIS_URL). یک آپدیت /start مدام به
+وب‌هوک فرستاده میشه تا قبول بشه و زمان رسیدن اولین sendMessage به stub اندازه گرفته میشه.
+گزارش (میانه، ثانیه از اجرای پروسه): accepted (اولین 200 وب‌هوک)، first_reply (اولین پیام) و مراحلی که
+خود ربات از شروع پروسه‌اش گزارش میده (/{TOKEN}/debug: ready، first_update).
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from cycle import HERE, start_stubs, stub_stats
+
+TOKEN = "123456:bench"
+BOOT = f"import asyncio, sys; sys.path.insert(0, {HERE!r}); from common import load_bot; asyncio.run(load_bot().main())"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_update(seq):
+    return json.dumps({
+        'update_id': seq,
+        'message': {
+            'message_id': seq, 'date': int(time.time()), 'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'bench'},
+        },
+    }).encode()
+
+
+def post_until_accepted(url, deadline):
+    seq = 0
+    while time.perf_counter() < deadline:
+        seq += 1
+        request = urllib.request.Request(url, data=start_update(seq), headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError("webhook never accepted the update")
+
+
+def run_once(args, stub_url, snapshot_path):
+    port = free_port()
+    env = dict(
+        os.environ,
+        TOKEN=TOKEN, BOT_MODE=args.mode, PORT=str(port), RENDER_EXTERNAL_URL=f"http://127.0.0.1:{port}",
+        TELEGRAM_API_URL=f"{stub_url}/bot", COINGECKO_API_URL=stub_url, SNAPSHOT_PATH=snapshot_path,
+    )
+    stub_stats(stub_url, reset=True)
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", BOOT], env=env,
+                            stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        deadline = started + args.timeout
+        post_until_accepted(f"http://127.0.0.1:{port}/{TOKEN}", deadline)
+        result = {'accepted': time.perf_counter() - started}
+        while not stub_stats(stub_url).get('telegram_sendMessage'):
+            if time.perf_counter() > deadline:
+                raise TimeoutError("no reply from the bot")
+            time.sleep(0.005)
+        result['first_reply'] = time.perf_counter() - started
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/{TOKEN}/debug") as resp:
+            marks = json.loads(resp.read())['startup']
+        result.update((f"bot_{stage}", seconds) for stage, seconds in marks.items())
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", default="all", choices=("all", "web"))
+    parser.add_argument("--latency", type=float, default=0.05, help="تأخیر هر درخواست Bot API/CoinGecko (ثانیه)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--verbose", action="store_true", help="لاگ‌های ربات روی stderr")
+    parser.add_argument("--json", action="store_true", help="خروجی یک خط JSON")
+    args = parser.parse_args()
+
+    stubs, stub_url = start_stubs(args.latency)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            runs = [run_once(args, stub_url, os.path.join(tmp, "snapshot.json")) for _ in range(args.runs)]
+    finally:
+        stubs.terminate()
+
+    keys = sorted({key for run in runs for key in run}, key=lambda key: min(run.get(key, 1e9) for run in runs))
+    result = {key: statistics.median(run[key] for run in runs if key in run) for key in keys}
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key in keys:
+        print(f"{key:<20}{result[key]:>10.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""سرور جعلی CoinGecko، CoinCap و Bot API تلگرام برای بنچمارک آفلاین
+
+    python bench/stubs.py [--port 0] [--latency 0.05] [--faults '{"coingecko": {"status": 429}}']
+
+پورت واقعی روی اولین خط stdout چاپ میشه. --latency تأخیر هر درخواست (ثانیه) برای شبیه‌سازی round-trip شبکه‌ست. آمار درخواست‌ها از GET /_stats و صفر کردنش با POST /_reset.
+GET /_sends لاگ sendMessage ها به شکل [[زمان، chat_id], ...] (با /_reset خالی میشه).
+CoinGecko روی /simple/price و CoinCap روی /coincap/assets (فقط ~۹۰٪ ارزها رو می‌شناسه).
+خطای ساختگی برای هر provider با POST /_faults (بدنه JSON، جایگزین همه خطاهای قبلی):
+    {"coingecko": {"latency": 2, "status": 429, "rate": 0.5, "retry_after": 3}}
+/simple/price هر واحدی از vs_currencies که در FX باشه رو با نرخ ثابت برمی‌گردونه.
+latency تأخیر اضافه، status کد جواب برای کسر rate از درخواست‌ها (پیش‌فرض همه) و retry_after هدر Retry-After.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+import zlib
+from collections import Counter
+
+import tornado.web
+
+stats = Counter()
+sends = []  # (زمان، chat_id) هر sendMessage
+latency = 0.0
+faults = {}
+FX = {"usd": 1.0, "eur": 0.92, "gbp": 0.79, "try": 34.2, "aed": 3.6725, "cad": 1.37, "aud": 1.52, "chf": 0.88}
+
+
+def stub_price(cg_id):
+    """قیمت ثابت برای هر ارز + نوسان کوچک با زمان، تا هشدارها گاهی فعال بشن"""
+    base = (zlib.crc32(cg_id.encode()) % 100_000) / 10 + 0.01
+    return round(base * (1 + 0.03 * ((time.time() // 1) % 3 - 1)), 6)
+
+
+async def inject(handler, provider):
+    """تأخیر و خطای ساختگی این provider؛ True اگه جواب خطا فرستاده شد"""
+    fault = faults.get(provider, {})
+    stats[f"{provider}_calls"] += 1
+    await asyncio.sleep(latency + fault.get("latency", 0))
+    if fault.get("status") and random.random() < fault.get("rate", 1.0):
+        stats[f"{provider}_{fault['status']}"] += 1
+        handler.set_status(fault["status"])
+        if fault.get("retry_after") is not None:
+            handler.set_header("Retry-After", str(fault["retry_after"]))
+        handler.write({"error": "injected"})
+        return True
+    return False
+
+
+class SimplePriceHandler(tornado.web.RequestHandler):
+    async def get(self):
+        if await inject(self, "coingecko"):
+            return
+        ids = [cg_id for cg_id in self.get_argument("ids", "").split(",") if cg_id]
+        stats["coingecko_ids"] += len(ids)
+        currencies = [cur for cur in self.get_argument("vs_currencies", "usd").split(",") if cur in FX]
+        prices = {cg_id: stub_price(cg_id) for cg_id in ids}
+        self.write({cg_id: {cur: round(price * FX[cur], 6) for cur in currencies} for cg_id, price in prices.items()})
+
+
+class CoinCapHandler(tornado.web.RequestHandler):
+    async def get(self):
+        if await inject(self, "coincap"):
+            return
+        ids = [cg_id for cg_id in self.get_argument("ids", "").split(",") if cg_id]
+        known = [cg_id for cg_id in ids if zlib.crc32(cg_id.encode()) % 10]
+        stats["coincap_ids"] += len(known)
+        self.write({"data": [{"id": cg_id, "priceUsd": str(stub_price(cg_id))} for cg_id in known]})
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    message_id = 0
+
+    def params(self):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.request.body or b"{}")
+        return {key: self.get_argument(key) for key in self.request.arguments}
+
+    async def post(self, token, method):
+        await asyncio.sleep(latency)
+        stats[f"telegram_{method}"] += 1
+        params = self.params()
+        if method == "getMe":
+            result = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            if method == "sendMessage":
+                sends.append((time.time(), int(params.get("chat_id", 0))))
+            BotApiHandler.message_id += 1
+            result = {
+                "message_id": BotApiHandler.message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+    get = post
+
+
+class FaultsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(faults)
+
+    def post(self):
+        faults.clear()
+        faults.update(json.loads(self.request.body or b"{}"))
+        self.write(faults)
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(dict(stats))
+
+    def post(self):
+        stats.clear()
+        sends.clear()
+        self.write({})
+
+
+class SendsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"sends": sends})
+
+
+async def main():
+    global latency
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--faults", default="{}", help="خطاهای ساختگی اولیه (همون JSON ـه /_faults)")
+    args = parser.parse_args()
+    latency = args.latency
+    faults.update(json.loads(args.faults))
+    logging.getLogger("tornado.access").disabled = True  # 429/500 های ساختگی لاگ warning میدن
+    app = tornado.web.Application([
+        (r"/simple/price", SimplePriceHandler),
+        (r"/coincap/assets", CoinCapHandler),
+        (r"/_faults", FaultsHandler),
+        (r"/bot([^/]+)/(\w+)", BotApiHandler),
+        (r"/_stats", StatsHandler),
+        (r"/_reset", StatsHandler),
+        (r"/_sends", SendsHandler),
+    ])
+    server = app.listen(args.port, address="127.0.0.1")
+    port = next(iter(server._sockets.values())).getsockname()[1]
+    print(port, flush=True)
+    sys.stdout.close()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,194 +1,2733 @@
+import time
+STARTED_AT = time.monotonic()  # قبل از بقیه import ها، برای گزارش زمان راه‌اندازی
+
 import os
+import re
+import signal
+import socket
+import zlib
 import logging
 import json
-import time
 import asyncio
-import requests
+import httpx
 import redis
+import redis.asyncio as aioredis
+from bisect import bisect_left, bisect_right
+import contextlib
+import email.utils
+import functools
+import gc
+import importlib.util
+import heapq
+import mmap
+import struct
+import sys
+import tempfile
 import threading
+from array import array
+from collections import Counter, OrderedDict, deque
+from operator import itemgetter
 import asyncio
-from threading import Thread
-from asyncio import run_coroutine_threadsafe
-from flask import Flask, request
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import tornado.web
+import prometheus_client as prom
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.helpers import escape_markdown
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler,
+    Application, CommandHandler, CallbackQueryHandler, InlineQueryHandler,
     ContextTypes, MessageHandler, filters
 )
 
-main_loop = None  
+def lazy_import(name):
+    """ماژولی که فقط با اولین دسترسی به یکی از attribute هاش واقعاً لود میشه"""
+    if name in sys.modules:  # قبلاً کسی لودش کرده؛ دوباره اجرا کردنش ممنوعه
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+background_tasks = set()
+
+def spawn(coro):
+    """task پس‌زمینه تا آخر عمر پروسه
+
+    asyncio فقط weak reference به task ها نگه می‌داره و Application.create_task وقتی Application اجرا نمیشه
+    (BOT_MODE=worker) هم نگهشون نمی‌داره؛ task ـی که منتظر یک future بی‌صاحبه (مثل pubsub.listen) وسط کار GC میشه.
+    """
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# numpy فقط برای چک‌کننده (AlertIndex، PriceHistory) لازمه؛ پروسه وب هیچ‌وقت لودش نمی‌کنه
+np = lazy_import("numpy")
+
 # --- تنظیمات ---
 TOKEN = os.environ["TOKEN"]
 UPSTASH_REDIS_URL = os.environ["UPSTASH_REDIS_URL"]
 RENDER_EXTERNAL_URL = os.environ.get("RENDER_EXTERNAL_URL")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # مثلاً برای سرور Bot API محلی/تست
+PORT = int(os.environ.get("PORT", 5000))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+BOT_MODE = os.environ.get("BOT_MODE", "all")  # all: وب‌هوک + چک قیمت | web: فقط وب‌هوک | worker: فقط چک قیمت
+CHECKER_SHARDS = int(os.environ.get("CHECKER_SHARDS", 1))  # باید تو همه پروسه‌ها یکی باشه
+DATA_DIR = os.environ.get("DATA_DIR", ".")  # فایل‌های محلی ربات (کاتالوگ، snapshot)؛ بهتره بیرون از سورس باشه
 
 # --- لاگ ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- چک URL ---
-if not RENDER_EXTERNAL_URL:
-    logger.error("RENDER_EXTERNAL_URL تنظیم نشده!")
-    raise ValueError("RENDER_EXTERNAL_URL is required!")
-if not RENDER_EXTERNAL_URL.startswith("http"):
-    RENDER_EXTERNAL_URL = "https://" + RENDER_EXTERNAL_URL
+# --- چک URL ---
+# worker ها وب‌هوک ندارن
+if BOT_MODE != "worker":
+    if not RENDER_EXTERNAL_URL:
+        logger.error("RENDER_EXTERNAL_URL تنظیم نشده!")
+        raise ValueError("RENDER_EXTERNAL_URL is required!")
+    if not RENDER_EXTERNAL_URL.startswith("http"):
+        RENDER_EXTERNAL_URL = "https://" + RENDER_EXTERNAL_URL
+
+    WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}/{TOKEN}"
+    logger.info(f"Webhook URL: {WEBHOOK_URL}")
+
+# --- اتصال به Redis ---
+# rediss:// (مثل Upstash) بدون بررسی گواهی؛ redis:// ساده (Redis محلی یا بنچمارک) این گزینه رو قبول نمی‌کنه
+REDIS_TLS = {'ssl_cert_reqs': None} if UPSTASH_REDIS_URL.startswith("rediss://") else {}
+
+r = redis.from_url(
+    UPSTASH_REDIS_URL,
+    decode_responses=True,
+    **REDIS_TLS
+)
+# اتصال واقعی (ping) تو main همزمان با بقیه مراحل راه‌اندازی انجام میشه (connect_redis)
+
+# همون Redis بدون decode، برای مقدارهای باینری (مثل تاریخچه قیمت)
+rb = redis.from_url(UPSTASH_REDIS_URL, **REDIS_TLS)
+
+# کلاینت async برای مسیرهایی که روی loop اصلی مدام اجرا میشن (چرخه چک قیمت، lease ها)؛ دستور sync اونجا
+# کل loop (ارسال پیام‌ها، وب‌هوک) رو به اندازه یک round-trip نگه می‌داره
+ar = aioredis.from_url(UPSTASH_REDIS_URL, decode_responses=True, **REDIS_TLS)
+
+# --- متریک‌ها (Prometheus) ---
+# متریک‌های پرتکرار با child های از پیش ساخته ثبت میشن؛ شمارنده‌هایی که از قبل تو stats کلاس‌ها
+# نگه داشته میشن (کش قیمت، dispatcher) فقط موقع scrape خونده میشن و سربار مسیر اصلی ندارن.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # برای BOT_MODE=worker که وب‌سرور نداره
+USERS_COUNT_KEY = "stats:users"
+STATS_REFRESH = 30  # ثانیه؛ فاصله تازه کردن شمارنده‌های Redis ـه متریک‌ها
+
+CHECK_CYCLE_SECONDS = prom.Histogram(
+    "cryptobot_check_cycle_seconds", "مدت هر اجرای safe_check_prices",
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+PROVIDER_SECONDS = prom.Histogram("cryptobot_price_provider_seconds", "زمان درخواست‌های API قیمت", ["provider"])
+PROVIDER_REQUESTS = prom.Counter(
+    "cryptobot_price_provider_requests", "نتیجه درخواست‌های API قیمت (ok، throttled، error، skipped)", ["provider", "result"]
+)
+REDIS_SECONDS = prom.Histogram(
+    "cryptobot_redis_roundtrip_seconds", "زمان round-trip های Redis در مسیرهای اصلی", ["op"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+)
+REDIS_OPS = {
+    op: REDIS_SECONDS.labels(op)
+    for op in ("get_price", "get_due", "load_users", "save_last_sent", "reschedule", "user_data", "user_op")
+}
+SEND_SECONDS = prom.Histogram(
+    "cryptobot_send_seconds", "از ورود پیام به صف dispatcher تا تحویل به تلگرام",
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+HANDLER_SECONDS = prom.Histogram("cryptobot_handler_seconds", "زمان اجرای هر هندلر تلگرام", ["handler"])
+ALERTS_FIRED = prom.Counter("cryptobot_alerts_fired", "هشدارهای فعال‌شده", ["kind"])
+UPDATES_RECEIVED = prom.Counter("cryptobot_updates_received", "آپدیت‌های وب‌هوک", ["result"])
+UPDATES_IN_FLIGHT = prom.Gauge("cryptobot_updates_in_flight", "آپدیت‌هایی که هندلرشون در حال اجراست")
+STARTUP_SECONDS = prom.Gauge(
+    "cryptobot_startup_seconds", "زمان از شروع پروسه تا هر مرحله راه‌اندازی (ready، first_update، first_check)", ["stage"]
+)
+startup_marks = {}  # stage -> ثانیه از شروع پروسه
+
+def startup_mark(stage):
+    """اولین رسیدن به هر مرحله راه‌اندازی: متریک + لاگ (فقط یکبار)"""
+    if stage in startup_marks:
+        return
+    elapsed = startup_marks[stage] = time.monotonic() - STARTED_AT
+    STARTUP_SECONDS.labels(stage).set(elapsed)
+    logger.info(f"راه‌اندازی: {stage} بعد از {elapsed:.2f} ثانیه")
+
+class StatsCollector:
+    """متریک‌هایی که موقع scrape از state خود برنامه خونده میشن
+
+    شمارنده‌های Redis (کاربران، ارزهای تحت نظر) موقع scrape خونده نمیشن، چون scrape روی همون loop
+    وب‌هوک و چک قیمت اجرا میشه؛ run هر STATS_REFRESH ثانیه با کلاینت async تازه‌شون می‌کنه.
+    """
+
+    def __init__(self):
+        self.redis_counts = None  # (users، tracked)؛ تا اولین خوندن موفق این دو متریک گزارش نمیشن
+
+    async def run(self):
+        while True:
+            try:
+                pipe = ar.pipeline(transaction=False)
+                pipe.get(USERS_COUNT_KEY)
+                pipe.hlen(TRACKED_KEY)
+                users, tracked = await pipe.execute()
+                self.redis_counts = (int(users or 0), tracked)
+            except redis.RedisError as e:
+                logger.warning(f"خوندن شمارنده‌های متریک از Redis ناموفق: {e}")
+            await asyncio.sleep(STATS_REFRESH)
+
+    def describe(self):
+        return []  # تا register موقع import خود collect رو صدا نزنه
+
+    def collect(self):
+        cache = CounterMetricFamily("cryptobot_price_cache", "نتیجه درخواست‌های کش قیمت", labels=["result"])
+        for result, value in price_cache.stats.items():
+            cache.add_metric([result], value)
+        yield cache
+
+        messages = CounterMetricFamily("cryptobot_messages", "پیام‌های dispatcher", labels=["result"])
+        for result in ('queued', 'sent', 'failed', 'retried', 'rate_limited'):
+            messages.add_metric([result], dispatcher.stats[result])
+        yield messages
+        settings = CounterMetricFamily("cryptobot_settings_cache", "درخواست‌های کش تنظیمات کاربران", labels=["result"])
+        for result, value in settings_cache.stats.items():
+            settings.add_metric([result], value)
+        yield settings
+        yield GaugeMetricFamily("cryptobot_settings_cache_entries", "کاربرهای داخل کش تنظیمات", value=len(settings_cache))
+        yield GaugeMetricFamily("cryptobot_messages_pending", "پیام‌های منتظر در صف dispatcher", value=dispatcher.pending())
+        yield GaugeMetricFamily("cryptobot_alerts", "هشدارهای شاردهای این پروسه", value=len(alert_index))
+        requests = CounterMetricFamily("cryptobot_price_requests", "درخواست‌های price_source (hedged، fallback، failed)", labels=["result"])
+        for result, value in price_source.stats.items():
+            requests.add_metric([result], value)
+        yield requests
+        rate = GaugeMetricFamily("cryptobot_price_provider_rate", "نرخ فعلی RateGovernor هر provider (درخواست در ثانیه)", labels=["provider"])
+        circuit = GaugeMetricFamily("cryptobot_price_provider_circuit_open", "۱ اگه circuit breaker provider بازه", labels=["provider"])
+        for provider in price_source.providers:
+            rate.add_metric([provider.name], provider.governor.rate)
+            circuit.add_metric([provider.name], int(provider.breaker.state != CircuitBreaker.CLOSED))
+        yield rate
+        yield circuit
+
+        app = globals().get('application')
+        if app is not None:
+            yield GaugeMetricFamily("cryptobot_updates_queued", "آپدیت‌های منتظر در صف", value=app.update_queue.qsize())
+        if self.redis_counts is not None:
+            users, tracked = self.redis_counts
+            yield GaugeMetricFamily("cryptobot_users", "تعداد کاربران", value=users)
+            yield GaugeMetricFamily("cryptobot_tracked_coins", "ارزهای تحت نظر حداقل یک کاربر", value=tracked)
+
+stats_collector = StatsCollector()
+prom.REGISTRY.register(stats_collector)
+
+@contextlib.contextmanager
+def handler_span(name, update, timer=None):
+    """حسابداری یک آپدیت: زمان هندلر + آپدیت‌های در حال اجرا + لاگ آپدیت‌های کند + مرحله first_update"""
+    timer = timer or HANDLER_SECONDS.labels(name)
+    UPDATES_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timer.observe(elapsed)
+        UPDATES_IN_FLIGHT.dec()
+        profiler.handler_done(name, update, elapsed)
+        if 'first_update' not in startup_marks:
+            startup_mark('first_update')
+
+def instrument_handler(callback):
+    """هندلر تلگرام داخل handler_span (با اسم تابع)"""
+    name = callback.__name__
+    timer = HANDLER_SECONDS.labels(name)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with handler_span(name, update, timer):
+            return await callback(update, context)
+    return wrapper
+
+# --- پروفایل و ردیابی مسیرهای کند ---
+# همه‌چیز پیش‌فرض خاموشه و بدون ری‌استارت از هش debug:profile تو Redis روشن میشه (مستقیم با
+# redis-cli یا با POST /{TOKEN}/debug)؛ هر پروسه هر PROFILE_REFRESH ثانیه تو پس‌زمینه دوباره می‌خونه:
+#   spans=1     زمان هر مرحله چرخه چک قیمت (load/fetch/evaluate/send/write-back) و هر هندلر
+#   slow_ms=N   لاگ هشدار برای آپدیت‌هایی که هندلرشون بیشتر از N میلی‌ثانیه طول کشیده
+#   capture=1   پروفایل نمونه‌برداری از چرخه بعدی (فقط یک پروسه برش می‌داره) در PROFILE_DIR
+PROFILE_KEY = "debug:profile"
+PROFILE_REFRESH = 5
+PROFILE_DIR = os.environ.get("PROFILE_DIR", tempfile.gettempdir())
+NO_SPAN = contextlib.nullcontext()
+
+class SamplingProfiler:
+    """پروفایلر نمونه‌برداری (فقط stdlib): یک ترد جدا هر interval ثانیه stack ترد اصلی رو برمی‌داره
+
+    خروجی با فرمت folded stacks ـه (هر خط: تابع‌ها با ; و بعد تعداد نمونه) که مستقیم به
+    flamegraph.pl یا speedscope داده میشه. چون loop اصلیه، وقت انتظار I/O زیر select دیده میشه
+    و هندلرهایی که همزمان اجرا شدن هم تو نمونه‌ها هستن.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+class Profiler:
+    """span های زمان‌دار چرخه چک قیمت، لاگ هندلرهای کند و capture یک چرخه
+
+    وقتی خاموشه span() همون یک nullcontext مشترک رو برمی‌گردونه، پس هزینه مسیر اصلی فقط یک
+    شرطه. span های آخرین چرخه و هندلرهای اخیر برای /debug نگه داشته میشن.
+    """
+
+    def __init__(self):
+        self.spans = False
+        self.slow_ms = 0.0
+        self.tracing = False       # span های چرخه فعلی ثبت بشن (spans یا capture)
+        self.trace = []            # (مرحله، شروع نسبت به شروع چرخه، مدت)
+        self.last_cycle = None
+        self.handlers = deque(maxlen=200)
+        self._capture_pending = False
+        self._origin = 0.0
+
+    def apply(self, config):
+        """تنظیمات خونده‌شده از هش debug:profile"""
+        self.spans = config.get('spans') == '1'
+        try:
+            self.slow_ms = float(config.get('slow_ms') or 0)
+        except ValueError:
+            self.slow_ms = 0.0
+        self._capture_pending = bool(config.get('capture'))
+
+    async def run(self):
+        """هر PROFILE_REFRESH ثانیه تنظیمات رو با کلاینت async می‌خونه، تا مسیر هندلرها بدون I/O بمونه"""
+        while True:
+            try:
+                self.apply(await ar.hgetall(PROFILE_KEY))
+            except redis.RedisError as e:
+                logger.warning(f"خوندن تنظیمات پروفایل ناموفق: {e}")
+            await asyncio.sleep(PROFILE_REFRESH)
+
+    async def _claim_capture(self):
+        """فقط پروسه‌ای که فیلد capture رو حذف کنه چرخه‌اش رو پروفایل می‌کنه"""
+        if not self._capture_pending:
+            return False
+        self._capture_pending = False
+        try:
+            return await ar.hdel(PROFILE_KEY, 'capture') == 1
+        except redis.RedisError:
+            return False
+
+    def span(self, name):
+        return self._span(name) if self.tracing else NO_SPAN
+
+    @contextlib.contextmanager
+    def _span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.trace.append((name, started - self._origin, time.perf_counter() - started))
+
+    @contextlib.asynccontextmanager
+    async def cycle(self):
+        """دور یک اجرای safe_check_prices: شروع trace، capture در صورت درخواست و گزارش آخر چرخه"""
+        sampler = SamplingProfiler() if await self._claim_capture() else None
+        self.tracing = self.spans or sampler is not None
+        self.trace = []
+        self._origin = time.perf_counter()
+        started_at = time.time()
+        if sampler:
+            sampler.start()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - self._origin
+            if sampler:
+                sampler.stop()
+                path = os.path.join(PROFILE_DIR, f"cycle-{WORKER_ID.replace(':', '-')}-{int(started_at)}.folded")
+                try:
+                    sampler.dump(path)
+                    logger.info(f"پروفایل چرخه ذخیره شد: {path} ({sum(sampler.samples.values())} نمونه)")
+                except OSError as e:
+                    logger.error(f"ذخیره پروفایل چرخه ناموفق: {e}")
+            if self.tracing:
+                self._report(started_at, total)
+            self.tracing = False
+
+    def _report(self, started_at, total):
+        phases = {}
+        for name, _, duration in self.trace:
+            count, spent = phases.get(name, (0, 0.0))
+            phases[name] = (count + 1, spent + duration)
+        self.last_cycle = {
+            'at': started_at,
+            'total_ms': round(total * 1000, 2),
+            'phases': {name: {'count': count, 'ms': round(spent * 1000, 2)} for name, (count, spent) in phases.items()},
+            'spans': [(name, round(offset * 1000, 2), round(duration * 1000, 2)) for name, offset, duration in self.trace[:1000]],
+        }
+        summary = "، ".join(f"{name} {spent * 1000:.1f}ms ({count}×)" for name, (count, spent) in phases.items())
+        logger.info(f"پروفایل چرخه چک قیمت: {total * 1000:.1f}ms — {summary or 'بدون کار'}")
+
+    def handler_done(self, name, update, elapsed):
+        if not (self.spans or self.slow_ms):
+            return
+        user = getattr(getattr(update, 'effective_user', None), 'id', None)
+        if self.spans:
+            self.handlers.append({'handler': name, 'at': time.time() - elapsed, 'ms': round(elapsed * 1000, 2), 'user': user})
+        if self.slow_ms and elapsed * 1000 >= self.slow_ms:
+            query = getattr(update, 'callback_query', None)
+            inline = getattr(update, 'inline_query', None)
+            detail = f" data={query.data!r}" if query is not None else f" query={inline.query!r}" if inline is not None else ""
+            logger.warning(f"آپدیت کند: {name} برای کاربر {user} {elapsed * 1000:.1f}ms (آستانه {self.slow_ms:g}ms){detail}")
+
+profiler = Profiler()
+
+# --- واحد پول قیمت‌ها ---
+# هر ارز کاربر قیمتش رو تو یک واحد پول (currency) می‌گیره و هشدار قیمتیش هم به همون واحده.
+# همه واحدهای QUOTE_CURRENCIES با یک درخواست (vs_currencies) برای همه ارزها گرفته میشن، پس اضافه
+# شدن واحد جدید تعداد درخواست‌ها رو زیاد نمی‌کنه. قیمت‌ها همه‌جا (price feed، کانال prices،
+# price_snapshot، کش‌ها و alert_index) با کلید quote_key نگه داشته میشن: cg_id برای دلار و
+# "cg_id/currency" برای بقیه، پس مسیرهایی که فقط دلار می‌شناختن بدون تغییر کار می‌کنن.
+BASE_CURRENCY = "usd"
+QUOTE_CURRENCIES = [BASE_CURRENCY] + [
+    currency for currency in os.environ.get("QUOTE_CURRENCIES", "eur,gbp,try,aed,cad").lower().replace(" ", "").split(",")
+    if currency and currency != BASE_CURRENCY
+]
+CURRENCY_LABELS = {  # واحد -> (نماد، اسم)
+    'usd': ("$", "دلار آمریکا"), 'eur': ("€", "یورو"), 'gbp': ("£", "پوند انگلیس"), 'try': ("₺", "لیر ترکیه"),
+    'aed': ("AED ", "درهم امارات"), 'cad': ("C$", "دلار کانادا"), 'aud': ("A$", "دلار استرالیا"), 'chf': ("CHF ", "فرانک سوئیس"),
+}
+
+def quote_key(cg_id, currency=BASE_CURRENCY):
+    return cg_id if currency == BASE_CURRENCY else f"{cg_id}/{currency}"
+
+def split_quote(key):
+    """(cg_id, currency) از quote_key"""
+    cg_id, _, currency = key.partition("/")
+    return cg_id, currency or BASE_CURRENCY
+
+def base_prices(prices):
+    """فقط قیمت‌های دلاری (مثلاً برای تاریخچه قیمت و هشدارهای درصدی)"""
+    return {key: price for key, price in prices.items() if "/" not in key}
+
+def currency_label(currency):
+    return CURRENCY_LABELS.get(currency, ("", currency.upper()))[1]
+
+def format_price(price, currency=BASE_CURRENCY):
+    sign = CURRENCY_LABELS.get(currency, ("",))[0]
+    return f"{sign}{price:,.2f}" if sign else f"{price:,.2f} {currency.upper()}"
+
+def md(text):
+    """نماد/اسم ارز یا متن کاربر برای پیام‌های parse_mode='Markdown' (بیرون از entity ها)"""
+    return escape_markdown(str(text))
+
+def md_code(text):
+    """همون برای داخل `...`: تو entity کد بک‌اسلش معنی نداره و فقط ` می‌شکوندش"""
+    return str(text).replace("`", "'")
+
+# --- توابع Redis ---
+# تنظیمات هر کاربر یک هش user:{user_id} ـه: هر ارز یک فیلد (فیلد = cg_id) و فیلد "#" شمارنده ترتیب
+# اضافه شدن (وجودش یعنی کاربر ثبت شده). مقدار هر ارز یک رکورد فشرده با شمای ثابت ـه (encode_item).
+# last_sent هر ارز جدا تو هش sent:{user_id} (فیلد = cg_id، مقدار = ثانیه صحیح) ـه، تا چک قیمت فقط
+# همین فیلدها رو بنویسه.
+# هندلرها هر تغییر رو با یک اسکریپت Lua اتمی انجام میدن (عملیات اتمی روی تنظیمات کاربر، پایین‌تر)،
+# پس دو آپدیت همزمان یک کاربر یا چک قیمت همدیگه رو بازنویسی نمی‌کنن.
+# فرمت‌های قدیمی (کل تنظیمات یک رشته JSON، یا مقدار JSON برای هر ارز) اولین باری که خونده یا تغییر
+# داده میشن به فرمت فعلی تبدیل میشن.
+SEQ_FIELD = "#"
+SETTINGS_VERSION = "3"
+_RECORD_PREFIX = SETTINGS_VERSION + "|"
+DECODE_CACHE_SIZE = int(os.environ.get("DECODE_CACHE_SIZE", 16384))  # رکوردهای parse شده (حدود ۵۰۰ بایت هر کدوم)
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+def sent_key(user_id):
+    return f"sent:{user_id}"
+
+def encode_item(item, seq):
+    """رکورد نسخه ۳: "3|period|seq|currency|op|price|window|symbol"
+
+    ترتیب ستون‌ها ثابته و اسم کلیدی تکرار نمیشه؛ currency برای دلار و ستون‌های هشدار برای ارز
+    بدون هشدار خالی‌ان و symbol آخره تا هر کاراکتری (حتی |) داشته باشه. اسکریپت‌های Lua همین
+    فرمت رو می‌خونن و می‌نویسن.
+    """
+    currency = item.get('currency', BASE_CURRENCY)
+    alert = item.get('alert')
+    if alert:
+        op, price, window = alert['op'], repr(alert['price']), str(alert.get('window') or '')
+    else:
+        op = price = window = ''
+    return "|".join((
+        SETTINGS_VERSION, str(item.get('period', 15)), str(seq), '' if currency == BASE_CURRENCY else currency,
+        op, price, window, item['symbol'],
+    ))
+
+def decode_item(raw):
+    """(seq, item) از مقدار یک ارز؛ JSON نسخه ۱ و رکورد نسخه ۲ (بدون currency) هم خونده میشن.
+
+    ValueError برای مقدار خراب. currency فقط برای غیر دلار تو item هست. هر فراخوانی dict های
+    خودش رو می‌گیره (کپی از کش _decode_record)، پس صدازننده می‌تونه item رو تغییر بده.
+    """
+    seq, item = _decode_record(raw)
+    item = item.copy()
+    if 'alert' in item:
+        item['alert'] = item['alert'].copy()
+    return seq, item
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def _decode_record(raw):
+    """تجزیه یک رکورد، با کش روی خود رشته: رکوردهای یکسان بین کاربرها زیادن (ارز معروف با همون دوره و
+    ترتیب) و هندلرها یک کاربر رو پشت سر هم دوباره parse می‌کنن. کپی گرفتن از نتیجه کش حدود نصف
+    تجزیه دوباره‌ست؛ رکوردهای یکتا (هشدار با قیمت دلخواه) فقط هزینه کپی رو اضافه می‌کنن.
+    """
+    if raw[:1] == "{":
+        item = json.loads(raw)
+        return item.pop('seq', 0), item
+    # یک split برای کل رکورد؛ تعداد ستون اشتباه موقع unpack خودش ValueError میده
+    if raw.startswith(_RECORD_PREFIX):
+        _, period, seq, currency, op, price, window, symbol = raw.split("|", 7)
+    elif raw.startswith("2|"):
+        _, period, seq, op, price, window, symbol = raw.split("|", 6)
+        currency = ''
+    else:
+        raise ValueError(f"unknown settings version {raw.split('|', 1)[0]!r}")
+    item = {'symbol': sys.intern(symbol), 'period': int(period)}
+    if currency:
+        item['currency'] = sys.intern(currency)
+    if op == '%':
+        item['alert'] = {'op': op, 'price': float(price), 'window': int(window)}
+    elif op:
+        item['alert'] = {'op': op, 'price': float(price)}
+    return int(seq), item
+
+def parse_settings(fields, sent):
+    """هش user:{id} + هش sent:{id} -> لیست ارزها به ترتیب اضافه شدن"""
+    items = []
+    for cg_id, raw in fields.items():
+        if cg_id == SEQ_FIELD:
+            continue
+        try:
+            seq, item = decode_item(raw)
+        except ValueError:
+            continue
+        item['cg_id'] = sys.intern(cg_id)
+        last_sent = sent.get(cg_id, 0)
+        try:
+            item['last_sent'] = int(last_sent)  # Lua ثانیه صحیح می‌نویسه
+        except ValueError:
+            item['last_sent'] = int(float(last_sent))
+        items.append((seq, item))
+    items.sort(key=itemgetter(0))
+    return [item for _, item in items]
+
+def pairs(flat):
+    return dict(zip(flat[::2], flat[1::2]))
+
+# --- کش تنظیمات کاربران ---
+SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", 10000))
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+class SettingsCache:
+    """کش LRU داخل پروسه جلوی user:{id} و sent:{id} برای هندلرها
+
+    کلیک‌های پشت سر هم یک کاربر (list_coins → edit_coin → set_time → save_time) از اینجا خونده میشن
+    و هر عملیات روی تنظیمات، وضعیت تازه‌ای که اسکریپتش برمی‌گردونه رو مستقیم تو کش می‌نویسه
+    (write-through). مقدار خام (دو هش) نگه داشته میشه و هر بار parse میشه، پس هندلرها می‌تونن لیست
+    رو بدون خطر تغییر بدن.
+
+    هماهنگی بین پروسه‌ها با خود Redis ـه: CLIENT TRACKING در حالت BCAST روی پیشوندهای user: و sent:
+    (و اگه سرور پشتیبانی نکنه، keyspace notifications در صورت روشن بودن). هر نوشتنی روی این کلیدها
+    از هر پروسه‌ای یک invalidation میاره و خونه اون کاربر پاک میشه. کش فقط وقتی فعاله که کانال
+    invalidation وصل باشه؛ با قطع شدنش خالی و خاموش میشه تا داده کهنه برنگرده. invalidation
+    نوشتن‌های خود این پروسه هم خونه رو پاک می‌کنه (BCAST کلیدهای چند نوشتن رو یکی می‌کنه و نمیشه
+    فهمید فقط مال ما بوده)؛ write-through فقط تا رسیدنش خوندن نوشته خود پروسه رو درست نگه می‌داره.
+    """
+
+    def __init__(self, maxsize=SETTINGS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # user_id -> (fields, sent)
+        self.live = False
+        self.mode = None  # tracking | keyspace
+        self.warm_ids = []  # کاربرهایی که بعد از وصل شدن کانال invalidation از قبل خونده میشن (snapshot)
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, user_id):
+        if not self.live:
+            return None
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.stats['hits'] += 1
+        return entry
+
+    def put(self, user_id, fields, sent):
+        if not self.live:
+            return
+        self._entries[user_id] = (fields, sent)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def hot_users(self, limit):
+        """پرکاربردترین کاربرها (آخرین‌ها در LRU)، از سرد به گرم"""
+        return list(self._entries)[-limit:]
+
+    def prefetch(self, user_ids, batch_size=500):
+        """خوندن تنظیمات چند کاربر با یک round-trip برای هر batch؛ فقط وقتی کانال invalidation وصله"""
+        for start in range(0, len(user_ids), batch_size):
+            chunk = user_ids[start:start + batch_size]
+            for user_id, (fields, sent) in zip(chunk, read_users(chunk, 'load_users')):
+                if fields:
+                    self.put(user_id, fields, sent)
+
+    def invalidate(self, key):
+        try:
+            user_id = int(key.partition(":")[2])
+        except ValueError:
+            return
+        self.stats['invalidations'] += 1
+        self._entries.pop(user_id, None)
+
+    async def _subscribe(self, listener, control):
+        """کانال invalidation: اول CLIENT TRACKING، وگرنه keyspace notifications"""
+        await listener.send_command("CLIENT", "ID")
+        client_id = await listener.read_response()
+        try:
+            await control.send_command(
+                "CLIENT", "TRACKING", "on", "REDIRECT", client_id, "BCAST", "PREFIX", "user:", "PREFIX", "sent:"
+            )
+            await control.read_response()
+            await listener.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+            await listener.read_response()
+            return "tracking"
+        except redis.ResponseError as e:
+            logger.info(f"CLIENT TRACKING در دسترس نیست ({e})، keyspace notifications امتحان میشه")
+        await control.send_command("CONFIG", "GET", "notify-keyspace-events")
+        flags = (await control.read_response() or ["", ""])[1]
+        if "K" not in flags or not ("A" in flags or {"$", "h"} <= set(flags)):
+            raise redis.ResponseError(f"notify-keyspace-events={flags!r}")
+        await listener.send_command("PSUBSCRIBE", "__keyspace@*__:user:*", "__keyspace@*__:sent:*")
+        for _ in range(2):
+            await listener.read_response()
+        return "keyspace"
+
+    def _on_message(self, message):
+        kind = message[0]
+        if kind == "message":
+            # tracking: لیست کلیدها، یا None وقتی کل دیتابیس flush شده
+            if message[2] is None:
+                self.clear()
+            else:
+                for key in message[2]:
+                    self.invalidate(key)
+        elif kind == "pmessage":
+            self.invalidate(message[2].split(":", 1)[1])
+
+    async def run(self):
+        """اتصال دائمی کانال invalidation؛ با هر قطعی کش خالی و دوباره وصل میشه"""
+        while True:
+            ar = aioredis.from_url(UPSTASH_REDIS_URL, decode_responses=True, **REDIS_TLS)
+            listener = control = None
+            try:
+                # دو اتصال جدا از pool: tracking به اتصال control بسته‌ست و پیام‌هاش به listener میرن
+                listener = await ar.connection_pool.get_connection("_")
+                control = await ar.connection_pool.get_connection("_")
+                try:
+                    self.mode = await self._subscribe(listener, control)
+                except redis.ResponseError as e:
+                    logger.warning(f"کش تنظیمات کاربران غیرفعاله: سرور invalidation پشتیبانی نمی‌کنه ({e})")
+                    return
+                self.clear()
+                self.live = True
+                logger.info(f"کش تنظیمات کاربران فعال شد (invalidation: {self.mode})")
+                if self.warm_ids:
+                    # از اینجا به بعد هر تغییری invalidation میاره، پس خوندن از قبل امنه
+                    warm_ids, self.warm_ids = self.warm_ids, []
+                    self.prefetch(warm_ids)
+                    logger.info(f"کش تنظیمات از snapshot گرم شد: {len(self)} کاربر")
+                while True:
+                    message = await listener.read_response(timeout=30)
+                    if message is None:
+                        # کانال ساکته؛ زنده بودن هر دو اتصال چک میشه (قطع control یعنی tracking تموم شده)
+                        await control.send_command("PING")
+                        await control.read_response()
+                        await listener.send_command("PING")
+                        continue
+                    self._on_message(message)
+            except Exception as e:
+                logger.error(f"خطا در کانال invalidation کش تنظیمات: {e}")
+            finally:
+                self.live = False
+                self.clear()
+                for conn in (listener, control):
+                    if conn is not None:
+                        await conn.disconnect()
+                await ar.aclose()
+            await asyncio.sleep(5)
+
+settings_cache = SettingsCache()
+
+def queue_user_reads(pipe, user_ids):
+    for user_id in user_ids:
+        pipe.hgetall(user_key(user_id))
+        pipe.hgetall(sent_key(user_id))
+
+def read_users(user_ids, op):
+    """(fields, sent) خام هر کاربر در یک round-trip؛ کاربرهای با فرمت قدیمی همینجا تبدیل میشن"""
+    pipe = r.pipeline(transaction=False)
+    queue_user_reads(pipe, user_ids)
+    with REDIS_OPS[op].time():
+        replies = pipe.execute(raise_on_error=False)
+    return user_rows(user_ids, replies)
+
+async def read_users_async(user_ids, op):
+    """مثل read_users با کلاینت async (چرخه چک قیمت)"""
+    pipe = ar.pipeline(transaction=False)
+    queue_user_reads(pipe, user_ids)
+    with REDIS_OPS[op].time():
+        replies = await pipe.execute(raise_on_error=False)
+    return user_rows(user_ids, replies)
+
+def user_rows(user_ids, replies):
+    rows = list(zip(replies[::2], replies[1::2]))
+    for n, (fields, sent) in enumerate(rows):
+        if isinstance(sent, Exception) and not isinstance(fields, redis.ResponseError):
+            raise sent
+        # WRONGTYPE: هنوز رشته JSON قدیمیه؛ "{" اول مقدار: ارز با فرمت JSON نسخه ۱
+        if isinstance(fields, redis.ResponseError) or any(raw[:1] == "{" for raw in fields.values()):
+            _, fields, sent, _ = run_user_script(MIGRATE_USER, user_ids[n])
+            rows[n] = (fields, sent)
+    return rows
+
+def get_user_data(user_id):
+    cached = settings_cache.get(user_id)
+    if cached is not None:
+        return parse_settings(*cached)
+    fields, sent = read_users([user_id], 'user_data')[0]
+    settings_cache.put(user_id, fields, sent)
+    return parse_settings(fields, sent)
+
+def set_user_data(user_id, data):
+    """جایگزینی کل تنظیمات کاربر (برای ابزارها و bench؛ هندلرها از عملیات‌های اتمی استفاده می‌کنن)"""
+    fields = {SEQ_FIELD: str(len(data))}
+    fields.update((item['cg_id'], encode_item(item, seq)) for seq, item in enumerate(data, 1))
+    sent = {item['cg_id']: str(int(item.get('last_sent', 0))) for item in data}
+    pipe = r.pipeline()
+    pipe.delete(user_key(user_id), sent_key(user_id))
+    pipe.hset(user_key(user_id), mapping=fields)
+    if sent:
+        pipe.hset(sent_key(user_id), mapping=sent)
+    with REDIS_OPS['user_data'].time():
+        pipe.execute()
+    settings_cache.put(user_id, fields, sent)
+
+def settings_rows(user_ids, rows):
+    return [(user_id, parse_settings(fields, sent)) for user_id, (fields, sent) in zip(user_ids, rows)]
+
+async def load_users(user_ids):
+    """تنظیمات چند کاربر در یک round-trip (pipeline: دو HGETALL برای هر کاربر)"""
+    if not user_ids:
+        return []
+    return settings_rows(user_ids, await read_users_async(user_ids, 'load_users'))
+
+async def save_last_sent(dirty, batch_size=500):
+    """فقط last_sent های تغییرکرده: {user_id: {cg_id: ts}} — با pipeline های batch‌شده"""
+    pipe = ar.pipeline(transaction=False)
+    with REDIS_OPS['save_last_sent'].time():
+        for n, (user_id, fields) in enumerate(dirty.items(), 1):
+            pipe.hset(sent_key(user_id), mapping=fields)
+            if n % batch_size == 0:
+                await pipe.execute()
+        await pipe.execute()
+
+def iter_user_batches(batch_size=500):
+    """همه کاربران به صورت جریانی: SCAN با cursor (به جای KEYS) و برای هر batch فقط یک round-trip
+
+    هر بار یک لیست [(user_id, settings), ...] برمی‌گرداند، پس حافظه به اندازه یک batch است نه کل کاربران.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = r.scan(cursor=cursor, match="user:*", count=batch_size)
+        user_ids = []
+        for key in keys:
+            try:
+                user_ids.append(int(key.split(":")[1]))
+            except (ValueError, IndexError):
+                continue
+        rows = read_users(user_ids, 'load_users') if user_ids else []
+        batch = [(user_id, settings) for user_id, settings in settings_rows(user_ids, rows) if settings]
+        if batch:
+            yield batch
+        if cursor == 0:
+            break
+
+# --- شاردها و lease ها ---
+# کاربران با hash بین CHECKER_SHARDS شارد تقسیم میشن. هر worker برای شاردهایی که چک می‌کنه
+# یک lease قابل تمدید تو Redis داره؛ اگه worker بمیره lease منقضی میشه و بقیه شاردش رو برمی‌دارن.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 30))  # ثانیه؛ worker مرده حداکثر این‌قدر شاردهاش رو نگه می‌داره
+WORKERS_KEY = "workers"  # sorted set: worker_id -> آخرین heartbeat
+PRICES_CHANNEL = "prices"
+ALERTS_CHANNEL = "alerts"
+
+def shard_of(user_id):
+    return zlib.crc32(str(user_id).encode()) % CHECKER_SHARDS
+
+_renew_lease = ar.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+_release_lease = ar.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+class Lease:
+    """lease قابل تمدید در Redis — در هر لحظه فقط یک worker صاحبشه"""
+
+    def __init__(self, name, ttl=LEASE_TTL):
+        self.key = f"lease:{name}"
+        self.ttl_ms = int(ttl * 1000)
+        self.held = False
+
+    async def acquire(self):
+        """تمدید (اگه دستمونه) یا گرفتن lease — خروجی: الان دستمونه یا نه"""
+        if self.held:
+            self.held = bool(await _renew_lease(keys=[self.key], args=[WORKER_ID, self.ttl_ms]))
+        else:
+            self.held = bool(await ar.set(self.key, WORKER_ID, nx=True, px=self.ttl_ms))
+        return self.held
+
+    async def release(self):
+        if self.held:
+            self.held = False
+            await _release_lease(keys=[self.key], args=[WORKER_ID])
+
+
+class ShardManager:
+    """شاردهای این worker: هر worker حداکثر سهم عادلانه‌اش (شاردها / worker های زنده) رو برمی‌داره"""
+
+    def __init__(self, shards=CHECKER_SHARDS, ttl=LEASE_TTL):
+        self.shards = shards
+        self.ttl = ttl
+        self.leases = [Lease(f"shard:{shard}", ttl) for shard in range(shards)]
+        self.feed_lease = Lease("feed", ttl)  # فقط یک پروسه قیمت‌ها رو از CoinGecko می‌گیره
+        self.owned = set()
+        self.live = 1  # worker های زنده در آخرین rebalance
+
+    async def fair_share(self):
+        now = time.time()
+        pipe = ar.pipeline(transaction=False)
+        pipe.zadd(WORKERS_KEY, {WORKER_ID: now})
+        pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - self.ttl)
+        pipe.zcard(WORKERS_KEY)
+        self.live = max((await pipe.execute())[-1], 1)
+        return -(-self.shards // self.live)
+
+    async def rebalance(self):
+        """تمدید/گرفتن/آزاد کردن lease ها — خروجی: (شاردهای جدید، شاردهای از دست رفته)"""
+        fair = await self.fair_share()
+        gained, lost = [], []
+        # تمدید lease های فعلی همزمان، نه یک round-trip پشت سر هم برای هر شارد
+        owned = sorted(self.owned)
+        renewed = await asyncio.gather(*(self.leases[shard].acquire() for shard in owned), self.feed_lease.acquire())
+        for shard, held in zip(owned, renewed):
+            if not held:
+                self.owned.discard(shard)
+                lost.append(shard)
+        # بیشتر از سهممون داریم (worker جدید اومده) → آزاد می‌کنیم تا بقیه بردارن
+        while len(self.owned) > fair:
+            shard = max(self.owned)
+            await self.leases[shard].release()
+            self.owned.discard(shard)
+            lost.append(shard)
+        # هر worker از یک جای متفاوت شروع می‌کنه تا سر یک شارد رقابت نکنن
+        start = zlib.crc32(WORKER_ID.encode()) % self.shards
+        for i in range(self.shards):
+            if len(self.owned) >= fair:
+                break
+            shard = (start + i) % self.shards
+            if shard not in self.owned and await self.leases[shard].acquire():
+                self.owned.add(shard)
+                gained.append(shard)
+        return gained, lost
+
+    async def release_all(self):
+        owned, self.owned = self.owned, set()
+        await asyncio.gather(*(self.leases[shard].release() for shard in owned), self.feed_lease.release())
+        await ar.zrem(WORKERS_KEY, WORKER_ID)
+
+shard_manager = ShardManager()
+
+# --- ایندکس زمان ارسال (due index) ---
+# برای هر شارد یک sorted set ‏due:{shard}: عضو = "{user_id}:{cg_id}" ، امتیاز = زمان ارسال بعدی (epoch)
+checker_wakeup = asyncio.Event()  # با تغییر ایندکس یا رسیدن قیمت تازه، چک‌کننده زودتر بیدار میشه
+
+def due_key(shard):
+    return f"due:{shard}"
+
+def next_send_time(item):
+    return item.get('last_sent', 0) + item.get('period', 15) * 60
+
+async def get_due(shard, now, page=5000):
+    """ورودی‌هایی که زمانشون رسیده، برای کل شارد و گروه‌بندی‌شده با کاربر: {user_id: {cg_id, ...}}
+
+    همه صفحه‌های ZRANGEBYSCORE قبل از پردازش خونده میشن، تا ارزهای یک کاربر بین چند batch پخش نشن
+    و هر کاربر در هر چرخه فقط یک digest بگیره. ورودی‌ها تا وقتی دوباره زمان‌بندی نشن تو ایندکس می‌مونن.
+    """
+    due = {}
+    start = 0
+    while True:
+        with REDIS_OPS['get_due'].time():
+            members = await ar.zrangebyscore(due_key(shard), '-inf', now, start=start, num=page)
+        for member in members:
+            user_id, cg_id = member.split(":", 1)
+            due.setdefault(int(user_id), set()).add(cg_id)
+        if len(members) < page:
+            return due
+        start += page
+
+async def next_due_at(shards):
+    """نزدیک‌ترین زمان ارسال بین شاردهای داده‌شده"""
+    pipe = ar.pipeline(transaction=False)
+    for shard in shards:
+        pipe.zrange(due_key(shard), 0, 0, withscores=True)
+    firsts = [first[0][1] for first in await pipe.execute() if first]
+    return min(firsts) if firsts else None
+
+# --- ارزهای تحت نظر ---
+# هش tracked: cg_id -> تعداد کاربرانی که این ارز رو دارن (برای price feed)
+TRACKED_KEY = "tracked"
+
+def tracked_coins():
+    return [cg_id for cg_id, count in r.hgetall(TRACKED_KEY).items() if int(count) > 0]
+
+# --- ایندکس هشدارها ---
+class AlertIndex:
+    """موتور هشدار: همه هشدارها در آرایه‌های پیوسته NumPy (هر هشدار یک خونه)
+
+    ستون‌ها: user_id، اندیس قیمت، op (>= / <= / %)، sign و key، window (دقیقه) و active.
+    اندیس قیمت به quote_key اشاره می‌کنه: هشدار قیمتی به واحد پول کاربر (cg_id/currency) و هشدار
+    درصدی همیشه روی قیمت دلاری (cg_id) که تاریخچه داره.
+    شرط قیمتی به شکل price * sign >= key ذخیره میشه (>=: sign=1، key=target | <=: sign=-1،
+    key=-target) تا همه هشدارها با یک ضرب و یک مقایسه برداری روی بردار قیمت‌ها بررسی بشن
+    (evaluate). برای هشدار درصدی sign=0 و key=درصد، و برای خونه خالی sign=0 و key=inf.
+    save_alert/clear_alert فقط یک خونه رو پر یا خالی می‌کنن (خونه‌های خالی دوباره استفاده میشن)
+    و ظرفیت دوبرابر میشه؛ حافظه هر هشدار ۳۸ بایته. آرایه‌ها با اولین هشدار ساخته میشن (numpy تنبل).
+    """
+
+    GE, LE, MOVE = 0, 1, 2
+    OPS = {'>=': GE, '<=': LE, '%': MOVE}
+    COLUMNS = (('_user', 'int64'), ('_coin', 'intp'), ('_op', 'int8'), ('_sign', 'float64'),
+               ('_key', 'float64'), ('_window', 'int32'), ('_active', 'bool'))
+
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        for name, _ in self.COLUMNS:
+            setattr(self, name, None)
+        self._size = 0        # بالاترین خونه استفاده‌شده + ۱
+        self._free = []       # خونه‌های خالی‌شده
+        self._slots = {}      # (user_id, cg_id) -> خونه
+        self._coins = {}      # quote_key -> اندیس قیمت
+        self._coin_ids = []   # اندیس قیمت -> quote_key
+        self._coin_cg = []    # اندیس قیمت -> cg_id
+        self._history_rows = None  # (len(history), len(coins), اندیس ارز -> سطر PriceHistory)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _grow(self):
+        capacity = self._capacity if self._user is None else len(self._user) * 2
+        for name, dtype in self.COLUMNS:
+            old = getattr(self, name)
+            new = np.full(capacity, np.inf) if name == '_key' else np.zeros(capacity, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _coin_index(self, key):
+        index = self._coins.get(key)
+        if index is None:
+            index = self._coins[key] = len(self._coin_ids)
+            self._coin_ids.append(key)
+            self._coin_cg.append(split_quote(key)[0])
+        return index
+
+    def set(self, user_id, cg_id, op, price, window=None, currency=BASE_CURRENCY):
+        self.remove(user_id, cg_id)
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._user is None or self._size == len(self._user):
+                self._grow()
+            slot = self._size
+            self._size += 1
+        self._user[slot] = user_id
+        self._coin[slot] = self._coin_index(cg_id if op == '%' else quote_key(cg_id, currency))
+        self._op[slot] = self.OPS[op]
+        self._sign[slot] = {self.GE: 1, self.LE: -1, self.MOVE: 0}[self._op[slot]]
+        self._key[slot] = price if op != '<=' else -price
+        self._window[slot] = window or 0
+        self._active[slot] = True
+        self._slots[(user_id, cg_id)] = slot
+
+    def remove(self, user_id, cg_id):
+        slot = self._slots.pop((user_id, cg_id), None)
+        if slot is None:
+            return
+        self._active[slot] = False
+        self._sign[slot] = 0
+        self._key[slot] = np.inf
+        self._free.append(slot)
+
+    def drop_shard(self, shard):
+        for user_id, cg_id in [key for key in self._slots if shard_of(key[0]) == shard]:
+            self.remove(user_id, cg_id)
+
+    def coins(self):
+        n = self._size
+        if not n:
+            return set()
+        return {self._coin_cg[i] for i in np.unique(self._coin[:n][self._active[:n]])}
+
+    def _rows_in(self, history):
+        """اندیس قیمت -> سطر PriceHistory (فقط وقتی قیمت جدیدی اضافه شده دوباره ساخته میشه؛ غیر دلاری‌ها -1)"""
+        key = (len(history), len(self._coin_ids))
+        if self._history_rows is None or self._history_rows[:2] != key:
+            rows = np.fromiter(map(history.row, self._coin_ids), dtype=np.intp, count=len(self._coin_ids))
+            self._history_rows = (*key, rows)
+        return self._history_rows[2]
+
+    def evaluate(self, prices, history=None):
+        """هشدارهای فعال‌شده با این قیمت‌های تازه: [(user_id, cg_id), ...]
+
+        یک گذر برداری روی همه هشدارها: قیمت هر هشدار از بردار قیمت‌ها (NaN برای ارزهایی که
+        قیمت تازه ندارن) برداشته و با مقدار هدفش مقایسه میشه. هشدارهای درصدی برای هر window
+        با بردار تغییرات PriceHistory.changes مقایسه میشن.
+        """
+        n = self._size
+        if not n or not prices:
+            return []
+        price_vec = np.full(len(self._coin_ids), np.nan)
+        for key, price in prices.items():
+            index = self._coins.get(key)
+            if index is not None:
+                price_vec[index] = price
+        coin, key = self._coin[:n], self._key[:n]
+        current = np.take(price_vec, coin)
+        mask = current * self._sign[:n] >= key  # NaN (قیمت تازه نیومده) همیشه False
+
+        moves = self._active[:n] & (self._op[:n] == self.MOVE)
+        if history is not None and len(history) and moves.any():
+            rows = self._rows_in(history)
+            for window in np.unique(self._window[:n][moves]):
+                changes = history.changes(int(window))
+                by_coin = np.where(rows >= 0, changes[np.maximum(rows, 0)], np.nan)
+                selected = moves & (self._window[:n] == window)
+                mask |= selected & (np.abs(by_coin[coin]) >= key)
+
+        hits = np.flatnonzero(mask)
+        return list(zip(self._user[hits].tolist(), map(self._coin_cg.__getitem__, self._coin[hits].tolist())))
+
+alert_index = AlertIndex()
+
+# هشدارها برای هر شارد تو هش alerts:{shard} هم ذخیره میشن (فیلد = "{user_id}:{cg_id}"، مقدار = [op, price]،
+# برای واحد غیر دلار [op, price, null, currency] و برای هشدار درصدی [op, price, window]) تا worker ی که شارد
+# رو برمی‌داره بتونه alert_index خودش رو بسازه؛ تغییرات هم روی کانال alerts منتشر میشن.
+def alerts_key(shard):
+    return f"alerts:{shard}"
+
+def alert_values(alert, currency=BASE_CURRENCY):
+    if alert['op'] == '%':
+        return [alert['op'], alert['price'], alert['window']]
+    if currency != BASE_CURRENCY:
+        return [alert['op'], alert['price'], None, currency]
+    return [alert['op'], alert['price']]
+
+def load_alert_shard(shard):
+    for member, value in r.hgetall(alerts_key(shard)).items():
+        user_id, cg_id = member.split(":", 1)
+        alert_index.set(int(user_id), cg_id, *json.loads(value))
+
+# --- عملیات اتمی روی تنظیمات کاربر ---
+# هر تغییر هندلرها یک اسکریپت Lua ـه که تو یک round-trip هم هش کاربر و هم ایندکس‌ها (due، alerts،
+# tracked) رو عوض می‌کنه و وضعیت تازه کاربر رو برمی‌گردونه. KEYS همه اسکریپت‌ها یکیه (run_user_script)
+# و ARGV با user_id، cg_id و زمان فعلی شروع میشه؛ خروجی: {status, HGETALL user, HGETALL sent, مقدار قبلی ارز}.
+USER_SCRIPT_PRELUDE = """
+local user, sent, due, alerts, tracked = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local user_id, cg_id, now = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local member = user_id .. ':' .. cg_id
+
+-- مقدار هر ارز: همون رکورد encode_item (نسخه ۳)؛ جدول Lua با ستون‌های رشته‌ای ('' یعنی دلار / بدون هشدار)
+local function text(value)
+    if value == nil or value == cjson.null then return '' end
+    return value
+end
+local function from_json(value)
+    local item = {period = tonumber(value.period) or 15, seq = tonumber(value.seq) or 0,
+                  symbol = text(value.symbol), currency = '', op = '', price = '', window = ''}
+    if type(value.alert) == 'table' then
+        item.op, item.price, item.window = text(value.alert.op), text(value.alert.price), text(value.alert.window)
+    end
+    return item
+end
+local function decode(raw)
+    if string.sub(raw, 1, 1) == '{' then return from_json(cjson.decode(raw)) end
+    local item = {currency = ''}
+    if string.sub(raw, 1, 2) == '2|' then
+        item.period, item.seq, item.op, item.price, item.window, item.symbol =
+            string.match(raw, '^2|(%d+)|(%d+)|([^|]*)|([^|]*)|([^|]*)|(.*)$')
+    else
+        item.period, item.seq, item.currency, item.op, item.price, item.window, item.symbol =
+            string.match(raw, '^%d+|(%d+)|(%d+)|([^|]*)|([^|]*)|([^|]*)|([^|]*)|(.*)$')
+    end
+    item.period, item.seq = tonumber(item.period), tonumber(item.seq)
+    return item
+end
+local function encode(item)
+    return table.concat({'""" + SETTINGS_VERSION + """', item.period, item.seq, item.currency, item.op, item.price, item.window, item.symbol}, '|')
+end
+
+-- فرمت قدیمی: کل تنظیمات یک رشته JSON (last_sent داخل هر ارز)
+if redis.call('TYPE', user).ok == 'string' then
+    local ok, items = pcall(cjson.decode, redis.call('GET', user))
+    redis.call('DEL', user)
+    local seq = 0
+    if ok and type(items) == 'table' then
+        for _, value in ipairs(items) do
+            seq = seq + 1
+            local last = math.floor(tonumber(value.last_sent) or 0)
+            if last > (tonumber(redis.call('HGET', sent, value.cg_id)) or 0) then
+                redis.call('HSET', sent, value.cg_id, last)
+            end
+            local item = from_json(value)
+            item.seq = seq
+            redis.call('HSET', user, value.cg_id, encode(item))
+        end
+    end
+    redis.call('HSET', user, '#', seq)
+end
+
+local before = cg_id ~= '' and redis.call('HGET', user, cg_id) or false
+local function result(status)
+    return {status, redis.call('HGETALL', user), redis.call('HGETALL', sent), before}
+end
+"""
+
+# همه ارزهایی که هنوز JSON نسخه ۱ان به رکورد فعلی تبدیل میشن (read_users برای هر کاربر فقط یک بار)
+MIGRATE_USER = r.register_script(USER_SCRIPT_PRELUDE + """
+local fields = redis.call('HGETALL', user)
+for i = 1, #fields, 2 do
+    if fields[i] ~= '#' and string.sub(fields[i + 1], 1, 1) == '{' then
+        local ok, item = pcall(decode, fields[i + 1])
+        if ok then redis.call('HSET', user, fields[i], encode(item)) end
+    end
+end
+return result('ok')
+""")
+
+# کاربر جدید (start): شمارنده stats:users فقط همینجا زیاد میشه
+CREATE_USER = r.register_script(USER_SCRIPT_PRELUDE + """
+if redis.call('HSETNX', user, '#', 0) == 1 then
+    redis.call('INCR', KEYS[6])
+    return result('created')
+end
+return result('exists')
+""")
+
+# ARGV[4]=symbol، ARGV[5]=period، ARGV[6]=MAX_COINS، ARGV[7]=currency ('' برای دلار)
+ADD_COIN = r.register_script(USER_SCRIPT_PRELUDE + """
+if before then return result('exists') end
+if redis.call('HLEN', user) - redis.call('HEXISTS', user, '#') >= tonumber(ARGV[6]) then
+    return result('full')
+end
+local period = tonumber(ARGV[5])
+local seq = redis.call('HINCRBY', user, '#', 1)
+redis.call('HSET', user, cg_id, encode({period = period, seq = seq, symbol = ARGV[4], currency = ARGV[7],
+                                       op = '', price = '', window = ''}))
+redis.call('HSET', sent, cg_id, math.floor(now))
+redis.call('ZADD', due, now + period * 60, member)
+redis.call('HINCRBY', tracked, cg_id, 1)
+return result('added')
+""")
+
+# ARGV[4]=period؛ last_sent = الان، پس قیمت بعدی یک دوره بعد میاد
+SET_PERIOD = r.register_script(USER_SCRIPT_PRELUDE + """
+if not before then return result('missing') end
+local item = decode(before)
+item.period = tonumber(ARGV[4])
+redis.call('HSET', user, cg_id, encode(item))
+redis.call('HSET', sent, cg_id, math.floor(now))
+if item.op == '' then
+    redis.call('ZADD', due, now + item.period * 60, member)
+end
+return result('ok')
+""")
+
+# ARGV[4..6]=op، price، window (ستون‌های رکورد)، ARGV[7]=currency ـی که هشدار باهاش ثبت شده،
+# ARGV[8]=مقدار alerts:{shard}، ARGV[9]=کانال، ARGV[10]=پیام
+SET_ALERT = r.register_script(USER_SCRIPT_PRELUDE + """
+if not before then return result('missing') end
+local item = decode(before)
+if item.currency ~= ARGV[7] then return result('changed') end
+item.op, item.price, item.window = ARGV[4], ARGV[5], ARGV[6]
+redis.call('HSET', user, cg_id, encode(item))
+redis.call('ZREM', due, member)
+redis.call('HSET', alerts, member, ARGV[8])
+redis.call('PUBLISH', ARGV[9], ARGV[10])
+return result('ok')
+""")
+
+# ARGV[4]=currency جدید، ARGV[5]=currency فعلی (همونی که Python دیده)، ARGV[6]=قیمت هشدار تبدیل‌شده
+# ('' اگه هشدار قیمتی نداره)، ARGV[7]=مقدار alerts:{shard}، ARGV[8]=کانال، ARGV[9]=پیام
+SET_CURRENCY = r.register_script(USER_SCRIPT_PRELUDE + """
+if not before then return result('missing') end
+local item = decode(before)
+local priced = item.op == '>=' or item.op == '<='
+if item.currency ~= ARGV[5] or priced ~= (ARGV[6] ~= '') then return result('changed') end
+item.currency = ARGV[4]
+if priced then
+    item.price = ARGV[6]
+    redis.call('HSET', alerts, member, ARGV[7])
+    redis.call('PUBLISH', ARGV[8], ARGV[9])
+end
+redis.call('HSET', user, cg_id, encode(item))
+return result('ok')
+""")
+
+# ARGV[4]=کانال، ARGV[5]=پیام؛ ارز دوباره طبق last_sent و period زمان‌بندی میشه
+CLEAR_ALERT = r.register_script(USER_SCRIPT_PRELUDE + """
+if not before then return result('missing') end
+local item = decode(before)
+if item.op == '' then return result('missing') end
+item.op, item.price, item.window = '', '', ''
+redis.call('HSET', user, cg_id, encode(item))
+redis.call('HDEL', alerts, member)
+redis.call('PUBLISH', ARGV[4], ARGV[5])
+local last = tonumber(redis.call('HGET', sent, cg_id)) or 0
+redis.call('ZADD', due, last + item.period * 60, member)
+return result('ok')
+""")
+
+# ARGV[4]=کانال، ARGV[5]=پیام
+REMOVE_COIN = r.register_script(USER_SCRIPT_PRELUDE + """
+if not before then return result('missing') end
+local item = decode(before)
+redis.call('HDEL', user, cg_id)
+redis.call('HDEL', sent, cg_id)
+redis.call('ZREM', due, member)
+if item.op ~= '' then
+    redis.call('HDEL', alerts, member)
+    redis.call('PUBLISH', ARGV[4], ARGV[5])
+end
+if redis.call('HINCRBY', tracked, cg_id, -1) <= 0 then
+    redis.call('HDEL', tracked, cg_id)
+end
+return result('removed')
+""")
+
+def run_user_script(script, user_id, cg_id="", *args):
+    """(status, fields, sent, مقدار قبلی ارز) — وضعیت تازه کاربر تو کش تنظیمات هم نوشته میشه"""
+    shard = shard_of(user_id)
+    keys = [user_key(user_id), sent_key(user_id), due_key(shard), alerts_key(shard), TRACKED_KEY, USERS_COUNT_KEY]
+    with REDIS_OPS['user_op'].time():
+        status, fields, sent, before = script(keys=keys, args=[user_id, cg_id, time.time(), *args])
+    fields, sent = pairs(fields), pairs(sent)
+    settings_cache.put(user_id, fields, sent)
+    return status, fields, sent, before
+
+def user_op(script, user_id, cg_id, *args):
+    """(status, settings, ارز قبل از تغییر یا None)"""
+    status, fields, sent, before = run_user_script(script, user_id, cg_id, *args)
+    return status, parse_settings(fields, sent), decode_item(before)[1] if before else None
+
+def alert_event(user_id, cg_id, alert=None, currency=BASE_CURRENCY):
+    event = {'from': WORKER_ID, 'user_id': user_id, 'cg_id': cg_id, 'op': None}
+    if alert:
+        event.update(op=alert['op'], price=alert['price'], window=alert.get('window'), currency=currency)
+    return json.dumps(event)
+
+def currency_arg(currency):
+    return '' if currency == BASE_CURRENCY else currency
+
+def create_user(user_id):
+    """True اگه کاربر تازه ثبت شد"""
+    return run_user_script(CREATE_USER, user_id)[0] == 'created'
+
+def add_user_coin(user_id, cg_id, symbol, period=15, currency=BASE_CURRENCY):
+    """status: added | exists | full"""
+    status, settings, _ = user_op(ADD_COIN, user_id, cg_id, symbol, period, MAX_COINS, currency_arg(currency))
+    if status == 'added':
+        checker_wakeup.set()
+    return status, settings
+
+def set_user_coin_period(user_id, cg_id, period):
+    status, settings, _ = user_op(SET_PERIOD, user_id, cg_id, period)
+    checker_wakeup.set()
+    return status, settings
+
+def alert_columns(alert):
+    """ستون‌های op، price و window رکورد encode_item برای این هشدار"""
+    return encode_item({'symbol': '', 'alert': alert}, 0).split("|", 7)[4:7]
+
+def set_user_coin_alert(user_id, cg_id, alert, currency=BASE_CURRENCY):
+    """status: ok | missing | changed (واحد پول ارز همین الان عوض شده)؛ price هشدار به واحد currency"""
+    values = alert_values(alert, currency)
+    status, settings, _ = user_op(
+        SET_ALERT, user_id, cg_id, *alert_columns(alert), currency_arg(currency), json.dumps(values),
+        ALERTS_CHANNEL, alert_event(user_id, cg_id, alert, currency)
+    )
+    if status == 'ok' and shard_of(user_id) in shard_manager.owned:
+        alert_index.set(user_id, cg_id, *values)
+    return status, settings
+
+async def set_user_coin_currency(user_id, cg_id, currency):
+    """(status, settings, هشدار تبدیل‌شده یا None) — status: ok | missing | noprice | changed
+
+    هشدار قیمتی (>= / <=) با نسبت قیمت فعلی ارز در دو واحد به واحد جدید تبدیل میشه (۶ رقم
+    معنی‌دار)؛ اگه قیمت یکی از دو واحد در دسترس نباشه واحد عوض نمیشه (noprice).
+    """
+    item = next((i for i in get_user_data(user_id) if i['cg_id'] == cg_id), None)
+    if item is None:
+        return 'missing', get_user_data(user_id), None
+    old = item.get('currency', BASE_CURRENCY)
+    alert = item.get('alert')
+    converted = None
+    if alert and alert['op'] != '%' and currency != old:
+        old_price, new_price = await asyncio.gather(get_price(cg_id, old), get_price(cg_id, currency))
+        if not old_price or not new_price:
+            return 'noprice', get_user_data(user_id), None
+        converted = dict(alert, price=float(f"{alert['price'] * new_price / old_price:.6g}"))
+    elif alert and alert['op'] != '%':
+        converted = alert
+    values = alert_values(converted, currency) if converted else []
+    status, settings, _ = user_op(
+        SET_CURRENCY, user_id, cg_id, currency_arg(currency), currency_arg(old),
+        alert_columns(converted)[1] if converted else '', json.dumps(values),
+        ALERTS_CHANNEL, alert_event(user_id, cg_id, converted, currency)
+    )
+    if status == 'ok' and converted and shard_of(user_id) in shard_manager.owned:
+        alert_index.set(user_id, cg_id, *values)
+    return status, settings, converted if status == 'ok' and currency != old else None
+
+def clear_user_coin_alert(user_id, cg_id):
+    status, settings, _ = user_op(CLEAR_ALERT, user_id, cg_id, ALERTS_CHANNEL, alert_event(user_id, cg_id))
+    if status == 'ok':
+        alert_index.remove(user_id, cg_id)
+        checker_wakeup.set()
+    return status, settings
+
+def remove_user_coin(user_id, cg_id):
+    """(status, settings, ارز حذف‌شده یا None)"""
+    status, settings, removed = user_op(REMOVE_COIN, user_id, cg_id, ALERTS_CHANNEL, alert_event(user_id, cg_id))
+    alert_index.remove(user_id, cg_id)
+    return status, settings, removed
+
+# کاربرانی که پیام بهشون نمیرسه (ربات رو بلاک کردن، حسابشون پاک شده یا چت وجود نداره): ورودی‌های due و
+# هشدارهاشون حذف میشه ولی تنظیماتشون می‌مونه و با /start بعدی دوباره زمان‌بندی میشن.
+UNDELIVERABLE_KEY = "undeliverable"
+
+def undeliverable(error):
+    """خطاهای ارسالی که با تکرار درست نمیشن"""
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and 'chat not found' in error.message.lower())
+
+def pause_users(users):
+    """[(user_id, settings), ...] — حذف از ایندکس due و هشدارها تا کاربر دوباره /start بزنه"""
+    pipe = r.pipeline(transaction=False)
+    for user_id, settings in users:
+        shard = shard_of(user_id)
+        pipe.sadd(UNDELIVERABLE_KEY, user_id)
+        for item in settings:
+            member = f"{user_id}:{item['cg_id']}"
+            if 'alert' in item:
+                pipe.hdel(alerts_key(shard), member)
+                pipe.publish(ALERTS_CHANNEL, alert_event(user_id, item['cg_id']))
+                alert_index.remove(user_id, item['cg_id'])
+            else:
+                pipe.zrem(due_key(shard), member)
+    with REDIS_OPS['reschedule'].time():
+        pipe.execute()
+    logger.info(f"{len(users)} کاربر پیام دریافت نمی‌کنن؛ ارسال‌هاشون تا /start بعدی متوقف شد")
+
+def resume_user(user_id):
+    """کاربر متوقف‌شده (pause_users) برگشته: ارزها و هشدارهاش دوباره زمان‌بندی میشن"""
+    if not r.srem(UNDELIVERABLE_KEY, user_id):
+        return
+    shard = shard_of(user_id)
+    pipe = r.pipeline(transaction=False)
+    for item in get_user_data(user_id):
+        member = f"{user_id}:{item['cg_id']}"
+        if 'alert' in item:
+            currency = item.get('currency', BASE_CURRENCY)
+            values = alert_values(item['alert'], currency)
+            pipe.hset(alerts_key(shard), member, json.dumps(values))
+            pipe.publish(ALERTS_CHANNEL, alert_event(user_id, item['cg_id'], item['alert'], currency))
+            if shard in shard_manager.owned:
+                alert_index.set(user_id, item['cg_id'], *values)
+        else:
+            pipe.zadd(due_key(shard), {member: next_send_time(item)}, nx=True)
+    pipe.execute()
+    checker_wakeup.set()
+
+INDEX_META_KEY = "index:shards"  # تعداد شاردهایی که ایندکس‌ها باهاش ساخته شدن
+
+def indexes_ready():
+    return r.get(INDEX_META_KEY) == str(CHECKER_SHARDS)
+
+def rebuild_indexes():
+    """یک SCAN روی همه کاربران و ساخت دوباره ایندکس due، هش alerts و هش tracked
+
+    فقط وقتی لازمه که ایندکس‌ها هنوز ساخته نشدن یا تعداد شاردها عوض شده (indexes_ready).
+    """
+    previous = r.get(INDEX_META_KEY)
+    old_keys = ["due", TRACKED_KEY]  # "due": ایندکس قدیمی بدون شارد
+    if previous:
+        old_keys += [key for shard in range(int(previous)) for key in (due_key(shard), alerts_key(shard))]
+    r.delete(*old_keys)
+
+    tracked = {}
+    users = due_count = alert_count = 0
+    for batch in iter_user_batches():
+        users += len(batch)
+        pipe = r.pipeline(transaction=False)
+        for user_id, settings in batch:
+            shard = shard_of(user_id)
+            for item in settings:
+                tracked[item['cg_id']] = tracked.get(item['cg_id'], 0) + 1
+                member = f"{user_id}:{item['cg_id']}"
+                if 'alert' in item:
+                    # ارزهای هشدار‌دار با alert_index چک میشن نه ایندکس due
+                    pipe.hset(alerts_key(shard), member, json.dumps(alert_values(item['alert'], item.get('currency', BASE_CURRENCY))))
+                    alert_count += 1
+                else:
+                    pipe.zadd(due_key(shard), {member: next_send_time(item)}, nx=True)
+                    due_count += 1
+        pipe.execute()
+    if tracked:
+        r.hset(TRACKED_KEY, mapping=tracked)
+    r.set(USERS_COUNT_KEY, users)
+    r.set(INDEX_META_KEY, CHECKER_SHARDS)
+    logger.info(f"ایندکس‌ها ساخته شد: {due_count} ارز due، {alert_count} هشدار، {len(tracked)} ارز تحت نظر، {CHECKER_SHARDS} شارد")
+
+async def ensure_indexes():
+    """فقط یک پروسه ایندکس‌ها رو می‌سازه؛ بقیه صبر می‌کنن تا آماده بشه"""
+    lock = Lease("rebuild", ttl=600)
+    if not r.exists(USERS_COUNT_KEY) and await lock.acquire():
+        # شمارنده کاربران برای متریک‌ها؛ فقط بار اول (بعدش start و rebuild به‌روزش نگه می‌دارن)
+        try:
+            r.set(USERS_COUNT_KEY, sum(1 for _ in r.scan_iter(match="user:*", count=1000)), nx=True)
+        finally:
+            await lock.release()
+    while not indexes_ready():
+        if await lock.acquire():
+            try:
+                if not indexes_ready():
+                    rebuild_indexes()
+            finally:
+                await lock.release()
+        else:
+            await asyncio.sleep(1)
+
+async def run_shard_manager():
+    """هر LEASE_TTL/3 ثانیه lease ها تمدید و شاردها بین worker ها متعادل میشن"""
+    while True:
+        try:
+            gained, lost = await shard_manager.rebalance()
+            dispatcher.share(shard_manager.live)
+            for shard in lost:
+                alert_index.drop_shard(shard)
+            for shard in gained:
+                load_alert_shard(shard)
+            if gained or lost:
+                logger.info(f"شاردها: {sorted(shard_manager.owned)} (جدید: {gained}، از دست رفته: {lost})")
+                checker_wakeup.set()
+        except Exception as e:
+            logger.error(f"خطا در تمدید lease ها: {e}", exc_info=True)
+        await asyncio.sleep(LEASE_TTL / 3)
+
+async def listen_events(prices_only=False):
+    """پیام‌های بقیه پروسه‌ها: قیمت‌های تازه price feed و تغییر هشدارها
+
+    prices_only: فقط کانال prices و فقط برای snapshot (پروسه web، برای inline mode)
+    """
+    while True:
+        try:
+            ar = aioredis.from_url(UPSTASH_REDIS_URL, decode_responses=True, **REDIS_TLS)
+            pubsub = ar.pubsub()
+            await pubsub.subscribe(*((PRICES_CHANNEL,) if prices_only else (PRICES_CHANNEL, ALERTS_CHANNEL)))
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                data = json.loads(message['data'])
+                if data.get('from') == WORKER_ID:
+                    continue
+                if prices_only:
+                    price_feed.mirror(data['prices'])
+                elif message['channel'] == PRICES_CHANNEL:
+                    price_feed.publish(data['prices'])
+                elif shard_of(data['user_id']) in shard_manager.owned:
+                    if data['op'] is None:
+                        alert_index.remove(data['user_id'], data['cg_id'])
+                    else:
+                        alert_index.set(data['user_id'], data['cg_id'], data['op'], data['price'], data.get('window'),
+                                        data.get('currency', BASE_CURRENCY))
+        except Exception as e:
+            logger.error(f"خطا در pub/sub: {e}")
+            await asyncio.sleep(5)
+
+# --- محدودیت نرخ ---
+class TokenBucket:
+    """token bucket ساده: rate توکن در ثانیه، حداکثر capacity توکن"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """یک توکن رزرو می‌کنه و برمی‌گردونه چند ثانیه باید صبر کرد تا بشه ازش استفاده کرد"""
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        """پس دادن توکنی که reserve شده ولی استفاده نشد"""
+        self.tokens += 1
+
+    def penalize(self, seconds):
+        """بعد از RetryAfter: تا seconds ثانیه هیچ توکنی در دسترس نیست"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class RateGovernor(TokenBucket):
+    """بودجه مشترک همه درخواست‌های یک provider که از 429 ها یاد می‌گیره
+
+    نرخ از max_rate شروع میشه؛ هر 429 نرخ رو نصف می‌کنه (حداقل min_rate) و تا Retry-After (یا
+    cooldown ثانیه اگه هدر نداشت) هیچ توکنی نمیده. هر جواب موفق نرخ رو max_rate/20 بالا می‌بره،
+    پس بعد از محدود شدن، نرخ آروم آروم به سقف برمی‌گرده.
+    """
+
+    def __init__(self, rate, capacity, min_rate=None, cooldown=10):
+        super().__init__(rate, capacity)
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.cooldown = cooldown
+        self.throttled = 0
+
+    def success(self):
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def throttle(self, retry_after=None):
+        self.throttled += 1
+        self._refill()
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.penalize(self.cooldown if retry_after is None else retry_after)
+
+
+class CircuitBreaker:
+    """بعد از threshold خطای پشت سر هم باز میشه و درخواست‌ها بدون تماس با provider رد میشن
+
+    reset_after ثانیه بعد فقط یک درخواست آزمایشی رد میشه (half-open): موفق باشه بسته میشه، خطا
+    بده دوباره باز میشه. 429 خطا حساب نمیشه (سرور سالمه، فقط محدودمون کرده؛ کار RateGovernor ـه).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, threshold=5, reset_after=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.opens = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_after:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def release(self):
+        """درخواست آزمایشی بدون نتیجه لغو شد؛ درخواست بعدی دوباره امتحان می‌کنه"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"circuit {self.name} دوباره بسته شد")
+        self.state, self.failures = self.CLOSED, 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.opens += 1
+            logger.warning(f"circuit {self.name} باز شد بعد از {self.failures} خطا؛ {self.reset_after} ثانیه بدون درخواست")
+            self.state, self.opened_at = self.OPEN, time.monotonic()
+
+# --- منابع قیمت (async) ---
+# همه درخواست‌های قیمت (price feed و get_price) از price_source رد میشن. هر provider یک RateGovernor
+# مشترک و یک CircuitBreaker داره؛ اگه CoinGecko کند باشه، 429 بده یا circuit ـش باز باشه، همون
+# درخواست به provider دوم (PRICE_FALLBACK) هم فرستاده میشه (hedge) و اولین جواب استفاده میشه.
+COINGECKO_API_URL = os.environ.get("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+COINGECKO_RATE = float(os.environ.get("COINGECKO_RATE", 0.5))  # درخواست در ثانیه (پلن رایگان ≈ ۳۰ در دقیقه)
+PRICE_FALLBACK = os.environ.get("PRICE_FALLBACK", "")  # coincap | coingecko (مثلاً Pro با کلید جدا) | خالی = خاموش
+PRICE_FALLBACK_URL = os.environ.get("PRICE_FALLBACK_URL", "")
+PRICE_FALLBACK_KEY = os.environ.get("PRICE_FALLBACK_KEY", "")
+PRICE_FALLBACK_RATE = float(os.environ.get("PRICE_FALLBACK_RATE", 0.5))
+PRICE_HEDGE_DELAY = float(os.environ.get("PRICE_HEDGE_DELAY", 0))  # 0: p95 تأخیر اخیر CoinGecko
+
+class ProviderError(Exception):
+    """provider قیمت جواب قابل استفاده نداد"""
+
+class RateLimited(ProviderError):
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider}: rate limited ({retry_after:.1f}s)")
+        self.retry_after = retry_after
+
+def retry_after_seconds(value):
+    """هدر Retry-After (ثانیه یا تاریخ HTTP) -> ثانیه، یا None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class PriceProvider:
+    """یک API قیمت: connection pool دائمی (keep-alive)، RateGovernor و CircuitBreaker خودش
+
+    زیرکلاس‌ها فقط request (ساختن درخواست) و parse (جواب -> {cg_id: price}) رو پیاده می‌کنن.
+    """
+
+    name = "provider"
+
+    def __init__(self, base_url, rate, burst=5, api_key="", max_connections=20, max_keepalive=10):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=60
+        )
+        self._client = None
+        self.governor = RateGovernor(rate, burst)
+        self.breaker = CircuitBreaker(self.name)
+        self.latencies = deque(maxlen=50)  # ثانیه، فقط جواب‌های موفق
+        self.seconds = PROVIDER_SECONDS.labels(self.name)
+        self.results = {result: PROVIDER_REQUESTS.labels(self.name, result) for result in ('ok', 'throttled', 'error', 'skipped')}
+
+    def headers(self):
+        return {"User-Agent": "CryptoBot/1.0"}
+
+    @property
+    def client(self):
+        # ساخت تنبل، تا کلاینت داخل همان loop اصلی ساخته شود
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers(),
+                limits=self.limits,
+                timeout=httpx.Timeout(10, connect=5)
+            )
+        return self._client
+
+    def request(self, cg_ids):
+        raise NotImplementedError
+
+    def parse(self, data, cg_ids):
+        raise NotImplementedError
+
+    def reserve(self, max_wait):
+        """ثانیه‌های انتظار تا نوبت درخواست در RateGovernor
+
+        اگه بیشتر از max_wait باشه RateLimited و اگه circuit بازه ProviderError؛ در هر دو حالت
+        توکنی مصرف نمیشه و هیچ درخواستی نمیره.
+        """
+        wait = self.governor.reserve()
+        if wait > max_wait:
+            self.governor.refund()
+            self.results['skipped'].inc()
+            raise RateLimited(self.name, wait)
+        if not self.breaker.allow():
+            self.governor.refund()
+            self.results['skipped'].inc()
+            raise ProviderError(f"{self.name}: circuit open")
+        return wait
+
+    async def fetch(self, cg_ids, deadline=8, wait=0):
+        """بعد از reserve: wait ثانیه صبر و بعد یک درخواست با مهلت deadline — خروجی: {cg_id: price}"""
+        try:
+            await asyncio.sleep(wait)
+            started = time.perf_counter()
+            with self.seconds.time():
+                resp = await asyncio.wait_for(self.request(cg_ids), timeout=deadline)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self.breaker.failure()
+            self.results['error'].inc()
+            raise ProviderError(f"{self.name}: {e!r}") from e
+        if resp.status_code == 429:
+            retry_after = retry_after_seconds(resp.headers.get("Retry-After"))
+            self.governor.throttle(retry_after)
+            self.breaker.success()
+            self.results['throttled'].inc()
+            logger.warning(f"{self.name}: HTTP 429؛ نرخ به {self.governor.rate:.3g} درخواست در ثانیه کم شد")
+            raise RateLimited(self.name, self.governor.cooldown if retry_after is None else retry_after)
+        error = None
+        if resp.status_code != 200:
+            error = ProviderError(f"{self.name}: HTTP {resp.status_code}")
+        else:
+            try:
+                prices = self.parse(resp.json(), cg_ids)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                error = ProviderError(f"{self.name}: bad response {e!r}")
+        if error is not None:
+            self.breaker.failure()
+            self.results['error'].inc()
+            raise error
+        self.latencies.append(time.perf_counter() - started)
+        self.governor.success()
+        self.breaker.success()
+        self.results['ok'].inc()
+        return prices
+
+    def status(self):
+        return {
+            'rate': round(self.governor.rate, 4), 'throttled': self.governor.throttled,
+            'circuit': self.breaker.state, 'circuit_opens': self.breaker.opens,
+            'p95_ms': round(percentile(self.latencies, 0.95) * 1000, 1) if self.latencies else None,
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+class CoinGeckoProvider(PriceProvider):
+    """/simple/price با همه QUOTE_CURRENCIES در یک درخواست؛ با api_key (مثلاً pro-api.coingecko.com) سهمیه جدا داره"""
+
+    name = "coingecko"
+
+    def headers(self):
+        headers = super().headers()
+        if self.api_key:
+            headers["x-cg-pro-api-key"] = self.api_key
+        return headers
+
+    def request(self, cg_ids):
+        return self.client.get("/simple/price", params={"ids": ','.join(cg_ids), "vs_currencies": ','.join(QUOTE_CURRENCIES)})
+
+    def parse(self, data, cg_ids):
+        return {
+            quote_key(cg_id, currency): quotes[currency]
+            for cg_id in cg_ids if (quotes := data.get(cg_id))
+            for currency in QUOTE_CURRENCIES if currency in quotes
+        }
+
+class CoinCapProvider(PriceProvider):
+    """CoinCap (/v3/assets): شناسه ارزهای بزرگ همون cg_id ـه (جز چندتا در ALIASES)؛ بقیه تو جواب نمیان
+
+    فقط قیمت دلاری میده؛ بقیه واحدها رو PriceSource با نرخ تبدیل آخرین جواب CoinGecko می‌سازه.
+    """
+
+    name = "coincap"
+    ALIASES = {'binancecoin': 'binance-coin', 'avalanche-2': 'avalanche'}
+
+    def headers(self):
+        headers = super().headers()
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def request(self, cg_ids):
+        ids = [self.ALIASES.get(cg_id, cg_id) for cg_id in cg_ids]
+        return self.client.get("/assets", params={"ids": ','.join(ids), "limit": len(ids)})
+
+    def parse(self, data, cg_ids):
+        wanted = {self.ALIASES.get(cg_id, cg_id): cg_id for cg_id in cg_ids}
+        return {
+            wanted[asset['id']]: float(asset['priceUsd'])
+            for asset in data['data'] if asset.get('id') in wanted and asset.get('priceUsd')
+        }
+
+PRICE_PROVIDERS = {'coingecko': CoinGeckoProvider, 'coincap': CoinCapProvider}
+PROVIDER_URLS = {'coingecko': "https://pro-api.coingecko.com/api/v3", 'coincap': "https://rest.coincap.io/v3"}
+
+class PriceSource:
+    """CoinGecko و (اختیاری) یک provider دوم با hedge
+
+    - اگه primary الان نمیشه (circuit باز یا نوبتش دیرتر از max_wait) یا خطا/429 بده، همون لحظه
+    - اگه تا hedge_delay بعد از رفتن درخواست جواب نیاد (پیش‌فرض p95 تأخیر اخیرش)
+    همون درخواست به fallback هم فرستاده میشه. جواب primary همیشه قبول میشه؛ جواب fallback اگه
+    همه ارزها رو داشته باشه (یا primary شکست بخوره) و وگرنه با جواب primary ادغام میشه.
+    خروجی با کلیدهای quote_key ـه؛ واحدهایی که fallback نداره با fx (نرخ هر واحد به دلار، از
+    آخرین جواب primary) از قیمت دلاری ساخته میشن.
+    """
+
+    def __init__(self, primary, fallback=None, hedge_delay=0):
+        self.primary = primary
+        self.fallback = fallback
+        self.fixed_hedge_delay = hedge_delay
+        self.fx = {}  # currency -> واحد به ازای هر دلار
+        self.stats = {'requests': 0, 'hedged': 0, 'fallback': 0, 'failed': 0}
+
+    @property
+    def providers(self):
+        return [provider for provider in (self.primary, self.fallback) if provider is not None]
+
+    def hedge_delay(self):
+        if self.fixed_hedge_delay:
+            return self.fixed_hedge_delay
+        if len(self.primary.latencies) < 5:
+            return 1.0
+        # سقف ۱ ثانیه: اگه CoinGecko مدام کنده، p95 هم کند میشه و hedge نباید همراهش عقب بره
+        return min(1.0, max(0.2, percentile(self.primary.latencies, 0.95)))
+
+    def _learn_fx(self, prices):
+        for currency in QUOTE_CURRENCIES[1:]:
+            ratios = [
+                prices[key] / price for cg_id, price in base_prices(prices).items()
+                if price and (key := quote_key(cg_id, currency)) in prices
+            ]
+            if ratios:
+                self.fx[currency] = percentile(ratios, 0.5)
+        return prices
+
+    def _with_fx(self, prices):
+        for cg_id, price in base_prices(prices).items():
+            for currency, rate in self.fx.items():
+                prices.setdefault(quote_key(cg_id, currency), price * rate)
+        return prices
+
+    def _start(self, provider, cg_ids, deadline, max_wait, errors):
+        try:
+            wait = provider.reserve(max_wait)
+        except ProviderError as e:
+            errors.append(e)
+            return None, 0
+        return asyncio.ensure_future(provider.fetch(cg_ids, deadline, wait)), wait
+
+    async def fetch(self, cg_ids, deadline=8, max_wait=None):
+        """{cg_id: price} — ProviderError اگه هیچ providerـی جواب نداد
+
+        deadline مهلت هر درخواست HTTP ـه؛ max_wait (پیش‌فرض deadline/2) حداکثر صبر برای نوبت RateGovernor.
+        """
+        self.stats['requests'] += 1
+        max_wait = deadline / 2 if max_wait is None else max_wait
+        errors, tasks = [], []
+        try:
+            primary, wait = self._start(self.primary, cg_ids, deadline, max_wait, errors)
+            if primary is not None:
+                tasks.append(primary)
+                if self.fallback is None:
+                    return self._learn_fx(await primary)
+                await asyncio.wait([primary], timeout=wait + self.hedge_delay())
+                if primary.done():
+                    if primary.exception() is None:
+                        return self._learn_fx(primary.result())
+                    errors.append(primary.exception())
+            if self.fallback is not None:
+                self.stats['hedged'] += 1
+                hedge, _ = self._start(self.fallback, cg_ids, deadline, max_wait, errors)
+                if hedge is not None:
+                    tasks.append(hedge)
+
+            prices = {}
+            pending = {task for task in tasks if not task.done()}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif task is primary:
+                        return {**prices, **self._learn_fx(task.result())}
+                    else:
+                        prices.update(self._with_fx(task.result()))
+                if prices and (primary not in pending or all(cg_id in prices for cg_id in cg_ids)):
+                    self.stats['fallback'] += 1
+                    return prices
+            if prices:
+                self.stats['fallback'] += 1
+                return prices
+            raise errors[-1] if errors else ProviderError("no price provider")
+        except ProviderError:
+            self.stats['failed'] += 1
+            raise
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # جواب بازنده هم خونده میشه تا لاگ "never retrieved" نده
+
+    def status(self):
+        return {
+            'hedge_delay': round(self.hedge_delay(), 3), **self.stats, 'fx': self.fx,
+            'providers': {provider.name: provider.status() for provider in self.providers},
+        }
+
+    async def aclose(self):
+        for provider in self.providers:
+            await provider.aclose()
+
+def make_price_source():
+    primary = CoinGeckoProvider(COINGECKO_API_URL, COINGECKO_RATE)
+    fallback = None
+    if PRICE_FALLBACK:
+        fallback = PRICE_PROVIDERS[PRICE_FALLBACK](
+            PRICE_FALLBACK_URL or PROVIDER_URLS[PRICE_FALLBACK], PRICE_FALLBACK_RATE, api_key=PRICE_FALLBACK_KEY
+        )
+    return PriceSource(primary, fallback, PRICE_HEDGE_DELAY)
+
+price_source = make_price_source()
+
+# --- کش قیمت ---
+PRICE_TTL = 55  # عمر کلید price:{cg_id} در Redis
+
+class PriceCache:
+    """کش داخل پروسه (L1) جلوی کلیدهای price:{cg_id} در Redis (L2)
+
+    - TTL + LRU با حداکثر maxsize ارز
+    - تا ttl ثانیه تازه؛ تا stale_ttl ثانیه قیمت قدیمی برگردونده میشه و در پس‌زمینه تازه میشه
+    - single-flight: درخواست‌های همزمان برای یک ارز فقط یک fetch مشترک دارن
+    """
+
+    def __init__(self, ttl=20, stale_ttl=300, maxsize=5000):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # cg_id -> (price, timestamp)
+        self._inflight = {}  # cg_id -> Future
+        self.stats = {'hits': 0, 'stale_hits': 0, 'redis_hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def put(self, cg_id, price, timestamp=None):
+        self._entries[cg_id] = (price, time.time() if timestamp is None else timestamp)
+        self._entries.move_to_end(cg_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def items(self):
+        """[(cg_id, price, timestamp), ...] از قدیمی به جدید (برای snapshot)"""
+        return [(cg_id, price, timestamp) for cg_id, (price, timestamp) in self._entries.items()]
+
+    def peek(self, cg_id):
+        """(price, age) یا None — فقط تا stale_ttl"""
+        entry = self._entries.get(cg_id)
+        if entry is None:
+            return None
+        price, timestamp = entry
+        age = time.time() - timestamp
+        if age >= self.stale_ttl:
+            del self._entries[cg_id]
+            return None
+        self._entries.move_to_end(cg_id)
+        return price, age
+
+    async def get(self, cg_id, loader):
+        cached = self.peek(cg_id)
+        if cached is not None:
+            price, age = cached
+            if age < self.ttl:
+                self.stats['hits'] += 1
+            else:
+                self.stats['stale_hits'] += 1
+                self.refresh(cg_id, loader)
+            return price
+        self.stats['misses'] += 1
+        return await self.single_flight(cg_id, loader)
+
+    def refresh(self, cg_id, loader):
+        if cg_id not in self._inflight:
+            self.single_flight(cg_id, loader)
+
+    def single_flight(self, cg_id, loader):
+        fut = self._inflight.get(cg_id)
+        if fut is not None:
+            self.stats['coalesced'] += 1
+        else:
+            fut = self._inflight[cg_id] = asyncio.ensure_future(loader(cg_id))
+            fut.add_done_callback(lambda _: self._inflight.pop(cg_id, None))
+        # shield: لغو شدن یک منتظر، fetch مشترک بقیه رو لغو نمی‌کنه
+        return asyncio.shield(fut)
+
+price_cache = PriceCache()
+
+async def get_redis_price(key):
+    try:
+        with REDIS_OPS['get_price'].time():
+            cached = await ar.get(f"price:{key}")
+        if cached:
+            cached = json.loads(cached)
+            price_cache.put(key, cached['price'], cached.get('timestamp'))
+            return cached['price']
+    except Exception:
+        pass
+    return None
+
+async def get_cached_price(key):
+    """key همون quote_key ـه (برای دلار خود cg_id)"""
+    cached = price_cache.peek(key)
+    if cached is not None:
+        return cached[0]
+    return await get_redis_price(key)
+
+async def cache_prices(prices):
+    """قیمت‌های تازه تو هر دو لایه کش"""
+    now = time.time()
+    pipe = ar.pipeline(transaction=False)
+    for key, price in prices.items():
+        price_cache.put(key, price, now)
+        pipe.setex(f"price:{key}", PRICE_TTL, json.dumps({"price": price, "timestamp": now}))
+    await pipe.execute()
+
+async def load_price(key):
+    """L2 (Redis) و بعد price_source — فقط از طریق price_cache صدا زده میشه
+
+    درخواست upstream همه واحدهای ارز رو با هم میاره و همه‌شون کش میشن، پس بقیه واحدهای همون ارز
+    بعدش از کش جواب داده میشن.
+    """
+    price = await get_redis_price(key)
+    if price is not None:
+        price_cache.stats['redis_hits'] += 1
+        return price
+
+    cg_id, _ = split_quote(key)
+    try:
+        # کاربر منتظره: اگه نوبت CoinGecko بیشتر از ۱ ثانیه دیگه‌ست مستقیم سراغ fallback
+        prices = await price_source.fetch([cg_id], deadline=8, max_wait=1)
+    except ProviderError:
+        return None
+    if prices:
+        await cache_prices(prices)
+        price_feed.publish(prices)
+    return prices.get(key)
+
+async def get_price(cg_id, currency=BASE_CURRENCY):
+    key = quote_key(cg_id, currency)
+    price = await price_cache.get(key, load_price)
+    if price is None:
+        # CoinGecko در دسترس نیست — قیمت قدیمی بهتر از هیچیه
+        price = await get_cached_price(key)
+    return price
+
+async def fetch_prices(cg_ids, deadline=12, max_wait=None):
+    """قیمت همه ارزها (همه واحدها) با یک درخواست — خروجی: {quote_key: price}"""
+    prices = {}
+    if not cg_ids:
+        return prices
+    try:
+        prices = await price_source.fetch(sorted(cg_ids), deadline=deadline, max_wait=max_wait)
+    except ProviderError as e:
+        logger.warning(f"Batch price fetch failed: {e}")
+    if prices:
+        await cache_prices(prices)
+    return prices
+
+# --- ارسال پیام (صف + محدودیت نرخ) ---
+class MessageDispatcher:
+    """همه send_message ها از این صف رد میشن
+
+    - صف محدود (اگه پر باشه، فرستنده صبر می‌کنه)
+    - چند worker همزمان
+    - محدودیت نرخ کلی و محدودیت نرخ هر چت (محدودیت‌های flood تلگرام)
+    - RetryAfter → کل ارسال‌ها به اندازه retry_after متوقف و پیام دوباره صف میشه
+    - آمار ارسال در self.stats
+    """
+
+    INTERACTIVE = 0  # جواب مستقیم به کاربر — جلوتر از پیام‌های دوره‌ای
+    BULK = 1
+
+    def __init__(self, workers=8, maxsize=10000, global_rate=25, global_burst=3, chat_rate=1, chat_burst=3, max_retries=3):
+        self.workers = workers
+        self.maxsize = maxsize
+        # تو هر بازه یک‌ثانیه‌ای حداکثر global_rate + global_burst پیام میره (سقف تلگرام ۳۰)
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.bot = None
+        self._queue = None
+        self._tasks = []
+        self._chat_buckets = {}
+        self._seq = 0
+        self.stats = {
+            'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0,
+            'latency_total': 0.0, 'latency_max': 0.0
+        }
+
+    async def start(self, bot):
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def pending(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def share(self, processes):
+        """سقف کلی برای کل ربات‌ه: بین processes تا worker که همزمان digest می‌فرستن تقسیم میشه
+
+        سهم هر worker از global_rate + global_burst پیام در ثانیه بین burst (حداقل یک توکن) و نرخ تقسیم میشه.
+        """
+        processes = max(processes, 1)
+        budget = (self.global_rate + self.global_burst) / processes
+        bucket = self.global_bucket
+        bucket._refill()
+        bucket.capacity = max(self.global_burst / processes, 1)
+        bucket.rate = max(budget - bucket.capacity, budget / 2)
+        bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    async def submit(self, chat_id, text, priority=BULK, **kwargs):
+        """پیام رو صف می‌کنه و یک Future برمی‌گردونه (نتیجه: Message یا خطا)"""
+        fut = asyncio.get_running_loop().create_future()
+        # اگه کسی منتظر نتیجه نباشه، خطای Future لاگ "never retrieved" نمیده
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        job = {'chat_id': chat_id, 'text': text, 'kwargs': kwargs, 'future': fut,
+               'attempt': 0, 'reserved': False, 'enqueued': time.monotonic()}
+        await self._put(priority, job)
+        self.stats['queued'] += 1
+        return fut
+
+    async def send(self, chat_id, text, priority=INTERACTIVE, **kwargs):
+        """ارسال و صبر تا تحویل — ترتیب پیام‌های پشت سر هم یک هندلر حفظ میشه"""
+        return await (await self.submit(chat_id, text, priority, **kwargs))
+
+    async def _put(self, priority, job):
+        self._seq += 1
+        job['priority'] = priority
+        await self._queue.put((priority, self._seq, job))
+
+    async def _put_later(self, delay, job):
+        await asyncio.sleep(delay)
+        await self._put(job['priority'], job)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # bucket های پر (چت‌های بیکار) چیزی رو محدود نمی‌کنن
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_full()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.error(f"خطای dispatcher: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job):
+        fut = job['future']
+        if fut.done():
+            return
+        chat_id = job['chat_id']
+
+        # محدودیت هر چت: به جای نگه داشتن worker، پیام بعداً دوباره صف میشه
+        if not job['reserved']:
+            wait = self._chat_bucket(chat_id).reserve()
+            job['reserved'] = True
+            if wait > 0:
+                asyncio.create_task(self._put_later(wait, job))
+                return
+
+        # توکن فقط وقتی برداشته میشه که همین الان موجوده؛ با رزرو جلوتر، بعد از مکث loop همه ارسال‌های
+        # عقب‌افتاده با هم می‌رفتن. اینطوری تو هر ثانیه حداکثر capacity + rate پیام میره
+        while (wait := self.global_bucket.reserve()) > 0:
+            self.global_bucket.refund()
+            await asyncio.sleep(wait)
+        try:
+            message = await self.bot.send_message(chat_id=chat_id, text=job['text'], **job['kwargs'])
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            self.stats['rate_limited'] += 1
+            self.global_bucket.penalize(retry_after)
+            self._retry(job, retry_after, e)
+            return
+        except (Forbidden, BadRequest) as e:
+            self._fail(job, e)
+            return
+        except (TimedOut, NetworkError) as e:
+            self._retry(job, 2 ** job['attempt'], e)
+            return
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        latency = time.monotonic() - job['enqueued']
+        SEND_SECONDS.observe(latency)
+        self.stats['sent'] += 1
+        self.stats['latency_total'] += latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        fut.set_result(message)
+
+    def _retry(self, job, delay, error):
+        if job['attempt'] >= self.max_retries:
+            self._fail(job, error)
+            return
+        job['attempt'] += 1
+        job['reserved'] = False
+        self.stats['retried'] += 1
+        asyncio.create_task(self._put_later(delay, job))
+
+    def _fail(self, job, error):
+        self.stats['failed'] += 1
+        logger.warning(f"ارسال پیام به {job['chat_id']} ناموفق: {error}")
+        if not job['future'].done():
+            job['future'].set_exception(error)
+
+dispatcher = MessageDispatcher()
+
+# --- price feed ---
+class PriceFeed:
+    """تسک مستقل که قیمت همه ارزهای تحت نظر رو تازه نگه می‌داره
+
+    - ارزها به تکه‌های محدود (تعداد و طول URL) تقسیم میشن
+    - تکه‌ها همزمان (حداکثر concurrency تا) گرفته میشن و هر کدوم تا یک دوره کامل منتظر نوبتش در
+      RateGovernor مشترک CoinGecko می‌مونه (همون بودجه‌ای که get_price هم ازش خرج می‌کنه)
+    - نتیجه هر تکه به محض رسیدن منتشر میشه: کش Redis/L1، هش price_snapshot و subscriber های داخل پروسه
+    - اگه بودجه یک دوره به همه تکه‌ها نرسه، دور بعد از اولین تکه جامونده شروع میشه (نه از اول
+      الفبا)، پس هیچ ارزی همیشه بی‌قیمت نمی‌مونه
+    """
+
+    def __init__(self, interval=60, chunk_size=100, max_url_chars=1800, concurrency=3):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.max_url_chars = max_url_chars
+        self.concurrency = concurrency
+        self.snapshot = {}
+        self.updated_at = 0
+        self._subscribers = []
+        self._resume = None  # اولین cg_id اولین تکه‌ای که دور قبل قیمت نگرفت
+
+    def subscribe(self, callback):
+        """callback(prices) با هر دسته قیمت تازه صدا زده میشه"""
+        self._subscribers.append(callback)
+
+    def publish(self, prices):
+        if not prices:
+            return
+        self.snapshot.update(prices)
+        self.updated_at = time.time()
+        for callback in self._subscribers:
+            try:
+                callback(prices)
+            except Exception as e:
+                logger.error(f"خطا در subscriber قیمت: {e}", exc_info=True)
+
+    def mirror(self, prices):
+        """فقط snapshot، بدون subscriber ها (پروسه‌ای که چک قیمت و تاریخچه نداره)"""
+        self.snapshot.update(prices)
+        self.updated_at = time.time()
+
+    def chunks(self, cg_ids):
+        chunk, length = [], 0
+        for cg_id in sorted(cg_ids):
+            if chunk and (len(chunk) >= self.chunk_size or length + len(cg_id) + 1 > self.max_url_chars):
+                yield chunk
+                chunk, length = [], 0
+            chunk.append(cg_id)
+            length += len(cg_id) + 1
+        if chunk:
+            yield chunk
+
+    def rotated(self, chunks):
+        """تکه‌ها از تکه‌ای که دور قبل جاموند (همون که _resume توش میفته) شروع میشن"""
+        if self._resume is None:
+            return chunks
+        start = bisect_right([chunk[0] for chunk in chunks], self._resume) - 1
+        return chunks[start:] + chunks[:start] if start > 0 else chunks
+
+    async def _fetch_chunk(self, i, chunk, semaphore):
+        async with semaphore:
+            return i, await fetch_prices(chunk, max_wait=self.interval)
+
+    async def refresh(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        chunks = self.rotated(list(self.chunks(tracked_coins())))
+        # تسک‌ها به همین ترتیب ساخته میشن تا نوبت semaphore (و بودجه) هم به همین ترتیب باشه
+        tasks = [asyncio.ensure_future(self._fetch_chunk(i, chunk, semaphore)) for i, chunk in enumerate(chunks)]
+        missed = []
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                i, prices = await next_result
+                if not prices:
+                    missed.append(i)
+                else:
+                    # برای بقیه پروسه‌ها: هش price_snapshot و کانال prices
+                    pipe = ar.pipeline(transaction=False)
+                    pipe.hset("price_snapshot", mapping=prices)
+                    price_history.save(pipe, prices)
+                    pipe.publish(PRICES_CHANNEL, json.dumps({'from': WORKER_ID, 'prices': prices}))
+                    await pipe.execute()
+                    self.publish(prices)
+        finally:
+            for task in tasks:
+                task.cancel()
+        self._resume = chunks[min(missed)][0] if missed else None
+        if missed:
+            logger.warning(
+                f"price feed: {len(missed)} از {len(chunks)} تکه تو این دوره قیمت نگرفت (بودجه CoinGecko کمه)؛ "
+                f"دور بعد از {self._resume} شروع میشه"
+            )
+
+    async def run(self):
+        """فقط پروسه‌ای که lease ‏feed رو داره از CoinGecko می‌گیره؛ بقیه از کانال prices دریافت می‌کنن"""
+        logger.info("price feed شروع شد")
+        while True:
+            if not shard_manager.feed_lease.held:
+                # lease با rebalance بعدی (یا مردن صاحب فعلی) به ما می‌رسه؛ تا یک دوره کامل صبر نمی‌کنیم
+                await asyncio.sleep(min(self.interval, LEASE_TTL / 3))
+                continue
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"خطا در price feed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+price_feed = PriceFeed()
+
+# --- تاریخچه قیمت (ring buffer) ---
+HISTORY_STEP = 60      # ثانیه؛ هم‌اندازه دوره price feed
+HISTORY_SLOTS = int(os.environ.get("HISTORY_SLOTS", 1500))  # ۱۵۰۰ دقیقه ≈ ۲۵ ساعت
+HISTORY_FIELDS = [('price', '<f4'), ('step', '<u4')]  # رکورد ۸ بایتی هر خونه
+MOVE_WINDOWS = [(15, "۱۵ دقیقه"), (60, "۱ ساعت"), (4 * 60, "۴ ساعت"), (24 * 60, "۲۴ ساعت")]
+
+def history_key(cg_id):
+    return f"history:{cg_id}"
+
+class PriceHistory:
+    """تاریخچه قیمت هر ارز در یک ring buffer با اندازه ثابت
+
+    هر ارز یک سطر از ماتریس (ارز × HISTORY_SLOTS) با رکوردهای ۸ بایتی (price float32،
+    step uint32) داره؛ خونه هر step همون step % HISTORY_SLOTS ـه و step ذخیره‌شده نشون میده
+    مقدار خونه مال کدوم دقیقه‌ست (خونه‌های کهنه خودبه‌خود نامعتبر میشن).
+    حافظه هر ارز: HISTORY_SLOTS × 8 بایت (پیش‌فرض ۱۲٬۰۰۰ بایت ≈ ۱۱.۷ KiB)، چه تو پروسه و چه
+    تو Redis (کلید history:{cg_id} با همین فرمت که با SETRANGE خونه به خونه نوشته میشه).
+    ظرفیت ماتریس دوبرابر میشه، پس در بدترین حالت دو برابر این مقدار برای هر ارز رزرو میشه.
+    """
+
+    def __init__(self, slots=HISTORY_SLOTS, step=HISTORY_STEP):
+        self.slots = slots
+        self.step = step
+        self._rows = {}  # cg_id -> سطر
+        self.dtype = None  # np.dtype(HISTORY_FIELDS)؛ با اولین سطر ساخته میشه (numpy تنبل)
+        self._data = None
+        self._last = None  # آخرین رکورد هر سطر
+        self.now_step = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def step_of(self, ts):
+        return int(ts // self.step)
+
+    def _grow(self, needed):
+        if self._data is None:
+            self.dtype = np.dtype(HISTORY_FIELDS)
+            self._data = np.zeros((0, self.slots), dtype=self.dtype)
+            self._last = np.zeros(0, dtype=self.dtype)
+        capacity = len(self._data)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 64)
+        data = np.zeros((capacity, self.slots), dtype=self.dtype)
+        data[:len(self._data)] = self._data
+        last = np.zeros(capacity, dtype=self.dtype)
+        last[:len(self._last)] = self._last
+        self._data, self._last = data, last
+
+    def _add_rows(self, cg_ids):
+        """سطر جدید برای ارزهای تازه؛ اگه تو Redis تاریخچه داشته باشن همون خونده میشه"""
+        self._grow(len(self._rows) + len(cg_ids))
+        try:
+            stored = rb.mget([history_key(cg_id) for cg_id in cg_ids])
+        except redis.RedisError as e:
+            logger.warning(f"خوندن تاریخچه قیمت از Redis ناموفق: {e}")
+            stored = [None] * len(cg_ids)
+        for cg_id, raw in zip(cg_ids, stored):
+            row = self._rows[cg_id] = len(self._rows)
+            if not raw:
+                continue
+            records = np.frombuffer(raw[:self.slots * self.dtype.itemsize], dtype=self.dtype)
+            self._data[row, :len(records)] = records
+            self._last[row] = records[np.argmax(records['step'])]
+
+    def record(self, prices, ts=None):
+        """price feed subscriber: قیمت‌های این step رو تو خونه‌هاشون می‌نویسه (فقط دلاری)"""
+        step = self.step_of(ts if ts is not None else time.time())
+        prices = base_prices(prices)
+        if not prices:
+            return
+        new = [cg_id for cg_id in prices if cg_id not in self._rows]
+        if new:
+            self._add_rows(new)
+        rows = np.fromiter((self._rows[cg_id] for cg_id in prices), dtype=np.intp, count=len(prices))
+        values = np.fromiter(prices.values(), dtype=np.float32, count=len(prices))
+        self._data['price'][rows, step % self.slots] = values
+        self._data['step'][rows, step % self.slots] = step
+        self._last['price'][rows] = values
+        self._last['step'][rows] = step
+        self.now_step = max(self.now_step, step)
+
+    def save(self, pipe, prices, ts=None):
+        """نوشتن خونه همین step برای هر ارز در Redis (۸ بایت برای هر ارز)"""
+        step = self.step_of(ts if ts is not None else time.time())
+        dtype = np.dtype(HISTORY_FIELDS)
+        offset = (step % self.slots) * dtype.itemsize
+        ttl = self.slots * self.step
+        for cg_id, price in base_prices(prices).items():
+            pipe.setrange(history_key(cg_id), offset, np.array((price, step), dtype=dtype).tobytes())
+            pipe.expire(history_key(cg_id), ttl)
+
+    def row(self, cg_id):
+        return self._rows.get(cg_id, -1)
+
+    def changes(self, window):
+        """درصد تغییر قیمت همه ارزها در window دقیقه اخیر (برداری؛ NaN یعنی داده کافی نیست)
+
+        مقدار قبلی از خونه step هدف خونده میشه و اگه اون دقیقه قیمت نیومده بود، یک step قبل‌تر.
+        """
+        n = len(self._rows)
+        if not n:
+            return np.zeros(0)
+        target = self.now_step - window * 60 // self.step
+        past = np.full(n, np.nan, dtype=np.float32)
+        for step in (target, target - 1):
+            records = self._data[:n, step % self.slots]
+            past = np.where(np.isnan(past) & (records['step'] == step), records['price'], past)
+        current = np.where(self._last['step'][:n] >= self.now_step - 1, self._last['price'][:n], np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(past > 0, (current - past) / past * 100, np.nan)
+
+    def change(self, cg_id, window):
+        row = self.row(cg_id)
+        if row < 0:
+            return None
+        value = self.changes(window)[row]
+        return None if np.isnan(value) else float(value)
+
+price_history = PriceHistory()
 
-WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}/{TOKEN}"
-logger.info(f"Webhook URL: {WEBHOOK_URL}")
+# --- چک قیمت دوره‌ای ---
+MESSAGE_LIMIT = 4096  # حداکثر طول پیام تلگرام
 
-# --- اتصال به Redis ---
-r = redis.from_url(
-    UPSTASH_REDIS_URL,
-    decode_responses=True,
-    ssl_cert_reqs=None
-)
-r.ping()
-logger.info("Redis متصل شد!")
+# قیمت‌های تازه از آخرین اجرای چک‌کننده
+fresh_prices = {}
 
-# --- توابع Redis ---
-def get_user_data(user_id):
-    data = r.get(f"user:{user_id}")
-    return json.loads(data) if data else []
+def on_price_update(prices):
+    fresh_prices.update(prices)
+    checker_wakeup.set()
 
-def set_user_data(user_id, data):
-    r.set(f"user:{user_id}", json.dumps(data, ensure_ascii=False))
+if BOT_MODE != "web":
+    # پروسه web چک قیمت نداره: قیمت‌هایی که get_price اونجا می‌گیره فقط snapshot میشن (مثل mirror)،
+    # نه numpy و mget تاریخچه و نه fresh_prices ـی که هیچ‌وقت خالی نمیشه
+    price_feed.subscribe(price_history.record)
+    price_feed.subscribe(on_price_update)
 
-# --- کش قیمت ---
-def get_price(cg_id):
-    cache_key = f"price:{cg_id}"
-    try:
-        cached = r.get(cache_key)
-        if cached:
-            return json.loads(cached)['price']
-    except:
-        pass
+def find_alert_hits(prices):
+    """{user_id: {cg_id, ...}} برای هشدارهایی که با این قیمت‌ها فعال شدن (قیمتی و درصدی)"""
+    hits = {}
+    for user_id, cg_id in alert_index.evaluate(prices, price_history):
+        hits.setdefault(user_id, set()).add(cg_id)
+    return hits
 
-    try:
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={cg_id}&vs_currencies=usd"
-        headers = {"User-Agent": "CryptoBot/1.0"}
-        resp = requests.get(url, headers=headers, timeout=8)
-        if resp.status_code == 429:
-            cached = r.get(cache_key)
-            if cached:
-                return json.loads(cached)['price']
-            return None
-        price = resp.json().get(cg_id, {}).get("usd")
-        if price is not None:
-            r.setex(cache_key, 55, json.dumps({"price": price, "timestamp": time.time()}))
-            return price
-    except:
-        pass
+def describe_alert(alert, currency=BASE_CURRENCY):
+    if alert['op'] == '%':
+        window = next((label for mins, label in MOVE_WINDOWS if mins == alert['window']), f"{alert['window']} دقیقه")
+        return f"تغییر ±{alert['price']:g}% در {window}"
+    op_text = "بیشتر یا مساوی با" if alert['op'] == '>=' else "کمتر یا مساوی با"
+    return f"{op_text} {format_price(alert['price'], currency)}"
 
-    try:
-        cached = r.get(cache_key)
-        if cached:
-            return json.loads(cached)['price']
-    except:
-        pass
-    return None
+def split_message(lines, limit=MESSAGE_LIMIT):
+    """خطوط رو به چند تکه تقسیم می‌کنه که هر کدوم حداکثر limit کاراکتر باشه (فقط سر خط می‌شکنه)"""
+    chunks = []
+    current, size = [], 0
+    for line in lines:
+        extra = len(line[0]) + (1 if current else 0)
+        if current and size + extra > limit:
+            chunks.append(current)
+            current, size = [], 0
+            extra = len(line[0])
+        current.append(line)
+        size += extra
+    if current:
+        chunks.append(current)
+    return chunks
 
-# --- چک قیمت دوره‌ای ---
 async def safe_check_prices(context: ContextTypes.DEFAULT_TYPE = None):
-    """چک قیمت اتوماتیک — دقیقاً طبق زمان‌بندی هر کاربر (۱۵ دقیقه، ۸ ساعت، ۲۴ ساعت و ...)"""
+    """چک قیمت اتوماتیک — فقط ارزهایی که زمان ارسالشون رسیده (از روی ایندکس due) + هشدارهای فعال‌شده"""
+    started = time.perf_counter()
     try:
-        bot = application.bot
-        current_time = time.time()
+        async with profiler.cycle():
+            current_time = time.time()
 
-        # گرفتن همه کاربران
-        keys = r.keys("user:*")
-        if not keys:
-            return
+            # قیمت‌ها از price feed میان؛ هشدارها فقط روی قیمت‌هایی که از آخرین چک تازه شدن بررسی میشن
+            with profiler.span('fetch'):
+                prices = dict(price_feed.snapshot)
+                updates = dict(fresh_prices)
+                fresh_prices.clear()
+            with profiler.span('evaluate'):
+                alert_hits = find_alert_hits(updates)
 
-        all_cg_ids = set()
-        users_to_update = {}
+            for shard in sorted(shard_manager.owned):
+                with profiler.span('load'):
+                    due_by_user = await get_due(shard, current_time)
+                user_ids = list(due_by_user)
+                for start in range(0, len(user_ids), 500):
+                    if shard not in shard_manager.owned:
+                        break  # lease از دست رفت؛ بقیه شارد مال worker دیگه‌ست
+                    batch_ids = user_ids[start:start + 500]
+                    with profiler.span('load'):
+                        batch = await load_users(batch_ids)
+                    alerts_by_user = {user_id: alert_hits.pop(user_id) for user_id in batch_ids if user_id in alert_hits}
 
-        for key in keys:
-            try:
-                user_id = int(key.split(":")[1])
-                raw = r.get(key)
-                if not raw:
-                    continue
-                settings = json.loads(raw)
-                users_to_update[user_id] = settings
-                for item in settings:
-                    all_cg_ids.add(item['cg_id'])
-            except:
-                continue
+                    await process_user_batch(batch, due_by_user, alerts_by_user, prices, current_time)
 
-        # فقط یک درخواست به CoinGecko برای همه ارزها
-        prices = {}
-        if all_cg_ids:
-            try:
-                ids_str = ','.join(all_cg_ids)
-                url = f"https://api.coingecko.com/api/v3/simple/price?ids={ids_str}&vs_currencies=usd"
-                resp = requests.get(url, headers={"User-Agent": "CryptoBot/1.0"}, timeout=12)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    for cg_id in all_cg_ids:
-                        if cg_id in data and "usd" in data[cg_id]:
-                            prices[cg_id] = data[cg_id]["usd"]
-            except Exception as e:
-                logger.warning(f"Batch price fetch failed: {e}")
+            # کاربرانی که فقط هشدار دارن
+            pending = list(alert_hits)
+            for start in range(0, len(pending), 500):
+                user_ids = pending[start:start + 500]
+                with profiler.span('load'):
+                    batch = await load_users(user_ids)
+                await process_user_batch(batch, {}, alert_hits, prices, current_time)
+
+    except Exception as e:
+        logger.error(f"خطای کلی در safe_check_prices: {e}", exc_info=True)
+    finally:
+        CHECK_CYCLE_SECONDS.observe(time.perf_counter() - started)
 
-        # پردازش هر کاربر و ارسال پیام
-        for user_id, settings in users_to_update.items():
+async def process_user_batch(batch, due_by_user, alerts_by_user, prices, current_time):
+    """برای هر کاربر ارزهای due و هشدارهای فعال‌شده‌اش تو یک پیام (digest) ارسال میشه
+
+    پیام فقط سر حد ۴۰۹۶ کاراکتر تلگرام تکه میشه. پیام‌های کل batch همزمان به dispatcher داده میشن
+    و last_sent فقط برای ارزهایی که پیامشون رسیده به‌روز میشه. اگه کاربر ربات رو بلاک کرده باشه یا چتش
+    نباشه (undeliverable) ارسال‌هاش متوقف میشه (pause_users)، بقیه BadRequest ها دوره بعد دوباره امتحان
+    میشن و فقط خطاهای موقت (RetryAfter، TimedOut، NetworkError) یک دقیقه بعد.
+    due_by_user باید همه ارزهای due هر کاربر رو داشته باشه (get_due کل شارد رو می‌خونه)، وگرنه یک کاربر چند پیام می‌گیره.
+    """
+    reschedule = {}
+    stale = []
+    outgoing = []  # (user_id, text, items)
+    with profiler.span('evaluate'):
+        for user_id, settings in batch:
+            due_ids = set(due_by_user.get(user_id, ()))
+            alert_ids = alerts_by_user.get(user_id, ())
+            price_lines, alert_lines = [], []
             for item in settings:
                 cg_id = item['cg_id']
                 symbol = item['symbol']
-                period_min = item.get('period', 15)  # پیش‌فرض ۱۵ دقیقه
-                last_sent = item.get('last_sent', 0)
-
-                # آیا زمان ارسال رسیده؟
-                if current_time - last_sent < period_min * 60:
-                    continue
+                currency = item.get('currency', BASE_CURRENCY)
+                key = quote_key(cg_id, currency)
+                member = f"{user_id}:{cg_id}"
 
-                # گرفتن قیمت
-                price = prices.get(cg_id)
-                if price is None:
-                    price = get_price(cg_id)  # fallback به کش
-                if not price:
-                    continue
+                if cg_id in due_ids:
+                    due_ids.discard(cg_id)
+                    # ارزهای هشدار‌دار فقط با alert_index بررسی میشن
+                    if 'alert' in item:
+                        stale.append(member)
+                        continue
+                    # ایندکس جلوتر از داده کاربره (مثلاً زمانش همین الان عوض شده)
+                    if next_send_time(item) > current_time:
+                        reschedule[member] = next_send_time(item)
+                        continue
+                    price = prices.get(key)
+                    if price is None:
+                        with profiler.span('fetch'):
+                            price = await get_cached_price(key)  # fallback به کش
+                    if not price:
+                        reschedule[member] = current_time + 60
+                        continue
+                    price_lines.append((f"**{md(symbol)}**: `{format_price(price, currency)}`", item))
 
-                # ساخت متن پیام
-                if 'alert' in item:
-                    op = item['alert']['op']
-                    target = item['alert']['price']
-                    if (op == '>=' and price < target) or (op == '<=' and price > target):
+                elif cg_id in alert_ids and 'alert' in item:
+                    # هر هشدار حداکثر یکبار در هر دوره (period) ارز
+                    if current_time - item.get('last_sent', 0) < item.get('period', 15) * 60:
                         continue
-                    op_text = "بیشتر یا مساوی با" if op == '>=' else "کمتر یا مساوی با"
-                    text = f"⚠️ هشدار قیمت!\n\n**{symbol}**: `${price:,.2f}`\nشرط: {op_text} `${target:,.2f}`"
-                else:
-                    text = f"**{symbol}**: `${price:,.2f}`"
+                    if key not in prices:
+                        # هشدار درصدی روی قیمت دلاری بررسی میشه؛ قیمت به واحد کاربر شاید هنوز نرسیده باشه
+                        key, currency = cg_id, BASE_CURRENCY
+                    line = f"**{md(symbol)}**: `{format_price(prices[key], currency)}`"
+                    if item['alert']['op'] == '%':
+                        change = price_history.change(cg_id, item['alert']['window'])
+                        if change is not None:
+                            line += f" ({change:+.2f}%)"
+                    alert_lines.append((f"{line}\nشرط: {describe_alert(item['alert'], currency)}", item))
+                    ALERTS_FIRED.labels('percent' if item['alert']['op'] == '%' else 'price').inc()
 
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=text,
-                        parse_mode='Markdown',
-                        disable_web_page_preview=True
-                    )
-                    item['last_sent'] = current_time
-                    logger.info(f"قیمت ارسال شد به {user_id} - {symbol} - هر {period_min} دقیقه")
-                except Exception as e:
-                    logger.warning(f"ارسال پیام به {user_id} ناموفق: {e}")
-
-        # ذخیره last_sent های جدید
-        for user_id, settings in users_to_update.items():
-            set_user_data(user_id, settings)
+            # ارزهایی که دیگه تو تنظیمات کاربر نیستن
+            stale.extend(f"{user_id}:{cg_id}" for cg_id in due_ids)
 
-    except Exception as e:
-        logger.error(f"خطای کلی در safe_check_prices: {e}", exc_info=True)
+            lines = []
+            if alert_lines:
+                lines.append(("⚠️ هشدار قیمت!\n", None))
+                lines.extend(alert_lines)
+                if price_lines:
+                    lines.append(("", None))
+            lines.extend(price_lines)
+            for chunk in split_message(lines):
+                outgoing.append((user_id, "\n".join(line for line, _ in chunk), [item for _, item in chunk if item]))
+
+    sends = []  # (user_id, items, future)
+    with profiler.span('send'):
+        for user_id, text, items in outgoing:
+            future = await dispatcher.submit(user_id, text, parse_mode='Markdown', disable_web_page_preview=True)
+            sends.append((user_id, items, future))
+        await asyncio.gather(*(future for *_, future in sends), return_exceptions=True)
+
+    dirty = {}
+    dropped = set()
+    for user_id, items, future in sends:
+        error = future.exception()
+        if error is not None and undeliverable(error):
+            dropped.add(user_id)
+            continue
+        for item in items:
+            if error is None:
+                item['last_sent'] = int(current_time)
+                dirty.setdefault(user_id, {})[item['cg_id']] = item['last_sent']
+            if 'alert' in item:
+                continue
+            member = f"{user_id}:{item['cg_id']}"
+            if error is None:
+                reschedule[member] = next_send_time(item)
+            elif isinstance(error, BadRequest):
+                # خود پیام ایراد داره؛ تکرارش تا دوره بعد فایده‌ای نداره
+                reschedule[member] = current_time + item.get('period', 15) * 60
+            else:
+                # RetryAfter/TimedOut/NetworkError (بعد از تلاش‌های dispatcher)
+                reschedule[member] = current_time + 60
+        if error is None:
+            logger.info(f"قیمت ارسال شد به {user_id} - {', '.join(item['symbol'] for item in items)}")
+    if dropped:
+        reschedule = {member: score for member, score in reschedule.items() if int(member.split(":", 1)[0]) not in dropped}
+
+    with profiler.span('write-back'):
+        # ذخیره last_sent های جدید — فقط کاربرانی که پیام گرفتن و فقط همین فیلد
+        if dirty:
+            await save_last_sent(dirty)
+
+        if stale or reschedule:
+            # یک ZREM و یک ZADD برای هر شارد، نه یک دستور برای هر ارز
+            stale_by_shard, reschedule_by_shard = {}, {}
+            for member in stale:
+                stale_by_shard.setdefault(shard_of(int(member.split(":", 1)[0])), []).append(member)
+            for member, score in reschedule.items():
+                reschedule_by_shard.setdefault(shard_of(int(member.split(":", 1)[0])), {})[member] = score
+            pipe = ar.pipeline(transaction=False)
+            for shard, members in stale_by_shard.items():
+                pipe.zrem(due_key(shard), *members)
+            for shard, scores in reschedule_by_shard.items():
+                pipe.zadd(due_key(shard), scores)
+            with REDIS_OPS['reschedule'].time():
+                await pipe.execute()
+
+        if dropped:
+            pause_users([(user_id, settings) for user_id, settings in batch if user_id in dropped])
 
 async def start_price_checker():
-    """هر ۱۰ دقیقه یکبار چک کن — کاملاً دقیق برای کاربران ۱۵ دقیقه‌ای"""
-    await asyncio.sleep(25)  # صبر تا وب‌هوک و همه چیز بالا بیاد
-    logger.info("شروع چک قیمت اتوماتیک هر ۱۰ دقیقه...")
+    """چک قیمت دقیقاً سر موعد: تا نزدیک‌ترین زمان ارسال یا رسیدن قیمت تازه می‌خوابه (حداکثر ۱۰ دقیقه)
+
+    بعد از main صدا زده میشه که Redis و bot آماده‌ان؛ پس بدون صبر ثابت، به محض ساخته شدن ایندکس‌ها شروع می‌کنه.
+    """
+    await ensure_indexes()
+    spawn(run_shard_manager())
+    spawn(listen_events())
+    spawn(price_feed.run())
+    logger.info("شروع چک قیمت اتوماتیک طبق ایندکس زمان ارسال...")
     while True:
+        checker_wakeup.clear()
         try:
             await safe_check_prices()
         except Exception as e:
             logger.error(f"خطا در start_price_checker: {e}")
-        await asyncio.sleep(600)  # ۶۰۰ ثانیه = ۱۰ دقیقه
+        startup_mark('first_check')
+        try:
+            first = await next_due_at(shard_manager.owned)
+        except Exception as e:
+            logger.error(f"خطا در خواندن ایندکس زمان ارسال: {e}")
+            first = None
+        delay = 600 if first is None else min(max(first - time.time(), 1), 600)
+        try:
+            # اگه ارزی اضافه/ویرایش بشه یا قیمت تازه برسه، زودتر بیدار میشیم
+            await asyncio.wait_for(checker_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 # --- ایموجی‌ها ---
 TICK = "✅"
 CROSS = "❌"
@@ -239,6 +2778,475 @@ ALL_COINS = {
     'SC': 'siacoin', 'DGB': 'digibyte', 'XEM': 'nem', 'ZEN': 'horizen', 'SYS': 'syscoin'
 }
 
+# --- کاتالوگ و ایندکس جستجوی ارز ---
+CATALOG_PATH = os.environ.get("CATALOG_PATH", os.path.join(DATA_DIR, "catalog.bin"))
+CATALOG_SOURCE = os.environ.get("CATALOG_SOURCE", os.path.join(DATA_DIR, "coins_list.json"))  # خروجی /coins/list کوین‌گکو
+CATALOG_REFRESH = int(os.environ.get("CATALOG_REFRESH", 6 * 3600))
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+def _search_key(text):
+    return _NON_ALNUM.sub('', text.lower())
+
+def _trigrams(key):
+    padded = f"^{key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+_KEY_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"  # تنها کاراکترهای کلیدها (_search_key)
+_KEY_CODES = {ord(c): i for i, c in enumerate(_KEY_CHARS, 1)}
+PREFIX_BUCKETS = (len(_KEY_CHARS) + 1) ** 2
+
+def _prefix_bucket(data):
+    """خونه جدول پیشوندهای یک و دو حرفی: کد حرف اول × ۳۷ + کد حرف دوم (۰ برای پیشوند یک حرفی)"""
+    return _KEY_CODES[data[0]] * (len(_KEY_CHARS) + 1) + (_KEY_CODES[data[1]] if len(data) > 1 else 0)
+
+class _Records:
+    """دسترسی ایندکسی به رکوردهای ثابت‌طول داخل بافر (برای bisect)"""
+
+    def __init__(self, buf, offset, count, fmt, decode=None):
+        self._buf = buf
+        self._offset = offset
+        self._count = count
+        self._struct = struct.Struct(fmt)
+        self._decode = decode
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        record = self._struct.unpack_from(self._buf, self._offset + i * self._struct.size)
+        return self._decode(record) if self._decode else record
+
+    def raw(self, lo, hi):
+        """رکوردهای lo تا hi بدون decode، یکجا با iter_unpack (برای پیمایش بازه‌های بزرگ)"""
+        size = self._struct.size
+        return self._struct.iter_unpack(memoryview(self._buf)[self._offset + lo * size:self._offset + hi * size])
+
+class CoinIndex:
+    """کاتالوگ ارزها + ایندکس جستجو، در یک فرمت باینری فشرده
+
+    کل ایندکس یک بافر پیوسته‌ست (bytes یا mmap فایل)، پس برای ۱۵ هزار ارز هم
+    موقع بالا اومدن چیزی parse نمیشه و فقط صفحه‌هایی که جستجو لازم داره خونده میشن.
+
+    رتبه هر ارز همون ترتیبش توی کاتالوگه، پس بین نتیجه‌های هم‌سطح ارز معروف‌تر جلوتر میاد.
+    - نماد دقیق: جدول هش روی کلیدها (O(1))
+    - پیشوند: بازه کلیدهای هر پیشوند یک و دو حرفی از جدول ثابت PREFIX_BUCKETS خونه‌ای میاد و برای
+      پیشوندهای بلندتر فقط داخل همون بازه bisect میشه. بهترین‌های هر پیشوندی که بازه‌اش بزرگه
+      (همه یک و دو حرفی‌ها، و بلندترهایی مثل "toke" با بیشتر از PREFIX_HOT کلید) موقع ساخت
+      حساب و تو فایل نوشته میشن، پس هیچ جستجوی پیشوندی بازه بزرگ رو پیمایش نمی‌کنه
+    - فازی: inverted index سه‌حرفی + ضریب Dice
+    """
+
+    MAGIC = b"CGCAT\x00\x00\x02"
+    HEADER = struct.Struct("<8s9Iqq")  # magic، تعداد بخش‌ها، اثر انگشت فایل منبع
+    COIN = struct.Struct("<IIIHHHxx")  # symbol_off, id_off, name_off, symbol_len, id_len, name_len
+    KEY = struct.Struct("<IIHBx")      # key_off, rank, key_len, tier
+    GRAM = struct.Struct("<3sxII")     # gram, postings_off, postings_len
+    HOT = struct.Struct("<IHxxII")     # prefix_off, prefix_len, ranks_off, ranks_len
+    # جدول PREFIX_BUCKETS خونه‌ای: lo, hi (بازه کلیدها), ranks_off, ranks_len
+
+    TIER_SYMBOL, TIER_NAME, TIER_WORD = 0, 1, 2
+    SHORT_PREFIX = 2
+    SHORT_PREFIX_KEEP = 32
+    PREFIX_HOT = 64
+    MIN_SIMILARITY = 0.4
+    FUZZY_CANDIDATES = 50
+    FUZZY_POSTINGS = 4000
+
+    def __init__(self, buf):
+        self._buf = buf
+        (magic, n_coins, n_keys, n_slots, n_grams, n_fields, n_postings, n_hot, n_prefix_ranks, _,
+         self.source_mtime, self.source_size) = self.HEADER.unpack_from(buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError("فرمت فایل کاتالوگ نامعتبره")
+        view = memoryview(buf)
+        offset = self.HEADER.size
+        self._coins = _Records(buf, offset, n_coins, self.COIN.format)
+        offset += n_coins * self.COIN.size
+        self._keys = _Records(buf, offset, n_keys, self.KEY.format, self._decode_key)
+        offset += n_keys * self.KEY.size
+        self._slots = view[offset:offset + n_slots * 4].cast('I')
+        offset += n_slots * 4
+        self._by_id = view[offset:offset + n_coins * 4].cast('I')  # رتبه‌ها مرتب بر اساس cg_id
+        offset += n_coins * 4
+        self._grams = _Records(buf, offset, n_grams, self.GRAM.format)
+        offset += n_grams * self.GRAM.size
+        self._field_rank = view[offset:offset + n_fields * 4].cast('I')
+        offset += n_fields * 4
+        self._field_size = view[offset:offset + n_fields]
+        offset += (n_fields + 3) & ~3
+        self._postings = view[offset:offset + n_postings * 4].cast('I')
+        offset += n_postings * 4
+        self._buckets = view[offset:offset + PREFIX_BUCKETS * 16].cast('I')
+        offset += PREFIX_BUCKETS * 16
+        self._hot = _Records(buf, offset, n_hot, self.HOT.format, self._decode_hot)
+        offset += n_hot * self.HOT.size
+        self._prefix_ranks = view[offset:offset + n_prefix_ranks * 4].cast('I')
+        self._strings = offset + n_prefix_ranks * 4
+        self._gram_postings = {}  # سه‌حرفی -> postings (کش)
+
+    @classmethod
+    def from_coins(cls, coins, source_mtime=0, source_size=0):
+        return cls(cls.build(coins, source_mtime, source_size))
+
+    @classmethod
+    def build(cls, coins, source_mtime=0, source_size=0):
+        """ساخت فرمت باینری از [(symbol, cg_id, name), ...] به ترتیب رتبه"""
+        strings = bytearray()
+        interned = {}
+
+        def intern(text):
+            data = text.encode()[:0xffff]
+            if data not in interned:
+                interned[data] = len(strings)
+                strings.extend(data)
+            return interned[data], len(data)
+
+        coin_records, ids, keys, fields = [], [], [], []
+        seen = set()
+        for symbol, cg_id, name in coins:
+            if not cg_id or cg_id in seen:
+                continue
+            seen.add(cg_id)
+            rank = len(coin_records)
+            name = name or ''
+            (symbol_off, symbol_len), (id_off, id_len), (name_off, name_len) = map(intern, (symbol, cg_id, name))
+            coin_records.append((symbol_off, id_off, name_off, symbol_len, id_len, name_len))
+            ids.append(cg_id)
+
+            symbol_key = _search_key(symbol)
+            coin_keys = {(symbol_key, cls.TIER_SYMBOL)}
+            for text in (cg_id, name):
+                compact = _search_key(text)
+                if compact != symbol_key:
+                    coin_keys.add((compact, cls.TIER_NAME))
+                # هر کلمه جدا هم پیشوند حساب میشه: "shiba-inu" با "inu" هم پیدا میشه
+                for word in _NON_ALNUM.split(text.lower()):
+                    if word != compact and word != symbol_key:
+                        coin_keys.add((word, cls.TIER_WORD))
+            keys.extend((key[:255], tier, rank) for key, tier in coin_keys if key)
+            for key in {symbol_key, _search_key(cg_id), _search_key(name)} - {''}:
+                fields.append((rank, _trigrams(key)))
+
+        keys.sort()
+        key_records = []
+        n_slots = 1 << max(4, (2 * len(keys)).bit_length())
+        slots = [0] * n_slots
+        previous = None
+        for i, (key, tier, rank) in enumerate(keys):
+            data = key.encode()
+            key_off, key_len = intern(key)
+            key_records.append((key_off, rank, key_len, tier))
+            if data != previous:
+                # هر کلید یک بار، به اولین رکوردش اشاره می‌کنه (رکوردهای یک کلید پشت سر هم هستن)
+                slot = zlib.crc32(data) & (n_slots - 1)
+                while slots[slot]:
+                    slot = (slot + 1) & (n_slots - 1)
+                slots[slot] = i + 1
+                previous = data
+
+        buckets, hot, prefix_ranks = cls._build_prefixes(keys, len(coin_records))
+        hot = [(*intern(prefix), ranks_off, ranks_len) for prefix, ranks_off, ranks_len in hot]
+
+        by_id = sorted(range(len(ids)), key=ids.__getitem__)
+        postings_by_gram = {}
+        for field, (_, grams) in enumerate(fields):
+            for gram in grams:
+                postings_by_gram.setdefault(gram, []).append(field)
+        gram_records, postings = [], []
+        for gram in sorted(postings_by_gram):
+            posting = postings_by_gram[gram]
+            gram_records.append((gram.encode(), len(postings), len(posting)))
+            postings.extend(posting)
+
+        out = bytearray(cls.HEADER.pack(
+            cls.MAGIC, len(coin_records), len(key_records), n_slots, len(gram_records),
+            len(fields), len(postings), len(hot), len(prefix_ranks), len(strings), int(source_mtime), int(source_size),
+        ))
+        for record in coin_records:
+            out += cls.COIN.pack(*record)
+        for record in key_records:
+            out += cls.KEY.pack(*record)
+        out += array('I', slots).tobytes()
+        out += array('I', by_id).tobytes()
+        for record in gram_records:
+            out += cls.GRAM.pack(*record)
+        out += array('I', (rank for rank, _ in fields)).tobytes()
+        out += bytes(min(len(grams), 255) for _, grams in fields)
+        out += bytes(-len(fields) % 4)
+        out += array('I', postings).tobytes()
+        out += array('I', buckets).tobytes()
+        for record in hot:
+            out += cls.HOT.pack(*record)
+        out += array('I', prefix_ranks).tobytes()
+        out += strings
+        return bytes(out)
+
+    @classmethod
+    def _build_prefixes(cls, keys, n):
+        """جدول پیشوندهای یک و دو حرفی و بهترین رتبه‌های پیشوندهای پرتکرار، از کلیدهای مرتب (key, tier, rank)
+
+        خروجی: (buckets، [(پیشوند، ranks_off، ranks_len), ...] مرتب، prefix_ranks)
+        """
+        texts = [key for key, _, _ in keys]
+        buckets = [0] * (PREFIX_BUCKETS * 4)
+        hot, prefix_ranks = [], []
+
+        def keep(lo, hi):
+            ranks = cls._top_ranks(((tier, rank) for _, tier, rank in keys[lo:hi]), n, cls.SHORT_PREFIX_KEEP)
+            prefix_ranks.extend(ranks)
+            return len(prefix_ranks) - len(ranks), len(ranks)
+
+        pending = []  # (طول پیشوند، lo، hi) بازه‌هایی که زیرپیشوندهاشون هم شاید پرتکرار باشن
+        for first in _KEY_CHARS:
+            for prefix in [first] + [first + second for second in _KEY_CHARS]:
+                lo = bisect_left(texts, prefix)
+                hi = bisect_left(texts, prefix + '\x7f', lo)
+                if lo == hi:
+                    continue
+                bucket = _prefix_bucket(prefix.encode()) * 4
+                buckets[bucket:bucket + 4] = (lo, hi, *keep(lo, hi))
+                if len(prefix) == cls.SHORT_PREFIX and hi - lo > cls.PREFIX_HOT:
+                    pending.append((len(prefix), lo, hi))
+        while pending:
+            length, lo, hi = pending.pop()
+            i = lo
+            while i < hi:
+                if len(texts[i]) <= length:  # خود پیشوند به عنوان کلید
+                    i += 1
+                    continue
+                prefix = texts[i][:length + 1]
+                j = bisect_left(texts, prefix + '\x7f', i, hi)
+                if j - i > cls.PREFIX_HOT:
+                    hot.append((prefix, *keep(i, j)))
+                    pending.append((length + 1, i, j))
+                i = j
+        hot.sort()
+        return buckets, hot, prefix_ranks
+
+    @classmethod
+    def _top_ranks(cls, entries, n, limit):
+        """بهترین رتبه‌ها از (tier, rank) ها: اول نماد، بعد اسم و کلمه (که توی پیشوند هم‌وزن‌ان)"""
+        scores = {rank if tier == cls.TIER_SYMBOL else n + rank for tier, rank in entries}
+        ranks = []
+        for score in heapq.nsmallest(2 * limit, scores):  # هر ارز حداکثر دو بار: نماد و اسم
+            if score % n not in ranks:
+                ranks.append(score % n)
+        return ranks[:limit]
+
+    def __len__(self):
+        return len(self._coins)
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return bytes(self._buf[start:start + length]).decode()
+
+    def _decode_key(self, record):
+        key_off, rank, key_len, tier = record
+        start = self._strings + key_off
+        return bytes(self._buf[start:start + key_len]), tier, rank
+
+    def _decode_hot(self, record):
+        prefix_off, prefix_len, ranks_off, ranks_len = record
+        start = self._strings + prefix_off
+        return bytes(self._buf[start:start + prefix_len]), ranks_off, ranks_len
+
+    def _cg_id(self, rank):
+        _, id_off, _, _, id_len, _ = self._coins[rank]
+        return self._string(id_off, id_len)
+
+    def coin(self, rank):
+        symbol_off, id_off, name_off, symbol_len, id_len, name_len = self._coins[rank]
+        return self._string(symbol_off, symbol_len), self._string(id_off, id_len), self._string(name_off, name_len)
+
+    def coins(self):
+        return (self.coin(rank) for rank in range(len(self)))
+
+    def get(self, cg_id):
+        lo, hi = 0, len(self._by_id)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._cg_id(self._by_id[mid]) < cg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._by_id) and self._cg_id(self._by_id[lo]) == cg_id:
+            return self.coin(self._by_id[lo])
+        return None
+
+    def _exact(self, key, tier):
+        data = key.encode()
+        mask = len(self._slots) - 1
+        slot = zlib.crc32(data) & mask
+        while self._slots[slot]:
+            i = self._slots[slot] - 1
+            if self._keys[i][0] == data:
+                ranks = []
+                while i < len(self._keys):
+                    found, found_tier, rank = self._keys[i]
+                    if found != data or found_tier > tier:
+                        break
+                    if found_tier == tier:
+                        ranks.append(rank)
+                    i += 1
+                return ranks
+            slot = (slot + 1) & mask
+        return []
+
+    def exact(self, symbol):
+        """ارزهایی که نمادشون دقیقاً همینه (O(1))"""
+        return [self.coin(rank) for rank in self._exact(_search_key(symbol), self.TIER_SYMBOL)]
+
+    def _prefix(self, key, limit):
+        data = key.encode()
+        bucket = _prefix_bucket(data) * 4
+        lo, hi, ranks_off, ranks_len = self._buckets[bucket:bucket + 4]
+        if len(data) > self.SHORT_PREFIX:
+            lo = bisect_left(self._keys, (data,), lo, hi)
+            hi = bisect_left(self._keys, (data + b'\x7f',), lo, hi)
+            if hi - lo <= self.PREFIX_HOT:
+                return self._top_ranks(((tier, rank) for _, rank, _, tier in self._keys.raw(lo, hi)), len(self), limit)
+            # هر پیشوندی با بیشتر از PREFIX_HOT کلید موقع ساخت تو جدول hot نوشته شده
+            _, ranks_off, ranks_len = self._hot[bisect_left(self._hot, (data,))]
+        return self._prefix_ranks[ranks_off:ranks_off + min(ranks_len, limit)].tolist()
+
+    def _posting(self, gram):
+        posting = self._gram_postings.get(gram)
+        if posting is not None:
+            return posting
+        i = bisect_left(self._grams, (gram.encode(),))
+        if i < len(self._grams):
+            found, offset, length = self._grams[i]
+            if found == gram.encode():
+                # فقط سه‌حرفی‌های خود کاتالوگ کش میشن، پس اندازه کش محدوده
+                posting = self._gram_postings[gram] = self._postings[offset:offset + length]
+                return posting
+        return ()
+
+    def _fuzzy(self, key, limit, seen):
+        grams = _trigrams(key)
+        postings = sorted(map(self._posting, grams), key=len)
+        # سه‌حرفی‌های رایج چیزی رو تفکیک نمی‌کنن و فقط کندش می‌کنن: از کم‌تکرارترین شمرده میشن تا وقتی
+        # جمع postings از FUZZY_POSTINGS بیشتر نشه، پس زمان شمردن به اندازه کاتالوگ بستگی نداره
+        counts = Counter()
+        budget = self.FUZZY_POSTINGS
+        for posting in postings:
+            budget -= len(posting)
+            if budget < 0 and counts:
+                break
+            counts.update(posting)
+        # Dice ≥ MIN_SIMILARITY یعنی حداقل need سه‌حرفی مشترک (چون shared ≤ اندازه فیلد)؛ بهترین‌ها به
+        # ترتیب shared میان، پس از اولین نامزد زیر need به بعد هیچ‌کدوم به حد نمی‌رسن
+        need = len(grams) * self.MIN_SIMILARITY / (2 - self.MIN_SIMILARITY) - 1e-9
+        best = {}
+        # sorted با کلید C (dict.__getitem__) روی چند هزار فیلد از heapq.nlargest سریع‌تره
+        for field in sorted(counts, key=counts.__getitem__, reverse=True)[:self.FUZZY_CANDIDATES]:
+            shared = counts[field]
+            if shared < need:
+                break
+            rank = self._field_rank[field]
+            score = 2 * shared / (len(grams) + self._field_size[field])
+            if score >= self.MIN_SIMILARITY and rank not in seen and score > best.get(rank, 0):
+                best[rank] = score
+        return [rank for rank, _ in sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+
+    def search(self, query, limit=10):
+        """نتیجه‌های رتبه‌بندی‌شده: [(symbol, cg_id, name), ...]"""
+        key = _search_key(query)
+        if not key:
+            return []
+        ranks = self._exact(key, self.TIER_SYMBOL)
+        if ranks:
+            # نماد دقیق همون ارزیه که کاربر دنبالشه؛ پیشوند و فازی فقط نتیجه‌های ضعیف‌تر اضافه می‌کنن
+            return [self.coin(rank) for rank in ranks[:limit]]
+        exact_names = self._exact(key, self.TIER_NAME)
+        results = list(dict.fromkeys(exact_names + self._prefix(key, limit)))[:limit]
+        # فازی فقط برای غلط تایپی‌ه؛ وقتی اسم دقیقاً پیدا شده لازم نیست
+        if not exact_names and len(results) < limit and len(key) >= 3:
+            results += self._fuzzy(key, limit - len(results), set(results))
+        return [self.coin(rank) for rank in results]
+
+def builtin_coins():
+    return [
+        (symbol, cg_id, POPULAR_COINS.get(symbol, (None, ''))[1])
+        for symbol, cg_id in ALL_COINS.items()
+    ]
+
+def load_catalog(path=CATALOG_PATH):
+    """کاتالوگ رو از فایل mmap می‌کنه؛ اگه نبود یا خراب بود، همون لیست داخلی"""
+    try:
+        with open(path, 'rb') as f:
+            index = CoinIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        logger.info(f"کاتالوگ ارزها از {path} بارگذاری شد ({len(index)} ارز)")
+        return index
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning(f"فایل کاتالوگ {path} قابل استفاده نیست: {e}")
+    return CoinIndex.from_coins(builtin_coins())
+
+def refresh_catalog(source=CATALOG_SOURCE, path=CATALOG_PATH):
+    """به‌روزرسانی کاتالوگ از dump محلی /coins/list
+
+    اگه فایل منبع عوض نشده باشه (mtime و اندازه) هیچ کاری نمی‌کنه. وگرنه رتبه ارزهای
+    قبلی حفظ میشه، ارزهای جدید ته لیست میان و حذف‌شده‌ها بیرون میرن؛ فایل جدید
+    اتمیک جایگزین میشه و فقط اگه لیست واقعاً عوض شده باشه دوباره ساخته میشه.
+    """
+    global coin_index
+    try:
+        stat = os.stat(source)
+    except FileNotFoundError:
+        return False
+    current = coin_index
+    if (current.source_mtime, current.source_size) == (stat.st_mtime_ns, stat.st_size):
+        return False
+
+    with open(source, 'rb') as f:
+        dump = {
+            coin['id']: (coin.get('symbol', '').upper(), coin['id'], coin.get('name', ''))
+            for coin in json.load(f) if coin.get('id')
+        }
+    builtin = builtin_coins()
+    builtin_ids = {cg_id for _, cg_id, _ in builtin}
+    ordered = [dump.get(cg_id, (symbol, cg_id, name)) for symbol, cg_id, name in builtin]
+    ordered += [dump[cg_id] for _, cg_id, _ in current.coins() if cg_id in dump and cg_id not in builtin_ids]
+    ordered += dump.values()  # ارزهای جدید؛ تکراری‌ها موقع ساخت حذف میشن
+
+    existing = {cg_id for _, cg_id, _ in current.coins()}
+    added = len(dump.keys() - existing)
+    removed = len(existing - dump.keys() - builtin_ids)
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    if not added and not removed and all(dump.get(c[1], c) == c for c in current.coins()):
+        data = bytearray(current._buf[:CoinIndex.HEADER.size])
+        data[-16:] = struct.pack("<qq", *fingerprint)
+        data += current._buf[CoinIndex.HEADER.size:]
+    else:
+        data = CoinIndex.build(ordered, *fingerprint)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    coin_index = load_catalog(path)
+    _inline_coin.cache_clear()
+    logger.info(f"کاتالوگ به‌روز شد: {len(coin_index)} ارز (+{added} / -{removed})")
+    return True
+
+async def run_catalog_refresh():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_catalog)
+        except Exception as e:
+            logger.error(f"خطا در به‌روزرسانی کاتالوگ: {e}")
+        await asyncio.sleep(CATALOG_REFRESH)
+
+coin_index = load_catalog()
+
 MAX_COINS = 20
 TIME_OPTIONS = [
     (8 * 60, "۸ ساعت"), (12 * 60, "۱۲ ساعت"), (24 * 60, "۲۴ ساعت"),
@@ -256,10 +3264,11 @@ def main_menu():
 # --- هندلرها ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not r.exists(f"user:{user_id}"):
-        set_user_data(user_id, [])
+    if not create_user(user_id):
+        resume_user(user_id)
     context.user_data.clear()
-    await update.message.reply_text(
+    await dispatcher.send(
+        update.effective_chat.id,
         f"**به ربات استعلام قیمت ارز خوش اومدی!**\n\n\n"
         f"{COIN} ارزهای معروف رو با **دکمه** انتخاب کن\n\n"
         f"{SEARCH} یا **نام/نماد** رو تایپ کن\n\n"
@@ -278,7 +3287,7 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     text = f"{BACK} منوی اصلی:"
     if update.message:
-        await update.message.reply_text(text, reply_markup=main_menu())
+        await dispatcher.send(update.effective_chat.id, text, reply_markup=main_menu())
     else:
         await update.callback_query.edit_message_text(text, reply_markup=main_menu())
 
@@ -308,7 +3317,7 @@ async def select_popular(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     symbol = query.data.split('_')[2]
     cg_id, _ = POPULAR_COINS[symbol]
-    await query.edit_message_text(f"{TICK} در حال اضافه کردن **{symbol}**...", parse_mode='Markdown')
+    await query.edit_message_text(f"{TICK} در حال اضافه کردن **{md(symbol)}**...", parse_mode='Markdown')
     await add_coin_logic(user_id, symbol, cg_id, query, context)
 
 async def search_coin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -325,21 +3334,20 @@ async def search_coin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def search_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     query_text = update.message.text.strip().lower()
-    results = []
-    for symbol, cg_id in ALL_COINS.items():
-        if query_text in symbol.lower() or query_text in cg_id.lower():
-            results.append((symbol, cg_id))
-        if len(results) >= 10:
-            break
+    results = coin_index.search(query_text, limit=10)
     if not results:
-        await update.message.reply_text(f"{CROSS} ارزی پیدا نشد! دوباره امتحان کن.", reply_markup=main_menu())
+        await dispatcher.send(update.effective_chat.id, f"{CROSS} ارزی پیدا نشد! دوباره امتحان کن.", reply_markup=main_menu())
         context.user_data.clear()
         return
     keyboard = []
-    for symbol, cg_id in results:
-        keyboard.append([InlineKeyboardButton(f"{symbol}", callback_data=f"select_search|{cg_id}|{symbol}")])
+    for symbol, cg_id, name in results:
+        callback_data = f"select_search|{cg_id}"
+        if len(callback_data.encode()) > 64:  # سقف callback_data تلگرام
+            continue
+        label = f"{symbol} {name}" if name else f"{symbol} ({cg_id})"
+        keyboard.append([InlineKeyboardButton(label, callback_data=callback_data)])
     keyboard.append([InlineKeyboardButton(f"{CANCEL} لغو", callback_data='cancel')])
-    await update.message.reply_text(f"نتایج برای `{query_text}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await dispatcher.send(update.effective_chat.id, f"نتایج برای `{md_code(query_text)}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     context.user_data['state'] = 'awaiting_selection'
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -353,58 +3361,56 @@ async def select_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     parts = query.data.split('|')
-    if len(parts) != 3:
+    coin = coin_index.get(parts[1]) if len(parts) == 2 else None
+    if coin:
+        symbol, cg_id, _ = coin
+    elif len(parts) == 3:  # دکمه‌های قدیمی: select_search|cg_id|symbol
+        _, cg_id, symbol = parts
+    else:
         await query.answer("خطا در پردازش", show_alert=True)
         return
-    _, cg_id, symbol = parts
-    await query.edit_message_text(f"{TICK} در حال اضافه کردن **{symbol}**...", parse_mode='Markdown')
+    await query.edit_message_text(f"{TICK} در حال اضافه کردن **{md(symbol)}**...", parse_mode='Markdown')
     await add_coin_logic(user_id, symbol, cg_id, query, context)
 
 async def add_coin_logic(user_id, symbol, cg_id, query_or_msg, context: ContextTypes.DEFAULT_TYPE):
-    settings = get_user_data(user_id)
-    if any(c['cg_id'] == cg_id for c in settings):
-        price = get_price(cg_id)
+    # چک تکراری بودن و سقف MAX_COINS با خود افزودن در یک اسکریپت اتمی
+    status, settings = add_user_coin(user_id, cg_id, symbol)
+    if status == 'exists':
+        currency = next((i.get('currency', BASE_CURRENCY) for i in settings if i['cg_id'] == cg_id), BASE_CURRENCY)
+        price = await get_price(cg_id, currency)
         if price:
-            await context.application.bot.send_message(
-                chat_id=user_id,
-                text=f"{COIN} قیمت لحظه‌ای\n\n**نام ارز:** `{symbol}`\n**قیمت:** `${price:,.2f}`",
+            await dispatcher.send(
+                user_id,
+                f"{COIN} قیمت لحظه‌ای\n\n**نام ارز:** `{md_code(symbol)}`\n**قیمت:** `{format_price(price, currency)}`",
                 parse_mode='Markdown'
             )
         if hasattr(query_or_msg, 'edit_message_text'):
             await query_or_msg.edit_message_text(f"{TICK} **{symbol}** قبلاً اضافه شده!")
         else:
-            await query_or_msg.message.reply_text(f"{TICK} **{symbol}** قبلاً اضافه شده!", reply_markup=main_menu())
+            await dispatcher.send(user_id, f"{TICK} **{symbol}** قبلاً اضافه شده!", reply_markup=main_menu())
         return
 
-    if len(settings) >= MAX_COINS:
+    if status == 'full':
         text = f"{CROSS} **حداکثر {MAX_COINS} ارز می‌تونی داشته باشی!**\nاول یکی رو با {DELETE} پاک کن."
         if hasattr(query_or_msg, 'edit_message_text'):
             await query_or_msg.edit_message_text(text, reply_markup=main_menu(), parse_mode='Markdown')
         else:
-            await query_or_msg.message.reply_text(text, reply_markup=main_menu(), parse_mode='Markdown')
+            await dispatcher.send(user_id, text, reply_markup=main_menu(), parse_mode='Markdown')
         return
 
-    settings.append({
-        'symbol': symbol,
-        'cg_id': cg_id,
-        'period': 15,
-        'last_sent': time.time()
-    })
-    set_user_data(user_id, settings)
-
     if hasattr(query_or_msg, 'edit_message_text'):
-        await query_or_msg.edit_message_text(f"{TICK} **{symbol}** با موفقیت اضافه شد!\nهر **۱۵ دقیقه** قیمت برات میاد.\n{EDIT} می‌تونی زمان یا {ALERT} هشدار بذاری.", parse_mode='Markdown')
+        await query_or_msg.edit_message_text(f"{TICK} **{md(symbol)}** با موفقیت اضافه شد!\nهر **۱۵ دقیقه** قیمت برات میاد.\n{EDIT} می‌تونی زمان یا {ALERT} هشدار بذاری.", parse_mode='Markdown')
     else:
-        await query_or_msg.message.reply_text(f"{TICK} **{symbol}** با موفقیت اضافه شد!", parse_mode='Markdown')
+        await dispatcher.send(user_id, f"{TICK} **{md(symbol)}** با موفقیت اضافه شد!", parse_mode='Markdown')
 
-    price = get_price(cg_id)
+    price = await get_price(cg_id)
     if price:
-        await context.application.bot.send_message(
-            chat_id=user_id,
-            text=f"{COIN} قیمت لحظه‌ای\n\n**نام ارز:** `{symbol}`\n**قیمت:** `${price:,.2f}`",
+        await dispatcher.send(
+            user_id,
+            f"{COIN} قیمت لحظه‌ای\n\n**نام ارز:** `{md_code(symbol)}`\n**قیمت:** `{format_price(price)}`",
             parse_mode='Markdown'
         )
-    await context.application.bot.send_message(chat_id=user_id, text=f"{BACK} منوی اصلی:", reply_markup=main_menu())
+    await dispatcher.send(user_id, f"{BACK} منوی اصلی:", reply_markup=main_menu())
 
 async def list_coins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -423,9 +3429,11 @@ async def list_coins(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mins = item['period']
         time_text = next((t[1] for t in TIME_OPTIONS if t[0] == mins), f"هر {mins} دقیقه")
         status = time_text
+        currency = item.get('currency', BASE_CURRENCY)
+        if currency != BASE_CURRENCY:
+            status += f" | {currency.upper()}"
         if 'alert' in item:
-            op_text = "بیشتر یا مساوی با" if item['alert']['op'] == '>=' else "کمتر یا مساوی با"
-            status += f" | هشدار: {op_text} ${item['alert']['price']:,.2f}"
+            status += f" | هشدار: {describe_alert(item['alert'], currency)}"
         keyboard.append([
             InlineKeyboardButton(f"{EDIT} {symbol} - {status}", callback_data=f"edit_{cg_id}"),
             InlineKeyboardButton(f"{DELETE}", callback_data=f"remove_{cg_id}")
@@ -449,10 +3457,11 @@ async def edit_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton(f"{EDIT} تغییر زمان", callback_data=f"time_{cg_id}")],
         [InlineKeyboardButton(f"{ALERT} تنظیم هشدار", callback_data=f"alert_{cg_id}")],
+        [InlineKeyboardButton(f"💱 واحد قیمت ({item.get('currency', BASE_CURRENCY).upper()})", callback_data=f"currency_{cg_id}")],
         [InlineKeyboardButton(f"{CROSS} حذف هشدار", callback_data=f"clearalert_{cg_id}") if 'alert' in item else InlineKeyboardButton(" ", callback_data='none')],
         [InlineKeyboardButton(f"{BACK} برگشت", callback_data='list_coins')]
     ]
-    await query.edit_message_text(f"{EDIT} ویرایش `{item['symbol']}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(f"{EDIT} ویرایش `{md_code(item['symbol'])}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -465,7 +3474,7 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for mins, label in TIME_OPTIONS:
         keyboard.append([InlineKeyboardButton(label, callback_data=f"settime_{cg_id}_{mins}")])
     keyboard.append([InlineKeyboardButton(f"{BACK} برگشت", callback_data=f"edit_{cg_id}")])
-    await query.edit_message_text(f"{EDIT} زمان `{symbol}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(f"{EDIT} زمان `{md_code(symbol)}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def save_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -474,15 +3483,57 @@ async def save_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = query.data.split('_')
     cg_id = parts[1]
     mins = int(parts[2])
-    settings = get_user_data(user_id)
-    for i in settings:
-        if i['cg_id'] == cg_id:
-            i['period'] = mins
-            i['last_sent'] = time.time()
-            break
-    set_user_data(user_id, settings)
+    _, settings = set_user_coin_period(user_id, cg_id, mins)
+    i = next((i for i in settings if i['cg_id'] == cg_id), None)
+    if not i:
+        await query.edit_message_text(f"{CROSS} خطا: ارز پیدا نشد!", reply_markup=main_menu())
+        return
     time_label = next((t[1] for t in TIME_OPTIONS if t[0] == mins), f"هر {mins} دقیقه")
-    await query.edit_message_text(f"{TICK} زمان `{i['symbol']}` به **{time_label}** تغییر کرد.", reply_markup=main_menu(), parse_mode='Markdown')
+    await query.edit_message_text(f"{TICK} زمان `{md_code(i['symbol'])}` به **{time_label}** تغییر کرد.", reply_markup=main_menu(), parse_mode='Markdown')
+
+async def set_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    cg_id = query.data.split('_')[1]
+    settings = get_user_data(query.from_user.id)
+    item = next((i for i in settings if i['cg_id'] == cg_id), None)
+    if not item:
+        await query.edit_message_text(f"{CROSS} خطا: ارز پیدا نشد!", reply_markup=main_menu())
+        return
+    current = item.get('currency', BASE_CURRENCY)
+    keyboard = []
+    for currency in QUOTE_CURRENCIES:
+        label = f"{currency.upper()} - {currency_label(currency)}"
+        if currency == current:
+            label = f"{TICK} {label}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"setcur_{cg_id}_{currency}")])
+    keyboard.append([InlineKeyboardButton(f"{BACK} برگشت", callback_data=f"edit_{cg_id}")])
+    text = f"💱 قیمت `{md_code(item['symbol'])}` به چه واحدی بیاد؟"
+    if 'alert' in item and item['alert']['op'] != '%':
+        text += "\nمبلغ هشدار هم با قیمت فعلی به واحد جدید تبدیل میشه."
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+async def save_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    _, cg_id, currency = query.data.split('_')
+    if currency not in QUOTE_CURRENCIES:
+        await query.edit_message_text(f"{CROSS} این واحد پشتیبانی نمیشه!", reply_markup=main_menu())
+        return
+    status, settings, alert = await set_user_coin_currency(user_id, cg_id, currency)
+    i = next((i for i in settings if i['cg_id'] == cg_id), None)
+    if status == 'noprice':
+        text = f"{CROSS} الان قیمت برای تبدیل مبلغ هشدار در دسترس نیست، کمی بعد دوباره امتحان کن."
+    elif status == 'changed':
+        text = f"{CROSS} تنظیمات این ارز همین الان عوض شد، دوباره امتحان کن."
+    elif not i:
+        text = f"{CROSS} خطا: ارز پیدا نشد!"
+    else:
+        text = f"{TICK} قیمت `{md_code(i['symbol'])}` از این به بعد به **{currency_label(currency)}** ({currency.upper()}) میاد."
+        if alert:
+            text += f"\nهشدار: **{describe_alert(alert, currency)}**"
+    await query.edit_message_text(text, reply_markup=main_menu(), parse_mode='Markdown')
 
 async def set_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -494,9 +3545,20 @@ async def set_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("بیشتر از (≥)", callback_data=f"alertop_{cg_id}_>=")],
         [InlineKeyboardButton("کمتر از (≤)", callback_data=f"alertop_{cg_id}_<=")],
+        [InlineKeyboardButton("تغییر درصدی (±٪)", callback_data=f"alertop_{cg_id}_%")],
         [InlineKeyboardButton(f"{CANCEL} لغو", callback_data='cancel')]
     ]
-    await query.edit_message_text(f"{ALERT} هشدار `{symbol}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(f"{ALERT} هشدار `{md_code(symbol)}`:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+async def select_alert_window(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    cg_id = query.data.split('_')[1]
+    keyboard = [
+        [InlineKeyboardButton(label, callback_data=f"alertwin_{cg_id}_{mins}")] for mins, label in MOVE_WINDOWS
+    ]
+    keyboard.append([InlineKeyboardButton(f"{CANCEL} لغو", callback_data='cancel')])
+    await query.edit_message_text(f"{ALERT} تغییر قیمت در چه بازه‌ای؟", reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def select_alert_op(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -505,40 +3567,66 @@ async def select_alert_op(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = query.data.split('_')
     cg_id = parts[1]
     op = parts[2]
-    context.user_data['temp_alert'] = {'cg_id': cg_id, 'op': op}
+    if op == '%':
+        await select_alert_window(update, context)
+        return
+    item = next((i for i in get_user_data(user_id) if i['cg_id'] == cg_id), None)
+    currency = item.get('currency', BASE_CURRENCY) if item else BASE_CURRENCY
+    context.user_data['temp_alert'] = {'cg_id': cg_id, 'op': op, 'currency': currency}
     context.user_data['state'] = 'alert_price'
     keyboard = [[InlineKeyboardButton(f"{CANCEL} لغو", callback_data='cancel')]]
-    await context.application.bot.send_message(
-        chat_id=user_id,
-        text=f"{ALERT} مبلغ مورد نظر را به صورت عددی وارد کنید (مثلاً 10000 یا 10000.50):\n\n`{op}` X\n\nیا دکمه زیر رو بزن تا لغو کنی:",
+    await dispatcher.send(
+        user_id,
+        f"{ALERT} مبلغ مورد نظر را به **{currency_label(currency)}** ({currency.upper()}) به صورت عددی وارد کنید (مثلاً 10000 یا 10000.50):\n\n`{op}` X\n\nیا دکمه زیر رو بزن تا لغو کنی:",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='Markdown'
     )
 
+async def save_alert_window(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, cg_id, mins = query.data.split('_')
+    context.user_data['temp_alert'] = {'cg_id': cg_id, 'op': '%', 'window': int(mins)}
+    context.user_data['state'] = 'alert_price'
+    keyboard = [[InlineKeyboardButton(f"{CANCEL} لغو", callback_data='cancel')]]
+    await query.edit_message_text(
+        f"{ALERT} درصد تغییر رو به صورت عددی وارد کنید (مثلاً 5 یا 2.5):\n\nیا دکمه زیر رو بزن تا لغو کنی:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
 async def save_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     text = update.message.text.strip().replace(',', '')
     try:
         price = float(text)
     except ValueError:
-        await update.message.reply_text(f"{CROSS} فقط عدد معتبر وارد کنید (مثلاً 10000 یا 10000.50)!")
+        await dispatcher.send(update.effective_chat.id, f"{CROSS} فقط عدد معتبر وارد کنید (مثلاً 10000 یا 10000.50)!")
         return
     temp = context.user_data.get('temp_alert')
     if not temp:
-        await update.message.reply_text(f"{CROSS} خطا! دوباره امتحان کن.", reply_markup=main_menu())
+        await dispatcher.send(update.effective_chat.id, f"{CROSS} خطا! دوباره امتحان کن.", reply_markup=main_menu())
         return
     cg_id = temp['cg_id']
     op = temp['op']
-    op_text = "بیشتر یا مساوی با" if op == '>=' else "کمتر یا مساوی با"
-    settings = get_user_data(user_id)
-    for i in settings:
-        if i['cg_id'] == cg_id:
-            i['alert'] = {'op': op, 'price': price}
-            break
-    set_user_data(user_id, settings)
+    currency = temp.get('currency', BASE_CURRENCY)
+    alert = {'op': op, 'price': price}
+    if op == '%':
+        if price <= 0:
+            await dispatcher.send(update.effective_chat.id, f"{CROSS} درصد باید بزرگ‌تر از صفر باشه!")
+            return
+        alert['window'] = temp['window']
+    status, settings = set_user_coin_alert(user_id, cg_id, alert, currency)
     context.user_data.clear()
-    await update.message.reply_text(
-        f"{TICK} هشدار `{i['symbol']}` تنظیم شد:\n{op_text} **${price:,.2f}**",
+    i = next((i for i in settings if i['cg_id'] == cg_id), None)
+    if status == 'changed':
+        await dispatcher.send(update.effective_chat.id, f"{CROSS} واحد قیمت این ارز عوض شده، هشدار رو دوباره تنظیم کن.", reply_markup=main_menu())
+        return
+    if not i:
+        await dispatcher.send(update.effective_chat.id, f"{CROSS} خطا: ارز پیدا نشد!", reply_markup=main_menu())
+        return
+    await dispatcher.send(
+        update.effective_chat.id,
+        f"{TICK} هشدار `{md_code(i['symbol'])}` تنظیم شد:\n**{describe_alert(alert, currency)}**",
         reply_markup=main_menu(),
         parse_mode='Markdown'
     )
@@ -548,28 +3636,19 @@ async def clear_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     cg_id = query.data.split('_')[1]
-    settings = get_user_data(user_id)
-    for i in settings:
-        if i['cg_id'] == cg_id and 'alert' in i:
-            del i['alert']
-            await query.edit_message_text(f"{CROSS} هشدار `{i['symbol']}` حذف شد.", reply_markup=main_menu(), parse_mode='Markdown')
-            set_user_data(user_id, settings)
-            return
+    status, settings = clear_user_coin_alert(user_id, cg_id)
+    i = next((i for i in settings if i['cg_id'] == cg_id), None)
+    if status == 'ok' and i:
+        await query.edit_message_text(f"{CROSS} هشدار `{md_code(i['symbol'])}` حذف شد.", reply_markup=main_menu(), parse_mode='Markdown')
 
 async def remove_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
     cg_id = query.data.split('_')[1]
-    settings = get_user_data(user_id)
-    removed_symbol = "؟"
-    new_settings = [item for item in settings if item['cg_id'] != cg_id]
-    for item in settings:
-        if item['cg_id'] == cg_id:
-            removed_symbol = item['symbol']
-            break
-    set_user_data(user_id, new_settings)
-    await query.edit_message_text(f"{DELETE} `{removed_symbol}` حذف شد.", reply_markup=main_menu(), parse_mode='Markdown')
+    _, _, removed = remove_user_coin(user_id, cg_id)
+    removed_symbol = removed['symbol'] if removed else "؟"
+    await query.edit_message_text(f"{DELETE} `{md_code(removed_symbol)}` حذف شد.", reply_markup=main_menu(), parse_mode='Markdown')
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -582,7 +3661,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"{SEARCH} **جستجو**: هر ارزی رو تایپ کن\n"
             f"{TICK} **قیمت فوری**: بعد از اضافه کردن\n"
             f"هر **۱۵ دقیقه** قیمت میاد\n"
-            f"{EDIT} **ویرایش**: زمان + هشدار\n"
+            f"{EDIT} **ویرایش**: زمان + هشدار + واحد قیمت ({', '.join(c.upper() for c in QUOTE_CURRENCIES)})\n"
             f"حداکثر **{MAX_COINS} ارز**\n"
             f"ساده و حرفه‌ای"
         ),
@@ -603,7 +3682,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif state == 'search':
         await search_coin(update, context)
     elif state == 'awaiting_selection':
-        await update.message.reply_text(f"{CROSS} لطفاً از دکمه‌های پیشنهادی استفاده کن.", reply_markup=main_menu())
+        await dispatcher.send(update.effective_chat.id, f"{CROSS} لطفاً از دکمه‌های پیشنهادی استفاده کن.", reply_markup=main_menu())
         context.user_data.clear()
     else:
         await search_coin(update, context)
@@ -611,122 +3690,500 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}")
 
-# --- Flask App ---
-flask_app = Flask(__name__)
+# --- inline mode ---
+# "@bot btc eth sol" (یا "@bot btc eur") از هر چتی. جواب فقط از حافظه همین پروسه ساخته میشه:
+# قیمت از price_feed.snapshot و کش L1 و ارز از coin_index — بدون Redis و بدون صبر برای upstream.
+# قیمت ارزی که تو حافظه نیست تو پس‌زمینه گرفته میشه و query بعدی (با cache_time کوتاه) جوابش رو داره.
+# جواب‌ها هم تو پروسه (InlineAnswers) و هم سمت تلگرام (cache_time، برای همه کاربرها) کش میشن.
+# وب‌هوک جواب رو مستقیم تو پاسخ همون درخواست برمی‌گردونه (answerInlineQuery داخل پاسخ وب‌هوک)، پس
+# نه صف آپدیت‌ها و نه یک درخواست جدا به Bot API سر راهش نیست؛ INLINE_WEBHOOK_REPLY=0 یعنی مسیر
+# معمولی (InlineQueryHandler). inline mode باید از BotFather (/setinline) روشن باشه.
+INLINE_WEBHOOK_REPLY = os.environ.get("INLINE_WEBHOOK_REPLY", "1") != "0"
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 30))  # ثانیه؛ کش سمت تلگرام
+INLINE_MISSING_CACHE_TIME = 3  # وقتی قیمت بعضی ارزها هنوز نرسیده
+INLINE_MAX_COINS = 10
+INLINE_DEFAULT = ('BTC', 'ETH', 'BNB', 'SOL', 'XRP', 'TON')  # query خالی
+INLINE_WARMUPS = 20  # حداکثر fetch پس‌زمینه همزمان
 
+class InlineAnswers:
+    """کش جواب‌های inline در دو سطح (هر دو LRU با حداکثر maxsize)
 
-# --- Flask Routes ---
-@flask_app.route('/')
-def index():
-    return "ربات فعاله و وب‌هوک درست کار می‌کنه! 🚀", 200
+    - هر ارز و واحد (quote_key): (price, article, line) — article همون dict نتیجه answerInlineQuery ـه
+      و فقط وقتی قیمت همون ارز عوض شده دوباره ساخته میشه
+    - هر query (متن نرمال‌شده): (quotes, prices, cache_time, articles, results_json) — تا وقتی قیمت
+      ارزهای خود query عوض نشده همون JSON برمی‌گرده، پس قیمت تازه ارزهای دیگه کش رو خالی نمی‌کنه
+    """
 
-@flask_app.route('/health', methods=['GET'])
-def health_check():
-    try:
-        r.ping()
-        return "OK - Redis Connected - Bot Running!", 200
-    except Exception as e:
-        return f"Redis Error: {e}", 500
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._queries = OrderedDict()
+        self._articles = OrderedDict()
+        self._warming = set()
+        self.stats = {'hits': 0, 'misses': 0, 'warmups': 0}
 
-@flask_app.route(f'/{TOKEN}', methods=['POST'])
-def telegram_webhook():
-    global main_loop
-    try:
-        update_json = request.get_json(force=True)
-        if not update_json:
-            return 'No JSON received', 400
-
-        update = Update.de_json(update_json, application.bot)
-        
-        if main_loop is None:
-            logger.error("main_loop هنوز آماده نیست!")
-            return 'Loop not ready', 503
-
-        # ارسال آپدیت به loop اصلی
-        asyncio.run_coroutine_threadsafe(
-            application.process_update(update),
-            main_loop
+    def __len__(self):
+        return len(self._queries)
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def get(self, key):
+        entry = self._queries.get(key)
+        if entry is not None and tuple(inline_price(*quote) for quote in entry[0]) == entry[1]:
+            self._queries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, entry):
+        self._remember(self._queries, key, entry)
+
+    def article(self, coin, currency, price):
+        """(article، خط متن) یک ارز؛ تا قیمت عوض نشده از کش"""
+        symbol, cg_id, name = coin
+        key = quote_key(cg_id, currency)
+        cached = self._articles.get(key)
+        if cached is not None and cached[0] == price:
+            return cached[1], cached[2]
+        shown = format_price(price, currency)
+        line = f"**{md(symbol)}**: `{shown}`"
+        article = {
+            'type': 'article', 'id': f"{zlib.crc32(key.encode()):x}",
+            'title': f"{symbol}: {shown}", 'description': name or cg_id,
+            'input_message_content': {
+                'message_text': f"{COIN} قیمت لحظه‌ای\n\n**نام ارز:** `{md_code(symbol)}`\n**قیمت:** `{shown}`",
+                'parse_mode': 'Markdown',
+            },
+        }
+        self._remember(self._articles, key, (price, article, line))
+        return article, line
+
+    def warm(self, cg_id, currency):
+        """قیمت ارز در پس‌زمینه (get_price)؛ درخواست‌های تکراری یکی میشن"""
+        key = quote_key(cg_id, currency)
+        if key in self._warming or len(self._warming) >= INLINE_WARMUPS:
+            return
+        self._warming.add(key)
+        self.stats['warmups'] += 1
+        asyncio.ensure_future(get_price(cg_id, currency)).add_done_callback(lambda task: self._warmed(key, task))
+
+    def _warmed(self, key, task):
+        self._warming.discard(key)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"گرفتن قیمت {key} برای inline ناموفق: {task.exception()}")
+
+inline_answers = InlineAnswers()
+
+@functools.lru_cache(maxsize=4096)
+def _inline_coin(token):
+    """بهترین ارز برای یک کلمه query (نماد، cg_id یا اسم)؛ با عوض شدن کاتالوگ خالی میشه"""
+    found = coin_index.search(token, limit=1)
+    return found[0] if found else None
+
+def inline_price(cg_id, currency):
+    """قیمت فقط از حافظه پروسه، یا None"""
+    key = quote_key(cg_id, currency)
+    price = price_feed.snapshot.get(key)
+    if price is None:
+        cached = price_cache.peek(key)
+        price = cached[0] if cached else None
+    return price
+
+def parse_inline_query(text):
+    """(ارزها، واحد پول) از متن query — کلمه‌ای که یکی از QUOTE_CURRENCIES باشه واحد رو تعیین می‌کنه"""
+    currency = BASE_CURRENCY
+    tokens = [token for token in re.split(r"[\s,]+", text.lower()) if token]
+    coins = []
+    for token in tokens:
+        if token in QUOTE_CURRENCIES:
+            currency = token
+        elif len(coins) < INLINE_MAX_COINS and (coin := _inline_coin(token)) and coin not in coins:
+            coins.append(coin)
+    if all(token in QUOTE_CURRENCIES for token in tokens):
+        coins = [coin for symbol in INLINE_DEFAULT if (coin := coin_index.get(POPULAR_COINS[symbol][0]))]
+    return coins, currency
+
+def inline_results(text):
+    """(cache_time, articles, results_json) برای متن یک inline query؛ هیچ I/O ای نداره"""
+    key = " ".join(text.lower().split())
+    cached = inline_answers.get(key)
+    if cached is not None:
+        return cached[2:]
+    coins, currency = parse_inline_query(key)
+    quotes = tuple((cg_id, currency) for _, cg_id, _ in coins)
+    prices = tuple(inline_price(*quote) for quote in quotes)
+    articles, lines = [], []
+    for coin, price in zip(coins, prices):
+        if price is None:
+            inline_answers.warm(coin[1], currency)
+            continue
+        article, line = inline_answers.article(coin, currency, price)
+        articles.append(article)
+        lines.append(line)
+    if len(articles) > 1:
+        articles.insert(0, {
+            'type': 'article', 'id': f"all-{zlib.crc32(key.encode()):x}",
+            'title': f"{COIN} همه ({len(lines)} ارز)",
+            'description': " | ".join(line.replace("**", "").replace("`", "") for line in lines),
+            'input_message_content': {'message_text': f"{COIN} قیمت لحظه‌ای\n\n" + "\n".join(lines), 'parse_mode': 'Markdown'},
+        })
+    missing = None in prices
+    entry = (quotes, prices, INLINE_MISSING_CACHE_TIME if missing else INLINE_CACHE_TIME,
+             articles, json.dumps(articles, ensure_ascii=False))
+    if not missing:
+        inline_answers.put(key, entry)
+    return entry[2:]
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """مسیر معمولی (وقتی جواب تو پاسخ وب‌هوک داده نشده)"""
+    query = update.inline_query
+    cache_time, articles, _ = inline_results(query.query)
+    results = [
+        InlineQueryResultArticle(
+            id=article['id'], title=article['title'], description=article['description'],
+            input_message_content=InputTextMessageContent(**article['input_message_content']),
         )
-        
-        return 'OK', 200
+        for article in articles
+    ]
+    await query.answer(results, cache_time=cache_time, is_personal=False)
 
-    except Exception as e:
-        logger.error(f"Webhook error: {e}", exc_info=True)
-        return 'Error', 500
-
-def run_flask():
-    """اجرای Flask در ترد جدا، اما با دسترسی به همان loop اصلی"""
-    global main_loop
-    
-    # صبر می‌کنیم تا main_loop مقدار بگیرد (حداکثر 10 ثانیه)
-    import time
-    timeout = 10
-    start_time = time.time()
-    while main_loop is None and time.time() - start_time < timeout:
-        time.sleep(0.1)
-    
-    if main_loop is None:
-        logger.error("main_loop هیچوقت مقدار نگرفت! Flask اجرا نمیشه.")
+def inline_webhook_reply(inline):
+    """بدنه پاسخ وب‌هوک برای یک inline_query خام: فراخوانی answerInlineQuery
+
+    از Application رد نمیشه، پس حسابداری هندلر (handler_span) و لاگ خطا (مثل error_handler) همین‌جاست.
+    None یعنی خطا: مثل مسیر معمولی، query بی‌جواب می‌مونه.
+    """
+    with handler_span('inline_query', None):
+        try:
+            cache_time, _, results_json = inline_results(inline.get('query', ''))
+        except Exception as e:
+            logger.error(f"Update {inline} caused error {e}", exc_info=True)
+            return None
+        return (
+            f'{{"method":"answerInlineQuery","inline_query_id":{json.dumps(inline["id"])},'
+            f'"cache_time":{cache_time},"is_personal":false,"results":{results_json}}}'
+        )
+
+# --- وب‌سرور (tornado، روی همان loop اصلی) ---
+class IndexHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ربات فعاله و وب‌هوک درست کار می‌کنه! 🚀")
+
+class RedisHealth:
+    """وضعیت Redis برای /health: ping با کلاینت async، نتیجه‌اش تا ttl ثانیه برای همه health check ها
+
+    health check های همزمان منتظر همون یک ping می‌مونن، پس loop هیچ وقت پشت round-trip Redis قفل نمیشه.
+    """
+
+    def __init__(self, ttl=2, timeout=5):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.error = None
+        self.checked = float("-inf")
+        self._client = None
+        self._ping = None
+
+    async def check(self):
+        """None اگه Redis جواب داد، وگرنه متن خطا"""
+        if time.monotonic() - self.checked >= self.ttl:
+            if self._ping is None:
+                self._ping = asyncio.ensure_future(self._run())
+            await asyncio.shield(self._ping)
+        return self.error
+
+    async def _run(self):
+        try:
+            if self._client is None:
+                self._client = aioredis.from_url(UPSTASH_REDIS_URL, **REDIS_TLS)
+            await asyncio.wait_for(self._client.ping(), self.timeout)
+            self.error = None
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+        finally:
+            self.checked = time.monotonic()
+            self._ping = None
+
+redis_health = RedisHealth()
+
+class HealthHandler(tornado.web.RequestHandler):
+    async def get(self):
+        error = await redis_health.check()
+        if error is None:
+            self.write("OK - Redis Connected - Bot Running!")
+        else:
+            self.set_status(500)
+            self.write(f"Redis Error: {error}")
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def post(self):
+        try:
+            update_json = json.loads(self.request.body or b"null")
+            if not update_json:
+                self.set_status(400)
+                self.write('No JSON received')
+                return
+
+            if INLINE_WEBHOOK_REPLY and 'inline_query' in update_json:
+                UPDATES_RECEIVED.labels('accepted').inc()
+                body = inline_webhook_reply(update_json['inline_query'])
+                if body is None:
+                    self.write('OK')
+                else:
+                    self.set_header("Content-Type", "application/json")
+                    self.write(body)
+                return
+
+            update = Update.de_json(update_json, application.bot)
+
+            # صف محدود: اگه پر باشه 503 میدیم و تلگرام بعداً دوباره می‌فرسته
+            try:
+                application.update_queue.put_nowait(update)
+            except asyncio.QueueFull:
+                logger.warning("صف آپدیت‌ها پره!")
+                UPDATES_RECEIVED.labels('rejected').inc()
+                self.set_status(503)
+                self.write('Busy')
+                return
+
+            UPDATES_RECEIVED.labels('accepted').inc()
+            self.write('OK')
+
+        except Exception as e:
+            UPDATES_RECEIVED.labels('error').inc()
+            logger.error(f"Webhook error: {e}", exc_info=True)
+            self.set_status(500)
+            self.write('Error')
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", prom.CONTENT_TYPE_LATEST)
+        self.write(prom.generate_latest())
+
+class DebugHandler(tornado.web.RequestHandler):
+    """GET: تنظیمات پروفایل + span های آخرین چرخه، هندلرهای اخیر و وضعیت provider های قیمت همین پروسه
+    POST: تغییر تنظیمات برای همه پروسه‌ها (spans، slow_ms، capture؛ مقدار خالی یا 0 یعنی خاموش)
+    """
+
+    FIELDS = ('spans', 'slow_ms', 'capture')
+
+    async def get(self):
+        try:
+            config = await ar.hgetall(PROFILE_KEY)
+        except redis.RedisError as e:
+            self.set_status(500)
+            self.write(f"Redis Error: {e}")
+            return
+        self.write_status(config)
+
+    def write_status(self, config):
+        self.write({
+            'worker': WORKER_ID,
+            'startup': startup_marks,
+            'config': config,
+            'last_cycle': profiler.last_cycle,
+            'handlers': list(profiler.handlers)[-50:],
+            'prices': price_source.status(),
+            'inline': {**inline_answers.stats, 'cached': len(inline_answers)},
+        })
+
+    async def post(self):
+        try:
+            pipe = ar.pipeline(transaction=False)
+            for field in self.FIELDS:
+                value = self.get_argument(field, None)
+                if value is None:
+                    continue
+                if value in ('', '0'):
+                    pipe.hdel(PROFILE_KEY, field)
+                else:
+                    pipe.hset(PROFILE_KEY, field, value)
+            pipe.hgetall(PROFILE_KEY)
+            config = (await pipe.execute())[-1]
+        except redis.RedisError as e:
+            self.set_status(500)
+            self.write(f"Redis Error: {e}")
+            return
+        profiler.apply(config)
+        self.write_status(config)
+
+def make_web_app():
+    return tornado.web.Application([
+        (r"/", IndexHandler),
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
+        (rf"/{re.escape(TOKEN)}/debug", DebugHandler),
+        (rf"/{re.escape(TOKEN)}", WebhookHandler),
+    ])
+
+# --- snapshot محلی برای گرم شدن سریع بعد از ری‌استارت ---
+# قیمت‌های کش L1 و لیست کاربرهای پرکاربرد هر SNAPSHOT_INTERVAL ثانیه و موقع خاموش شدن تو یک فایل
+# نوشته میشن. خود تنظیمات کاربرها ذخیره نمیشه (ممکنه تا ری‌استارت عوض شده باشه): فقط id ها، که بعد از
+# وصل شدن کانال invalidation یکجا از Redis خونده میشن. روی Render DATA_DIR باید یک دیسک دائمی باشه.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", os.path.join(DATA_DIR, "warm_snapshot.json"))
+SNAPSHOT_INTERVAL = 60
+SNAPSHOT_USERS = int(os.environ.get("SNAPSHOT_USERS", 2000))
+
+def save_snapshot(path=SNAPSHOT_PATH):
+    data = {
+        'saved_at': time.time(),
+        'prices': price_cache.items(),
+        'users': settings_cache.hot_users(SNAPSHOT_USERS),
+    }
+    tmp = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"ذخیره snapshot ناموفق: {e}")
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    """قیمت‌هایی که هنوز از stale_ttl کش جوون‌ترن مستقیم تو کش؛ کاربرها برای settings_cache.prefetch"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
         return
-    
-    # حالا از همان loop اصلی استفاده می‌کنیم
-    asyncio.set_event_loop(main_loop)
-    
-    flask_app.run(
-        host="0.0.0.0",
-        port=int(os.environ.get("PORT", 5000)),
-        use_reloader=False,
-        threaded=True
-    )
+    except (OSError, ValueError) as e:
+        logger.warning(f"خوندن snapshot ناموفق: {e}")
+        return
+    now = time.time()
+    prices = [(cg_id, price, ts) for cg_id, price, ts in data.get('prices', ()) if now - ts < price_cache.stale_ttl]
+    for cg_id, price, ts in prices:
+        price_cache.put(cg_id, price, ts)
+    settings_cache.warm_ids = data.get('users', [])
+    logger.info(f"snapshot خونده شد: {len(prices)} قیمت، {len(settings_cache.warm_ids)} کاربر ({now - data.get('saved_at', now):.0f} ثانیه پیش)")
+
+async def run_snapshots():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        save_snapshot()
 
 # --- اجرای اصلی ---
-async def main():
-    global application, main_loop
-    
-    # خیلی مهم: اول از همه loop اصلی رو می‌گیریم و ذخیره می‌کنیم
-    main_loop = asyncio.get_running_loop()
-    logger.info("main_loop با موفقیت گرفته شد")
+async def connect_redis():
+    await asyncio.to_thread(r.ping)
+    logger.info("Redis متصل شد!")
 
-    application = Application.builder().token(TOKEN).concurrent_updates(True).build()
+def build_application():
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    app = builder.build()
 
     # تمام هندلرها (همون قبلی‌ها رو داری، فقط اینا رو اضافه/تغییر بده)
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("menu", menu))
-    application.add_handler(CallbackQueryHandler(add_coin_menu, pattern='^add_coin$'))
-    application.add_handler(CallbackQueryHandler(select_popular, pattern='^select_pop_'))
-    application.add_handler(CallbackQueryHandler(search_coin_start, pattern='^search_coin$'))
-    application.add_handler(CallbackQueryHandler(cancel, pattern='^cancel$'))
-    application.add_handler(CallbackQueryHandler(select_search, pattern=r'^select_search\|'))
-    application.add_handler(CallbackQueryHandler(list_coins, pattern='^list_coins$'))
-    application.add_handler(CallbackQueryHandler(edit_coin, pattern='^edit_'))
-    application.add_handler(CallbackQueryHandler(set_time, pattern='^time_'))
-    application.add_handler(CallbackQueryHandler(save_time, pattern='^settime_'))
-    application.add_handler(CallbackQueryHandler(set_alert, pattern='^alert_'))
-    application.add_handler(CallbackQueryHandler(select_alert_op, pattern='^alertop_'))
-    application.add_handler(CallbackQueryHandler(clear_alert, pattern='^clearalert_'))
-    application.add_handler(CallbackQueryHandler(remove_coin, pattern='^remove_'))
-    application.add_handler(CallbackQueryHandler(help_cmd, pattern='^help$'))
-    application.add_handler(CallbackQueryHandler(back_to_menu, pattern='^back$'))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_error_handler(error_handler)
-
-    await application.initialize()
-    await application.bot.set_webhook(url=WEBHOOK_URL)
-    logger.info(f"Webhook تنظیم شد: {WEBHOOK_URL}")
-
-    # راه‌اندازی Flask در ترد جدا
-    Thread(target=run_flask, daemon=True).start()
-    logger.info("سرور Flask شروع شد")
-
-    # راه‌اندازی چک قیمت اتوماتیک (به جای job_queue)
-    application.create_task(start_price_checker())
-    logger.info("چک قیمت اتوماتیک هر ۱۰ دقیقه فعال شد ✅")
-
-    logger.info("ربات کاملاً فعال شد و در حال اجراست!")
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("menu", menu))
+    app.add_handler(CallbackQueryHandler(add_coin_menu, pattern='^add_coin$'))
+    app.add_handler(CallbackQueryHandler(select_popular, pattern='^select_pop_'))
+    app.add_handler(CallbackQueryHandler(search_coin_start, pattern='^search_coin$'))
+    app.add_handler(CallbackQueryHandler(cancel, pattern='^cancel$'))
+    app.add_handler(CallbackQueryHandler(select_search, pattern=r'^select_search\|'))
+    app.add_handler(CallbackQueryHandler(list_coins, pattern='^list_coins$'))
+    app.add_handler(CallbackQueryHandler(edit_coin, pattern='^edit_'))
+    app.add_handler(CallbackQueryHandler(set_time, pattern='^time_'))
+    app.add_handler(CallbackQueryHandler(save_time, pattern='^settime_'))
+    app.add_handler(CallbackQueryHandler(set_currency, pattern='^currency_'))
+    app.add_handler(CallbackQueryHandler(save_currency, pattern='^setcur_'))
+    app.add_handler(CallbackQueryHandler(set_alert, pattern='^alert_'))
+    app.add_handler(CallbackQueryHandler(select_alert_op, pattern='^alertop_'))
+    app.add_handler(CallbackQueryHandler(save_alert_window, pattern='^alertwin_'))
+    app.add_handler(CallbackQueryHandler(clear_alert, pattern='^clearalert_'))
+    app.add_handler(CallbackQueryHandler(remove_coin, pattern='^remove_'))
+    app.add_handler(CallbackQueryHandler(help_cmd, pattern='^help$'))
+    app.add_handler(CallbackQueryHandler(back_to_menu, pattern='^back$'))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(InlineQueryHandler(inline_query))
+    app.add_error_handler(error_handler)
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    return app
+
+async def main():
+    global application
+
+    application = build_application()
+    load_snapshot()
+
+    if BOT_MODE == "worker" and METRICS_PORT:
+        prom.start_http_server(METRICS_PORT)
+        logger.info(f"متریک‌ها روی پورت {METRICS_PORT} (/metrics)")
+
+    if BOT_MODE != "worker":
+        # وب‌سرور روی همین loop — بدون ترد جدا. اول از همه گوش میده تا health check و وب‌هوک‌هایی که
+        # تلگرام نگه داشته زودتر جواب بگیرن؛ آپدیت‌ها تا application.start تو صف می‌مونن
+        make_web_app().listen(PORT, address="0.0.0.0")
+        logger.info(f"وب‌سرور روی پورت {PORT} شروع شد")
+
+    # مراحل مستقل شبکه همزمان: اتصال Redis، getMe و ثبت وب‌هوک
+    steps = [connect_redis(), application.initialize()]
+    if BOT_MODE != "worker":
+        steps.append(application.bot.set_webhook(url=WEBHOOK_URL))
+    await asyncio.gather(*steps)
+    if BOT_MODE != "worker":
+        logger.info(f"Webhook تنظیم شد: {WEBHOOK_URL}")
+    await dispatcher.start(application.bot)
+
+    if BOT_MODE != "worker":
+        # آپدیت‌های صف رو خود Application پردازش می‌کنه
+        await application.start()
+
+        # کاتالوگ ارزها فقط وقتی فایل منبع عوض شده باشه دوباره ساخته میشه
+        spawn(run_catalog_refresh())
+        spawn(settings_cache.run())
+    if BOT_MODE == "web":
+        # چک قیمت اینجا اجرا نمیشه؛ قیمت‌های price feed فقط برای جواب inline query ها
+        spawn(listen_events(prices_only=True))
+    spawn(run_snapshots())
+    spawn(profiler.run())
+    spawn(stats_collector.run())
+
+    if BOT_MODE != "web":
+        # راه‌اندازی چک قیمت اتوماتیک (به جای job_queue)
+        spawn(start_price_checker())
+        logger.info(f"چک قیمت اتوماتیک فعال شد ✅ (worker: {WORKER_ID}، {CHECKER_SHARDS} شارد)")
+
+    logger.info(f"ربات کاملاً فعال شد و در حال اجراست! (حالت: {BOT_MODE})")
+    startup_mark('ready')
+    # اشیای بالا اومدن (ماژول‌ها، کاتالوگ، Application) تا آخر عمر پروسه زنده‌ان؛ بیرون بردنشون از GC
+    # نسل ۲ مکث هر GC کامل رو کوتاه می‌کنه (روی تأخیر p99 جواب‌های inline مستقیم دیده میشه)
+    gc.freeze()
+
+    # Render موقع deploy اول SIGTERM می‌فرسته؛ asyncio.run فقط SIGINT رو به استثنا تبدیل می‌کنه، پس
+    # اینجا task اصلی رو cancel می‌کنیم تا finally پایین (snapshot، آزاد کردن lease ها) اجرا بشه
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
 
     # نگه داشتن loop اصلی زنده
-    while True:
-        await asyncio.sleep(3600)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        logger.info("در حال خاموش شدن...")
+        # اول چک‌کننده و run_shard_manager متوقف میشن تا بعد از آزاد شدن دوباره leaseی نگیرن، بعد lease ها
+        # آزاد میشن تا worker های دیگه بدون صبر برای انقضا (LEASE_TTL) شاردها رو بردارن
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        try:
+            await shard_manager.release_all()
+        except Exception as e:
+            logger.error(f"خطا در آزاد کردن lease ها: {e}")
+        save_snapshot()
+        if application.running:
+            await application.stop()
+        await dispatcher.stop()
+        await application.shutdown()
+        await price_source.aclose()
 
 if __name__ == '__main__':
     asyncio.run(main())